@@ -0,0 +1,351 @@
+# bench.py - Benchmarks for the Everblaze region database and triggering code
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# These run entirely offline on synthetic data shaped like the daily data dump, so they can be used to compare implementations.
+# Usage: python bench.py <benchmark> [-n REGIONS] [-r REPEAT]
+
+import argparse, random, sqlite3, time, typing, os, tempfile, tracemalloc
+from xml.sax.saxutils import escape
+import db, snapshot
+import utility as util
+
+# Seconds a major/minor update takes, roughly. Only used to spread synthetic regions over a realistic time range.
+MAJOR_LENGTH = 5400.0
+MINOR_LENGTH = 3600.0
+
+# Generate rows shaped like the ones produced by db.parse_region_data(), with update times already backfilled.
+def synthetic_region_data(count: int, seed: int = 0) -> list[tuple]:
+    rng = random.Random(seed)
+
+    names = [f"region_{i}" for i in range(count)]
+    nations = [rng.choice([0, 1, 1, 1, 2, 3, 5, 10, 30, 200]) for _ in range(count)]
+    total_nations = sum(nations)
+
+    rows = []
+    cumulative_nations = 0
+    for (index, name) in enumerate(names):
+        embassies = [(embassy, "established") for embassy in rng.sample(names, rng.randint(0, 8))]
+        wfe = " ".join(rng.choice(["welcome", "to", "the", "region", "raiders", "beware", "[b]founded[/b]", "by", "lwu"]) for _ in range(rng.randint(0, 120)))
+        rows.append((name.replace("_", " ").title(), name, index,
+                     cumulative_nations * MAJOR_LENGTH / total_nations,
+                     cumulative_nations * MINOR_LENGTH / total_nations,
+                     rng.randint(0, 40), int(rng.random() < 0.7), int(rng.random() < 0.05) | (int(rng.random() < 0.3) << 1),
+                     wfe, embassies))
+        cumulative_nations += nations[index]
+
+    return rows
+
+# Generate a decompressed data dump shaped like regions.xml, holding the same regions as synthetic_region_data().
+# Each region also gets a list of nations, which isn't used by Everblaze but makes up a large part of the real dump.
+def synthetic_region_dump(count: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<REGIONS api_version="12">\n']
+
+    for (index, row) in enumerate(synthetic_region_data(count, seed)):
+        numnations = rng.choice([0, 1, 1, 1, 2, 3, 5, 10, 30, 200])
+        nations = ":".join(f"nation_{index}_{n}" for n in range(numnations))
+        embassies = "".join(f"<EMBASSY>{embassy.replace('_', ' ').title()}</EMBASSY>" for (embassy, _) in row[9])
+        parts.append(f"<REGION><NAME>{row[0]}</NAME><NUMNATIONS>{numnations}</NUMNATIONS><NATIONS>{nations}</NATIONS>"
+                     f"<DELEGATEVOTES>{row[5] + 1}</DELEGATEVOTES><DELEGATEAUTH>{'X' if row[6] else 'A'}</DELEGATEAUTH>"
+                     f"<FACTBOOK>{escape(row[8])}</FACTBOOK><LASTMAJORUPDATE>{1700000000 + index}</LASTMAJORUPDATE>"
+                     f"<LASTMINORUPDATE>{1700100000 + index}</LASTMINORUPDATE><EMBASSIES>{embassies}</EMBASSIES></REGION>\n")
+
+    parts.append("</REGIONS>\n")
+    return "".join(parts).encode()
+
+# Run a function <repeat> times and return the average time per call, in microseconds.
+def measure(function: typing.Callable[[], typing.Any], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+# Build an in-memory database with the untyped, unindexed table used by schema version 0.
+def build_untyped_database(rows: list[tuple]) -> sqlite3.Connection:
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE regions(canon_name, api_name, update_index, seconds_major, seconds_minor, delendos, executive, password, governorless, wfe, embassies)")
+    con.executemany("INSERT INTO regions VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [row[:7] + (row[7] & 1, row[7] >> 1 & 1, row[8], ",".join(embassy for (embassy, _) in row[9])) for row in rows])
+    return con
+
+# Build an in-memory database with the current layout.
+def build_current_database(rows: list[tuple]) -> sqlite3.Connection:
+    con = sqlite3.connect(":memory:")
+    cursor = con.cursor()
+    db.create_region_tables(cursor)
+    db.insert_region_data(cursor, "", rows)
+    db.apply_region_tags(cursor, "", {"password": [], "governorless": []})
+    db.create_region_indexes(cursor)
+    db.build_wfe_index(cursor)
+    return con
+
+# Lookup latency by api_name, by update_index and by update time range, before and after the typed, indexed schema.
+def bench_schema(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    rng = random.Random(1)
+    names = [row[1] for row in rows]
+
+    queries = {
+        "api_name": lambda cursor: cursor.execute("SELECT * FROM regions WHERE api_name = ?", [rng.choice(names)]).fetchone(),
+        "update_index": lambda cursor: cursor.execute("SELECT * FROM regions WHERE update_index = ?", [rng.randrange(len(rows))]).fetchone(),
+        "seconds_major": lambda cursor: cursor.execute("SELECT * FROM regions WHERE seconds_major > ? AND seconds_major < ?", [t := rng.uniform(0, MAJOR_LENGTH), t + 1.0]).fetchall(),
+    }
+
+    for (label, builder) in [("untyped", build_untyped_database), ("current", build_current_database)]:
+        cursor = builder(rows).cursor()
+        for (query, function) in queries.items():
+            print(f"{label:>8} {query:>14}: {measure(lambda: function(cursor), args.repeat):10.2f} us/query")
+
+# Matching a list of WFE phrases against every region: lowercasing and scanning each WFE in Python, versus one query on the WFE full-text index.
+def bench_wfe(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    cursor = build_current_database(rows).cursor()
+    wfes = [row[8] for row in rows]
+
+    for count in [1, 10, 50]:
+        phrases = [f"{word} {index}" for (index, word) in zip(range(count), ["raiders", "beware", "founded"] * count)]
+
+        def scan() -> int:
+            matches = 0
+            for wfe in wfes:
+                lowered = wfe.lower()
+                for phrase in phrases:
+                    if phrase in lowered:
+                        matches += 1
+                        break
+            return matches
+
+        print(f"{count:>3} phrases: scan {measure(scan, max(1, args.repeat // 100)):12.2f} us, index {measure(lambda: util.find_wfe_matches(cursor, phrases), args.repeat):10.2f} us")
+
+# Parsing the data dump with parse_region_data(), versus parse_region_data_parallel() with an increasing number of worker processes.
+def bench_parse(args: argparse.Namespace) -> None:
+    dump = synthetic_region_dump(args.regions)
+    chunks = [dump[i:i + db.DOWNLOAD_CHUNK_SIZE] for i in range(0, len(dump), db.DOWNLOAD_CHUNK_SIZE)]
+    repeat = max(1, args.repeat // 1000)
+
+    print(f"{len(dump) / 1e6:.1f} MB dump, {os.cpu_count()} cores available")
+
+    serial = measure(lambda: sum(1 for _ in db.parse_region_data(chunks, db.DumpSummary())), repeat)
+    print(f"  serial: {serial / 1e6:8.3f} s")
+
+    for workers in [1, 2, 4, 8]:
+        parallel = measure(lambda: sum(1 for _ in db.parse_region_data_parallel(chunks, db.DumpSummary(), workers)), repeat)
+        print(f"{workers:>2} cores: {parallel / 1e6:8.3f} s ({serial / parallel:.2f}x)")
+
+# Lookups by name and by update time range through SQLite, versus the memory-mapped snapshot.
+def bench_snapshot(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    rng = random.Random(1)
+    names = [row[1] for row in rows]
+    cursor = build_current_database(rows).cursor()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "regions.snapshot")
+        snapshot.write_snapshot(cursor.connection, path)
+        store = snapshot.RegionStore(path)
+
+        queries = {
+            "index_of": (lambda: util.fetch_update_index(cursor, rng.choice(names)),
+                         lambda: store.index_of(rng.choice(names))),
+            "region": (lambda: util.fetch_region_data_from_db(cursor, rng.choice(names)),
+                       lambda: util.format_database_data(store.get_region(store.index_of(rng.choice(names))))),
+            "time_range": (lambda: cursor.execute("SELECT update_index FROM regions WHERE seconds_major > ? AND seconds_major < ?", [t := rng.uniform(0, MAJOR_LENGTH), t + 1.0]).fetchall(),
+                           lambda: store.find_updating_between(False, t := rng.uniform(0, MAJOR_LENGTH), t + 1.0)),
+        }
+
+        for (query, (sql, mapped)) in queries.items():
+            print(f"{query:>10}: sqlite {measure(sql, args.repeat):8.2f} us, snapshot {measure(mapped, args.repeat):8.2f} us")
+
+        store.close()
+
+# Finding the region updating closest to a given time: a range query scanned in Python, versus a binary search on the timing index.
+def bench_timing(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    rng = random.Random(1)
+    cursor = build_current_database(rows).cursor()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "regions.snapshot")
+        snapshot.write_snapshot(cursor.connection, path)
+        store = snapshot.RegionStore(path)
+
+        indexes = [("query", None), ("array", util.TimingIndex.from_database(cursor)), ("snapshot", util.TimingIndex.from_store(store))]
+
+        for tolerance in [0.3, 2.0, 10.0]:
+            for (label, timing_index) in indexes:
+                function = lambda: util.find_region_updating_at_time(cursor, rng.uniform(0, MAJOR_LENGTH), False, tolerance, tolerance, timing_index)
+                print(f"+-{tolerance:<4} {label:>8}: {measure(function, args.repeat):8.2f} us")
+
+        store.close()
+
+# Finding triggers for many targets at once: one call to find_region_updating_at_time() per target, versus one call to find_regions_updating_at_times().
+def bench_batch(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    rng = random.Random(1)
+    cursor = build_current_database(rows).cursor()
+    timing_index = util.TimingIndex.from_database(cursor)
+    repeat = max(1, args.repeat // 100)
+
+    for count in [10, 100, 1000]:
+        delays = [rng.uniform(0, MAJOR_LENGTH) for _ in range(count)]
+
+        single_query = measure(lambda: [util.find_region_updating_at_time(cursor, delay, False, 2.0, 2.0) for delay in delays], repeat)
+        single_index = measure(lambda: [util.find_region_updating_at_time(cursor, delay, False, 2.0, 2.0, timing_index) for delay in delays], repeat)
+        batch = measure(lambda: util.find_regions_updating_at_times(cursor, delays, False, 2.0, 2.0, timing_index), repeat)
+        print(f"{count:>5} targets: query {single_query / 1e3:8.2f} ms, index {single_index / 1e3:8.2f} ms, batch {batch / 1e3:8.2f} ms")
+
+# Picking the first few raidable regions after a point in update: reading every candidate, versus stopping as soon as enough were read.
+def bench_raidable(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    rng = random.Random(1)
+    cursor = build_current_database(rows).cursor()
+
+    for count in [1, 10, 100]:
+        def first(limit: int | None) -> list:
+            candidates = util.find_raidable_regions(cursor, 20, rng.randrange(len(rows) // 2))
+            return list(candidates) if limit is None else [region for (_, region) in zip(range(limit), candidates)]
+
+        print(f"{count:>3} candidates: all {measure(lambda: first(None), max(1, args.repeat // 10)):10.2f} us, lazy {measure(lambda: first(count), args.repeat):10.2f} us")
+
+# Converting query results to region records: one dictionary per row, versus one Region per row. Measures speed and memory use.
+def bench_region(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    cursor = build_current_database(rows).cursor()
+    data = cursor.execute(f"SELECT {util.REGION_COLUMNS} FROM regions").fetchall()
+    repeat = max(1, args.repeat // 100)
+
+    def as_dictionaries() -> list:
+        return [{"canon_name": row[0], "api_name": row[1], "update_index": row[2], "seconds_major": row[3], "seconds_minor": row[4],
+                 "delendos": row[5], "executive": row[6], "tags": row[7]} for row in data]
+
+    def as_regions() -> list:
+        return [util.format_database_data(row) for row in data]
+
+    for (label, function) in [("dict", as_dictionaries), ("Region", as_regions)]:
+        tracemalloc.start()
+        records = function()
+        (size, _) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del records
+
+        print(f"{label:>6}: {measure(function, repeat) / 1e3:8.2f} ms, {size / len(data):6.1f} bytes/region ({len(data)} regions)")
+
+    scan = measure(lambda: sum(1 for _ in util.find_raidable_regions(cursor, 1000)), repeat)
+    print(f"find_raidable_regions: {scan / 1e3:8.2f} ms")
+
+# Looking up a region by name for each update event: a query on the database, the snapshot's hash table, and the preloaded region cache.
+def bench_cache(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    rng = random.Random(1)
+    names = [row[1] for row in rows]
+    cursor = build_current_database(rows).cursor()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "regions.snapshot")
+        snapshot.write_snapshot(cursor.connection, path)
+        store = snapshot.RegionStore(path)
+
+        region_cache = util.RegionCache()
+        preload = measure(lambda: region_cache.preload(cursor), max(1, args.repeat // 100))
+
+        print(f"   sqlite: {measure(lambda: util.fetch_region_data_from_db(cursor, rng.choice(names)), args.repeat):8.2f} us/lookup")
+        print(f" snapshot: {measure(lambda: store.index_of(rng.choice(names)), args.repeat):8.2f} us/lookup")
+        print(f"    cache: {measure(lambda: region_cache.get(rng.choice(names)), args.repeat):8.2f} us/lookup (preload: {preload / 1e3:.2f} ms)")
+        print(f"           {region_cache.format_stats()}")
+
+        store.close()
+
+# Trigger list operations, per update event (removing already updated triggers and looking up the updating region) and per trigger added.
+def bench_triggers(args: argparse.Namespace) -> None:
+    rows = synthetic_region_data(args.regions)
+    rng = random.Random(1)
+    cursor = build_current_database(rows).cursor()
+
+    for count in [10, 100, 1000]:
+        triggers = [{"api_name": row[1]} for row in rng.sample(rows, count)]
+
+        def fill() -> util.TriggerList:
+            targets = util.TriggerList()
+            for trigger in triggers:
+                targets.add_trigger(dict(trigger))
+                targets.sort_triggers(cursor)
+            return targets
+
+        def update() -> None:
+            targets = fill()
+            for (_, api_name, update_index, *_) in rows:
+                targets.remove_all_updated_triggers(update_index)
+                if targets.query_trigger(api_name) is not None:
+                    targets.remove_trigger(api_name)
+
+        add = measure(fill, max(1, args.repeat // 100)) / count
+        event = (measure(update, max(1, args.repeat // 1000)) - add * count) / len(rows)
+        print(f"{count:>5} triggers: {add:8.2f} us/add, {event:8.2f} us/event")
+
+# Generate happening lines shaped like the ones received from the admin, endo and member SSE feeds, most of which Everblaze ignores.
+def synthetic_happenings(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    formats = [
+        (30, "%%{region}%% updated."),
+        (25, "@@{nation}@@ endorsed @@{other}@@."),
+        (10, "@@{nation}@@ withdrew its endorsement from @@{other}@@."),
+        (3, "@@{nation}@@ resigned from the World Assembly."),
+        (1, "@@{nation}@@ became WA Delegate of %%{region}%%."),
+        (1, "@@{nation}@@ seized the position of %%{region}%% WA Delegate from @@{other}@@."),
+        (10, "@@{nation}@@ was admitted to the World Assembly."),
+        (10, "@@{nation}@@ relocated from %%{region}%% to %%{other}%%."),
+        (5, "@@{nation}@@ was founded in %%{region}%%."),
+        (5, "Following new legislation in @@{nation}@@, it is now illegal to eat at your desk."),
+    ]
+    weights = [weight for (weight, _) in formats]
+
+    return [rng.choices(formats, weights)[0][1].format(region=f"region_{rng.randrange(30000)}", nation=f"nation_{rng.randrange(100000)}",
+                                                       other=f"nation_{rng.randrange(100000)}") for _ in range(count)]
+
+# Classifying happenings: trying each pattern of util.EVENTS in turn, versus util.classify_happening().
+def bench_happenings(args: argparse.Namespace) -> None:
+    happenings = synthetic_happenings(args.regions)
+    repeat = max(1, args.repeat // 100)
+
+    def each_pattern() -> int:
+        matches = 0
+        for happening in happenings:
+            for pattern in util.EVENTS.values():
+                if pattern.match(happening) is not None:
+                    matches += 1
+                    break
+        return matches
+
+    def classify() -> int:
+        return sum(1 for happening in happenings if util.classify_happening(happening) is not None)
+
+    assert each_pattern() == classify()
+
+    for (label, function) in [("patterns", each_pattern), ("classify", classify)]:
+        elapsed = measure(function, repeat)
+        print(f"{label:>8}: {elapsed / len(happenings) * 1e3:8.1f} ns/happening, {len(happenings) / elapsed:6.2f}M happenings/s")
+
+BENCHMARKS: dict[str, typing.Callable[[argparse.Namespace], None]] = {
+    "schema": bench_schema,
+    "wfe": bench_wfe,
+    "parse": bench_parse,
+    "snapshot": bench_snapshot,
+    "timing": bench_timing,
+    "batch": bench_batch,
+    "raidable": bench_raidable,
+    "region": bench_region,
+    "cache": bench_cache,
+    "triggers": bench_triggers,
+    "happenings": bench_happenings,
+}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="everblaze-bench", description="Offline benchmarks for Everblaze")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument("-n", "--regions", type=int, default=30000)
+    parser.add_argument("-r", "--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,10 @@
 # Authored by Merethin, licensed under the BSD-2-Clause license.
 
 from dotenv import dotenv_values
-import discord, sqlite3, argparse, asyncio, typing, math, sys, sans, time
-from discord.ext import commands, tasks
+import discord, sqlite3, argparse, asyncio, typing, sys, sans, datetime
+from discord.ext import commands
 import utility as util
+import recording
 
 from cogs.blacklist import BlacklistManager
 from cogs.db import Database
@@ -14,11 +15,15 @@ from cogs.tag import TagManager
 from cogs.triggers import TriggerManager
 from cogs.update import UpdateListener
 from cogs.lock import TargetLock
+from cogs.refresh import DatabaseRefresher
+from cogs.sse import EventStream, parse_sse_event
 
 VERSION = "0.2.0"
 
 class EverblazeBot(commands.Bot):
-    def __init__(self, bot_db: sqlite3.Connection, everblaze_db: sqlite3.Connection, exit_delay: typing.Optional[int], nation: str):
+    def __init__(self, bot_db: sqlite3.Connection, everblaze_db: sqlite3.Connection, exit_delay: typing.Optional[int], nation: str,
+                 refresh_time: typing.Optional[datetime.time] = None, extra_tags: typing.List[str] = [], workers: int = 1, cache_days: typing.Optional[int] = None,
+                 log_events: bool = False, sse_connections: int = 1, record_path: typing.Optional[str] = None):
         intents: discord.Intents = discord.Intents.default()
         intents.message_content = True
         intents.members = True
@@ -32,22 +37,13 @@ class EverblazeBot(commands.Bot):
         self.everblaze_db = everblaze_db
         self.exit_delay = exit_delay
         self.nation = util.format_nation_or_region(nation)
-
-    async def sse_loop(self):
-        client = sans.AsyncClient()
-        while True:
-            async for event in sans.serversent_events(client, "admin", "endo", "member"):
-                self.last_event = time.time()
-                response = parse_sse_event(event)
-
-                if response is None:
-                    continue
-                    
-                (event, data) = response
-
-                self.dispatch(event, data)
-
-            print("log: SSE disconnected, attempting to reconnect")
+        self.refresh_time = refresh_time
+        self.extra_tags = extra_tags
+        self.workers = workers
+        self.cache_days = cache_days
+        self.log_events = log_events
+        self.sse_connections = sse_connections
+        self.record_path = record_path
 
     async def setup_hook(self):
         loop = asyncio.get_event_loop()
@@ -62,17 +58,11 @@ class EverblazeBot(commands.Bot):
         await self.add_cog(TargetLock(self))
         await self.add_cog(UpdateListener(self, self.exit_delay))
 
-        self.last_event = time.time()
-        self.sse_task = asyncio.create_task(self.sse_loop())
-        self.check_stale_loop.start()
+        if self.refresh_time is not None:
+            await self.add_cog(DatabaseRefresher(self, self.refresh_time, self.extra_tags, self.workers, self.cache_days))
 
-    @tasks.loop(minutes=5)
-    async def check_stale_loop(self):
-        current_time = time.time()
-        if (current_time - self.last_event) > 300:
-            print("No SSE events in the last 5 minutes, restarting connection.")
-            self.sse_task.cancel()
-            self.sse_task = asyncio.create_task(self.sse_loop())
+        recorder = None if self.record_path is None else recording.EventRecorder(self.record_path)
+        await self.add_cog(EventStream(self, self.log_events, connections=self.sse_connections, recorder=recorder))
 
     async def on_ready(self):
         print(f'Everblaze: logged in as {self.user}')
@@ -83,62 +73,6 @@ class EverblazeBot(commands.Bot):
         except Exception as e:
             print(f"Error syncing commands: {e}")
 
-def parse_sse_event(data: dict) -> typing.Optional[typing.Tuple[str, typing.Tuple[str, int] | typing.Tuple[str, str]]]:
-    happening = data["str"]
-
-    match = util.EVENTS["update"].match(happening)
-    if match is not None:
-        region_name = match.groups()[0]
-
-        print(f"[update] {region_name} updated")
-
-        time = math.floor(data["time"].timestamp())
-        return ("region_update", (region_name, time))
-    
-    match = util.EVENTS["endo"].match(happening)
-    if match is not None:
-        target = match.groups()[1]
-
-        print(f"[wa] {target} was endorsed")
-
-        return ("wa", ("endo", target))
-    
-    match = util.EVENTS["unendo"].match(happening)
-    if match is not None:
-        target = match.groups()[1]
-
-        print(f"[wa] {target} was unendorsed")
-
-        return ("wa", ("unendo", target))
-    
-    match = util.EVENTS["resign"].match(happening)
-    if match is not None:
-        target = match.groups()[0]
-
-        print(f"[wa] {target} resigned from the WA")
-
-        return ("wa", ("resign", target))
-    
-    match = util.EVENTS["newdel"].match(happening)
-    if match is not None:
-        point = match.groups()[0]
-        target = match.groups()[1]
-
-        print(f"[wa] {point} became delegate of {target}")
-
-        return ("delegate", (point, target))
-    
-    match = util.EVENTS["seizedel"].match(happening)
-    if match is not None:
-        point = match.groups()[0]
-        target = match.groups()[1]
-
-        print(f"[wa] {point} became delegate of {target}")
-
-        return ("delegate", (point, target))
-    
-    return None
-
 def create_tables_if_needed(bot_db: sqlite3.Connection) -> None:
     bot_cursor = bot_db.cursor()
 
@@ -160,33 +94,48 @@ def create_tables_if_needed(bot_db: sqlite3.Connection) -> None:
 
     bot_cursor.close()
 
-def check_positive_integer(value: typing.Any) -> int:
-    ivalue = int(value)
-    if ivalue <= 0:
-        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
-    return ivalue
+# Parse a time of day given as HH:MM, in UTC.
+def check_time_of_day(value: str) -> datetime.time:
+    try:
+        return datetime.datetime.strptime(value, "%H:%M").time().replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is an invalid HH:MM time" % value)
 
 def main() -> None:
     parser = argparse.ArgumentParser(prog="everblaze-bot", description="Everblaze Discord bot for NationStates R/D")
     parser.add_argument("-n", "--nation-name", required=True)
     parser.add_argument("-r", '--regenerate-db', action='store_true')
-    parser.add_argument("-e", "--exit-delay", type=check_positive_integer)
+    parser.add_argument("--keep-dump", action='store_true')
+    parser.add_argument("-i", "--incremental", action='store_true')
+    parser.add_argument("--tags", type=lambda value: value.split(","), default=[])
+    parser.add_argument("-j", "--jobs", type=util.check_positive_integer, default=1)
+    parser.add_argument("--offline", action='store_true')
+    parser.add_argument("--dump-date")
+    parser.add_argument("--dump-cache-days", type=util.check_positive_integer)
+    parser.add_argument("-e", "--exit-delay", type=util.check_positive_integer)
+    parser.add_argument("--refresh-at", type=check_time_of_day)
+    parser.add_argument("-v", "--log-events", action='store_true')
+    parser.add_argument("--sse-connections", type=util.check_positive_integer, default=1)
+    parser.add_argument("--record-sse")
+    parser.add_argument("--ns-url")
     args = parser.parse_args()
 
     user_agent = f"Everblaze/{VERSION} (Discord bot) by Merethin, used by {args.nation_name}"
     sans.set_agent(user_agent)
+    util.set_ns_base_url(args.ns_url)
 
     if not util.check_if_nation_exists(args.nation_name):
         print(f"The nation {args.nation_name} does not exist. Try again.")
         sys.exit(1)
 
-    util.bootstrap(args.regenerate_db)
+    util.bootstrap(args.regenerate_db, args.keep_dump, args.incremental, args.tags, args.jobs,
+                   args.offline, args.dump_date, args.dump_cache_days)
 
     everblaze_db = sqlite3.connect("regions.db")
     bot_db = sqlite3.connect("bot.db")
     create_tables_if_needed(bot_db)
 
-    bot = EverblazeBot(bot_db, everblaze_db, args.exit_delay, args.nation_name)
+    bot = EverblazeBot(bot_db, everblaze_db, args.exit_delay, args.nation_name, args.refresh_at, args.tags, args.jobs, args.dump_cache_days, args.log_events, args.sse_connections, args.record_sse)
 
     settings = dotenv_values(".env")
     bot.run(settings["TOKEN"])
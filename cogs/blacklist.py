@@ -10,32 +10,13 @@ class BlacklistManager(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
-    def check_blacklist(self, guild: Guild, region: dict) -> bool:
-        embassies: list[str] = region["embassies"].split(",")
-        for embassy in guild.embassy_blacklist:
-            if embassy in embassies:
-                return True
-
-        wfe: str = region["wfe"].lower()
-        for entry in guild.wfe_blacklist:
-            if entry in wfe:
-                return True
-            
-        return False
-    
-    def check_whitelist(self, guild: Guild, region: dict) -> bool:
-        embassies: list[str] = region["embassies"].split(",")
-        for embassy in guild.embassy_whitelist:
-            if embassy in embassies:
-                return True
-
-        wfe: str = region["wfe"].lower()
-        for entry in guild.wfe_whitelist:
-            if entry in wfe:
-                return True
-            
-        return False
-    
+    # Build the filter to apply to candidate regions for a guild, from either its blacklist or its whitelist.
+    # Pass it to util.find_raidable_regions() to get candidates that are already filtered.
+    def get_region_filter(self, guild: Guild, whitelist: bool) -> util.RegionFilter:
+        if whitelist:
+            return util.RegionFilter(guild.embassy_whitelist, guild.wfe_whitelist, True)
+        return util.RegionFilter(guild.embassy_blacklist, guild.wfe_blacklist, False)
+
     @app_commands.command(description="Add/remove a region to/from the embassy blacklist.")
     async def embassyblacklist(self, interaction: discord.Interaction, region: str, remove: bool):
         guilds: GuildManager = self.bot.get_cog('GuildManager')
@@ -1,6 +1,7 @@
 from discord.ext import commands
 import sqlite3
 import utility as util
+import snapshot
 
 # Global database connections are stored here so everyone can access them.
 class Database(commands.Cog):
@@ -8,14 +9,27 @@ class Database(commands.Cog):
         self.bot = bot
         self.bot_db = bot_db
         self.everblaze_db = everblaze_db
+        # Memory-mapped snapshot of the region database, for lookups that have to be fast (e.g. during update).
+        self.region_store = snapshot.RegionStore()
+        self.timing_index = util.TimingIndex.from_store(self.region_store)
+        # Every region in the region database, for lookups by name that have to be fast.
+        self.region_cache = util.RegionCache()
+        self.preload_region_cache()
+
+    # Fill the region cache with every region in the region database. Called again whenever the region database is swapped out.
+    def preload_region_cache(self) -> None:
+        cursor = self.everblaze_db.cursor()
+        self.region_cache.invalidate()
+        self.region_cache.preload(cursor)
+        cursor.close()
 
     # Fetch data for a region from the local database.
     # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
-    # Just a handy wrapper for util.fetch_region_data_from_db().
-    def fetch_region_data(self, region: str) -> dict | None:
+    # Reads from the region cache, and only falls back to util.fetch_region_data_from_db() if it hasn't been preloaded.
+    def fetch_region_data(self, region: str) -> util.Region | None:
         cursor = self.everblaze_db.cursor()
 
-        result = util.fetch_region_data_from_db(cursor, region)
+        result = self.region_cache.fetch(cursor, region)
         cursor.close()
 
         return result
\ No newline at end of file
@@ -6,9 +6,13 @@ from .update import UpdateListener
 from .db import Database
 from .blacklist import BlacklistManager
 from .lock import TargetLock
-import discord, typing
+import discord, typing, itertools, operator
 import utility as util
 
+# Number of raidable regions /select reads from the database and finds triggers for at once. Regions are only read as the user reaches them,
+# since most runs of /select stop long before the end of the list.
+SELECT_BATCH_SIZE = 32
+
 class RegionView(discord.ui.View):
     interaction: discord.Interaction | None = None
 
@@ -50,9 +54,9 @@ class RegionFinder(commands.Cog):
         
         trigger_time = 0
         if minor:
-            trigger_time = region_data["seconds_minor"] - ideal_delay
+            trigger_time = region_data.seconds_minor - ideal_delay
         else:
-            trigger_time = region_data["seconds_major"] - ideal_delay
+            trigger_time = region_data.seconds_major - ideal_delay
 
         if trigger_time < 0:
             await interaction.response.send_message(f"No trigger for {target} found in the specified time range!", ephemeral=guilds.should_be_ephemeral(interaction))
@@ -60,7 +64,7 @@ class RegionFinder(commands.Cog):
 
         cursor = database.everblaze_db.cursor()
 
-        trigger = util.find_region_updating_at_time(cursor, trigger_time, minor, early_tolerance, late_tolerance)
+        trigger = util.find_region_updating_at_time(cursor, trigger_time, minor, early_tolerance, late_tolerance, database.timing_index)
         if trigger is None:
             cursor.close()
             await interaction.response.send_message(f"No trigger for {target} found in the specified time range!", ephemeral=guilds.should_be_ephemeral(interaction))
@@ -68,18 +72,18 @@ class RegionFinder(commands.Cog):
 
         delay = 0
         if minor:
-            delay = region_data["seconds_minor"] - trigger["seconds_minor"]
+            delay = region_data.seconds_minor - trigger.seconds_minor
         else:
-            delay = region_data["seconds_major"] - trigger["seconds_major"]
+            delay = region_data.seconds_major - trigger.seconds_major
 
         targets = triggers.get_trigger_list(interaction)
 
-        targets.add_trigger(compose_trigger(trigger["api_name"], target=util.format_nation_or_region(target), delay=delay, message=message))
+        targets.add_trigger(compose_trigger(trigger.api_name, target=util.format_nation_or_region(target), delay=delay, message=message))
         targets.sort_triggers(cursor)
 
         cursor.close()
 
-        await interaction.response.send_message(f"Set trigger {trigger["api_name"]} for {target} (delay: %.2fs)" % delay, ephemeral=guilds.should_be_ephemeral(interaction))
+        await interaction.response.send_message(f"Set trigger {trigger.api_name} for {target} (delay: %.2fs)" % delay, ephemeral=guilds.should_be_ephemeral(interaction))
 
     @app_commands.command(description="Find and select targets with no password and an executive delegate.")
     async def select(self, interaction: discord.Interaction, update: str, point_endos: int, min_switch_time: float, ideal_delay: float, early_tolerance: float, late_tolerance: float, message: typing.Optional[str], whitelist: bool = False, confirm: bool = True):
@@ -107,7 +111,7 @@ class RegionFinder(commands.Cog):
         if last_update is not None:
             start = last_update.index
 
-        raidable_regions = util.find_raidable_regions(cursor, point_endos, start)
+        raidable_regions = util.find_raidable_regions(cursor, point_endos, start, region_filter=blacklist.get_region_filter(guild, whitelist))
 
         last_switch_time: float = -999
 
@@ -117,108 +121,109 @@ class RegionFinder(commands.Cog):
             else:
                 last_switch_time = last_update.major
 
-        for region in raidable_regions:
-            last_update = update_listener.last_update
+        update_time_of = operator.attrgetter("seconds_minor" if minor else "seconds_major")
 
-            if last_update is not None:
-                if(region["update_index"] <= last_update.index):
-                    continue
+        for batch in itertools.batched(raidable_regions, SELECT_BATCH_SIZE):
+            # Find triggers for every possible target in the batch in one go, instead of looking them up one by one as targets are picked.
+            candidates = [region for region in batch if update_time_of(region) - ideal_delay >= 0]
+            candidate_triggers = util.find_regions_updating_at_times(cursor, [update_time_of(region) - ideal_delay for region in candidates], minor, early_tolerance, late_tolerance, database.timing_index)
+            planned_triggers = {region.api_name: trigger for (region, trigger) in zip(candidates, candidate_triggers)}
 
-            update_time = 0
-            if minor:
-                update_time = region["seconds_minor"]
-            else:
-                update_time = region["seconds_major"]
+            for region in batch:
+                last_update = update_listener.last_update
 
-            if (update_time - last_switch_time) < min_switch_time:
-                continue
+                if last_update is not None:
+                    if(region.update_index <= last_update.index):
+                        continue
 
-            if whitelist:
-                if not blacklist.check_whitelist(guild, region):
-                    continue
-            else:
-                if blacklist.check_blacklist(guild, region):
+                update_time = 0
+                if minor:
+                    update_time = region.seconds_minor
+                else:
+                    update_time = region.seconds_major
+
+                if (update_time - last_switch_time) < min_switch_time:
                     continue
 
-            target = region["api_name"]
-            trigger_time = update_time - ideal_delay
+                target = region.api_name
+                trigger_time = update_time - ideal_delay
 
-            if trigger_time < 0:
-                continue
+                if trigger_time < 0:
+                    continue
 
-            if target_lock.is_locked(interaction.guild.id, compose_trigger("", target=target)):
-                continue
+                if target_lock.is_locked(interaction.guild.id, compose_trigger("", target=target)):
+                    continue
 
-            trigger = util.find_region_updating_at_time(cursor, trigger_time, minor, early_tolerance, late_tolerance)
-            if trigger is None:
-                continue
+                trigger = planned_triggers[target]
+                if trigger is None:
+                    continue
 
-            delay = 0
-            if minor:
-                delay = region["seconds_minor"] - trigger["seconds_minor"]
-            else:
-                delay = region["seconds_major"] - trigger["seconds_major"]
+                delay = 0
+                if minor:
+                    delay = region.seconds_minor - trigger.seconds_minor
+                else:
+                    delay = region.seconds_major - trigger.seconds_major
 
-            targets = triggers.get_trigger_list(interaction)
-            should_finish = False
+                targets = triggers.get_trigger_list(interaction)
+                should_finish = False
 
-            if not confirm:
-                targets.add_trigger(compose_trigger(trigger["api_name"], target=util.format_nation_or_region(target), delay=delay, message=message))
-                targets.sort_triggers(cursor)
+                if not confirm:
+                    targets.add_trigger(compose_trigger(trigger.api_name, target=util.format_nation_or_region(target), delay=delay, message=message))
+                    targets.sort_triggers(cursor)
 
-                target_lock.lock(interaction.guild.id, compose_trigger("", target=target))
+                    target_lock.lock(interaction.guild.id, compose_trigger("", target=target))
 
-                last_switch_time = update_time
-                continue
+                    last_switch_time = update_time
+                    continue
 
-            view = RegionView(interaction.user)
-            accept_button = discord.ui.Button(label="Accept Target", style=discord.ButtonStyle.green)
-            skip_button = discord.ui.Button(label="Find Another", style=discord.ButtonStyle.red)
-            end_button = discord.ui.Button(label="Finish", style=discord.ButtonStyle.gray)
+                view = RegionView(interaction.user)
+                accept_button = discord.ui.Button(label="Accept Target", style=discord.ButtonStyle.green)
+                skip_button = discord.ui.Button(label="Find Another", style=discord.ButtonStyle.red)
+                end_button = discord.ui.Button(label="Finish", style=discord.ButtonStyle.gray)
 
-            async def accept_callback(interaction: discord.Interaction):
-                nonlocal last_switch_time
+                async def accept_callback(interaction: discord.Interaction):
+                    nonlocal last_switch_time
 
-                if target_lock.is_locked(interaction.guild.id, compose_trigger("", target=target)):
-                    await interaction.response.send_message(f"The target {target} has already been selected in a different channel, finding a new one instead.", ephemeral=guilds.should_be_ephemeral(interaction))
-                    view.stop()
-                    return
+                    if target_lock.is_locked(interaction.guild.id, compose_trigger("", target=target)):
+                        await interaction.response.send_message(f"The target {target} has already been selected in a different channel, finding a new one instead.", ephemeral=guilds.should_be_ephemeral(interaction))
+                        view.stop()
+                        return
 
-                targets.add_trigger(compose_trigger(trigger["api_name"], target=util.format_nation_or_region(target), delay=delay, message=message))
-                targets.sort_triggers(cursor)
+                    targets.add_trigger(compose_trigger(trigger.api_name, target=util.format_nation_or_region(target), delay=delay, message=message))
+                    targets.sort_triggers(cursor)
 
-                target_lock.lock(interaction.guild.id, compose_trigger("", target=target))
+                    target_lock.lock(interaction.guild.id, compose_trigger("", target=target))
 
-                last_switch_time = update_time
+                    last_switch_time = update_time
 
-                await interaction.response.send_message(f"Set trigger {trigger["api_name"]} for target {target} (delay: %.2fs)" % delay, ephemeral=guilds.should_be_ephemeral(interaction))
+                    await interaction.response.send_message(f"Set trigger {trigger.api_name} for target {target} (delay: %.2fs)" % delay, ephemeral=guilds.should_be_ephemeral(interaction))
 
-                view.stop()
+                    view.stop()
             
-            async def skip_callback(interaction: discord.Interaction):
-                await interaction.response.send_message(f"Understood, finding a different target...", ephemeral=guilds.should_be_ephemeral(interaction))
-                view.stop()
+                async def skip_callback(interaction: discord.Interaction):
+                    await interaction.response.send_message(f"Understood, finding a different target...", ephemeral=guilds.should_be_ephemeral(interaction))
+                    view.stop()
 
-            async def end_callback(interaction: discord.Interaction):
-                nonlocal should_finish
-                should_finish = True
+                async def end_callback(interaction: discord.Interaction):
+                    nonlocal should_finish
+                    should_finish = True
 
-                await interaction.response.send_message("Stopped looking for targets.", ephemeral=guilds.should_be_ephemeral(interaction))
-                view.stop()
+                    await interaction.response.send_message("Stopped looking for targets.", ephemeral=guilds.should_be_ephemeral(interaction))
+                    view.stop()
 
-            # add the callback to the button
-            accept_button.callback = accept_callback
-            skip_button.callback = skip_callback
-            end_button.callback = end_callback
-            view.add_item(accept_button)
-            view.add_item(skip_button)
-            view.add_item(end_button)
+                # add the callback to the button
+                accept_button.callback = accept_callback
+                skip_button.callback = skip_callback
+                end_button.callback = end_callback
+                view.add_item(accept_button)
+                view.add_item(skip_button)
+                view.add_item(end_button)
 
-            await interaction.followup.send(f"Target: https://www.nationstates.net/region={target}\nTrigger: {trigger["api_name"]}\nDelay: %.2fs" % delay, view=view, ephemeral=guilds.should_be_ephemeral(interaction))
+                await interaction.followup.send(f"Target: https://www.nationstates.net/region={target}\nTrigger: {trigger.api_name}\nDelay: %.2fs" % delay, view=view, ephemeral=guilds.should_be_ephemeral(interaction))
 
-            await view.wait()
+                await view.wait()
 
-            if should_finish:
-                return
+                if should_finish:
+                    return
 
         await interaction.followup.send(f"No more regions found!", ephemeral=guilds.should_be_ephemeral(interaction))
\ No newline at end of file
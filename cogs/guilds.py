@@ -198,6 +198,6 @@ class GuildManager(commands.Cog):
         target_lock: TargetLock = self.bot.get_cog('TargetLock')
 
         target_lock.unlocklist(interaction.guild.id, triggers.trigger_map[interaction.channel.id].triggers)
-        del triggers.trigger_map[interaction.channel.id]
+        triggers.remove_channel(interaction.channel.id)
 
         await interaction.response.send_message("Channel configuration removed!", ephemeral=True)
\ No newline at end of file
@@ -0,0 +1,86 @@
+from discord.ext import commands, tasks
+from .db import Database
+from .triggers import TriggerManager
+from .update import UpdateListener
+from .tag import TagManager
+import asyncio, datetime, sqlite3, typing
+import db, snapshot
+import utility as util
+
+# Temporary file the new region database is built in before being swapped in.
+NEW_DATABASE_PATH = "regions.db.new"
+
+# Number of seconds to wait before checking again whether update is over, when a refresh is due during update.
+UPDATE_WAIT_INTERVAL = 60
+
+# Regenerate the region database every day while the bot is running, without restarting it or losing any triggers.
+class DatabaseRefresher(commands.Cog):
+    def __init__(self, bot: commands.Bot, refresh_time: datetime.time, extra_tags: typing.List[str] = [], workers: int = 1, cache_days: int | None = None):
+        self.bot = bot
+        self.refresh_time = refresh_time
+        self.extra_tags = extra_tags
+        self.workers = workers
+        self.cache = db.DumpCache() if cache_days is None else db.DumpCache(retention_days=cache_days)
+        self.lock = asyncio.Lock()
+
+    async def cog_load(self) -> None:
+        self.refresh_loop.change_interval(time=self.refresh_time)
+        self.refresh_loop.start()
+
+    async def cog_unload(self) -> None:
+        self.refresh_loop.cancel()
+
+    @tasks.loop(hours=24)
+    async def refresh_loop(self):
+        await self.refresh()
+
+    # Build a new region database from the latest data dump in a worker thread, so the bot keeps responding in the meantime.
+    def build_database(self) -> None:
+        db.generate_database(False, False, self.extra_tags, self.workers, cache=self.cache, path=NEW_DATABASE_PATH, snapshot_path=None)
+
+    # Copy the new region database over the current one, and write its snapshot. Also runs in a worker thread.
+    def install_database(self) -> None:
+        db.install_database(NEW_DATABASE_PATH)
+
+        con = sqlite3.connect("regions.db")
+        snapshot.write_snapshot(con)
+        con.close()
+
+    # Regenerate the region database and swap it in, then bring everything that depends on it up to date.
+    async def refresh(self) -> None:
+        if self.lock.locked():
+            return
+
+        async with self.lock:
+            print("[everblaze] regenerating region database in the background")
+
+            try:
+                await asyncio.to_thread(self.build_database)
+            except Exception as e:
+                print(f"[everblaze] failed to regenerate region database: {e}")
+                return
+
+            # Update indexes change with the new database, so don't swap it in while triggers are going off.
+            update_listener: UpdateListener = self.bot.get_cog('UpdateListener')
+            while update_listener.is_updating():
+                await asyncio.sleep(UPDATE_WAIT_INTERVAL)
+
+            await asyncio.to_thread(self.install_database)
+
+            # Commands that are still running keep their cursors on the old connection and snapshot, so they're left for the garbage collector to close.
+            database: Database = self.bot.get_cog('Database')
+            database.everblaze_db = sqlite3.connect("regions.db")
+            database.region_store = snapshot.RegionStore()
+            database.timing_index = util.TimingIndex.from_store(database.region_store)
+            database.preload_region_cache()
+
+            update_listener.reload_region_count()
+
+            triggers: TriggerManager = self.bot.get_cog('TriggerManager')
+            triggers.reindex_triggers()
+
+            # Tag runs keep the update index of their jump point, which may have moved too.
+            tag_manager: TagManager = self.bot.get_cog('TagManager')
+            await tag_manager.reindex_jump_points()
+
+            print(f"[everblaze] region database regenerated, {update_listener.region_count} regions")
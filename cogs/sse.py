@@ -0,0 +1,354 @@
+from discord.ext import commands, tasks
+from discord import app_commands
+import discord, asyncio, time, typing, sans, collections, random
+import utility as util
+import recording
+from .db import Database
+from .update import UpdateListener, SSEGap
+from dataclasses import dataclass, field
+
+# Maximum number of events waiting to be dispatched. Past this, the oldest waiting event other than a region update is dropped to make room
+# for the new one. Region updates are never dropped: if they're all that's waiting, the queue grows past this instead.
+EVENT_QUEUE_SIZE = 4096
+
+# Number of seconds without any SSE event after which the connection is restarted, outside of update.
+STALE_TIMEOUT = 300
+
+# During update, a connection is restarted once it hasn't delivered a region update for this many seconds longer than it should take the next
+# region to update. WA happenings don't count, as a connection can keep delivering those while region updates are held up.
+UPDATE_SILENCE_GRACE = 10
+
+# Number of seconds between each check for silent connections.
+WATCHDOG_INTERVAL = 1
+
+# Reconnecting after a connection fails waits a random time between 0 and RECONNECT_BACKOFF_BASE * 2^failures seconds,
+# capped at RECONNECT_BACKOFF_MAX, so that reconnections don't hammer NationStates.
+RECONNECT_BACKOFF_BASE = 0.5
+RECONNECT_BACKOFF_MAX = 30
+
+# Number of recent event IDs remembered to spot copies of the same event, when reading from several connections at once.
+DEDUPLICATION_WINDOW = 16384
+
+# An event read from the SSE stream, waiting to be dispatched.
+@dataclass
+class ReceivedEvent:
+    name: str # Name of the event to dispatch.
+    data: util.Happening # Data passed to the event's listeners.
+    received: float # time.monotonic() at the time the event was read.
+
+# Counters describing how well event dispatching is keeping up with the SSE stream.
+@dataclass
+class IngestionStats:
+    received: int = 0 # Events read from the stream and queued.
+    dispatched: int = 0 # Events dispatched to listeners.
+    dropped: dict[str, int] = field(default_factory=dict) # Events dropped because the queue was full, by event name.
+    max_depth: int = 0 # Highest number of events ever waiting in the queue at once.
+    total_lag: float = 0 # Sum of the seconds every dispatched event spent in the queue.
+    max_lag: float = 0 # Most seconds any dispatched event spent in the queue.
+    last_lag: float = 0 # Seconds the last dispatched event spent in the queue.
+
+# Counters describing one of the connections to the SSE stream, when reading from several at once.
+@dataclass
+class ConnectionStats:
+    received: int = 0 # Events read from this connection, including copies of events already read from another one.
+    wins: int = 0 # Events read from this connection before any other.
+    total_delay: float = 0 # Sum of the seconds this connection was behind the first one, for events it didn't win.
+    max_delay: float = 0 # Most seconds this connection was ever behind the first one.
+
+# Open the SSE stream Everblaze listens to.
+def open_event_stream(client: sans.AsyncClient) -> typing.AsyncIterable[dict]:
+    return sans.serversent_events(client, "admin", "endo", "member")
+
+# Parse an event from sans.serversent_events(), returning the name of the event to dispatch and its data, or None if it should be ignored.
+# If log is set to True, every happening found is printed out.
+def parse_sse_event(data: dict, log: bool = False) -> typing.Optional[typing.Tuple[str, util.Happening]]:
+    event = util.classify_sse_event(data)
+    if event is None:
+        return None
+
+    if log:
+        print(format_event_log(event))
+
+    return (util.HAPPENING_EVENT_NAMES[type(event)], event)
+
+# Format a line describing a happening, for logging.
+def format_event_log(event: util.Happening) -> str:
+    if isinstance(event, util.RegionUpdateEvent):
+        return f"[update] {event.region} updated"
+    if isinstance(event, util.DelegateEvent):
+        return f"[wa] {event.nation} became delegate of {event.region}"
+    if event.kind == "endo":
+        return f"[wa] {event.nation} was endorsed"
+    if event.kind == "unendo":
+        return f"[wa] {event.nation} was unendorsed"
+    return f"[wa] {event.nation} resigned from the WA"
+
+# Events waiting to be dispatched, in the order they were received. Adding an event never waits: once maxsize events are waiting, the oldest
+# one that isn't a region update is dropped instead. Region updates can't be dropped, since the triggers they set off would only be reported
+# late, and update_end is only dispatched when the last region updates.
+class EventQueue:
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        # Region updates and everything else wait apart, so the oldest droppable event is always at the front of its own deque.
+        # Both hold (sequence, event) pairs, the sequence number telling which of their first events was received first.
+        self.region_updates: collections.deque[tuple[int, ReceivedEvent]] = collections.deque()
+        self.droppable: collections.deque[tuple[int, ReceivedEvent]] = collections.deque()
+        self.sequence = 0
+        self.available = asyncio.Semaphore(0) # Counts the events in the queue, so getting an event waits until there is one.
+
+    def qsize(self) -> int:
+        return len(self.region_updates) + len(self.droppable)
+
+    # Add an event to the queue, and return the event dropped to make room for it, if any.
+    def put(self, event: ReceivedEvent) -> typing.Optional[ReceivedEvent]:
+        dropped = None
+        if self.qsize() >= self.maxsize and len(self.droppable) != 0:
+            (_, dropped) = self.droppable.popleft()
+
+        self.sequence += 1
+        if isinstance(event.data, util.RegionUpdateEvent):
+            self.region_updates.append((self.sequence, event))
+        else:
+            self.droppable.append((self.sequence, event))
+
+        # The dropped event's place in the count goes to the new one.
+        if dropped is None:
+            self.available.release()
+        return dropped
+
+    async def get(self) -> ReceivedEvent:
+        await self.available.acquire()
+        if len(self.droppable) == 0 or (len(self.region_updates) != 0 and self.region_updates[0][0] < self.droppable[0][0]):
+            return self.region_updates.popleft()[1]
+        return self.droppable.popleft()[1]
+
+# Returns how long to wait before reconnecting after failures failures in a row, with random jitter. Never waits after the first one.
+def get_backoff_delay(failures: int) -> float:
+    if failures <= 0:
+        return 0
+    return random.uniform(0, min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_BASE * 2 ** failures))
+
+# Read happenings from the NationStates SSE stream and dispatch them to the rest of the bot.
+# Reading and dispatching are done by separate tasks, with a bounded queue in between, so slow listeners never hold up reading from the stream.
+# If the dispatchers fall so far behind that the queue fills up, the oldest waiting WA happening is dropped, as it is of no use to a tag run
+# anymore. Region updates are always kept (see EventQueue).
+# With connections set to more than 1, the stream is read from that many connections at once, so that one of them stalling doesn't delay
+# anything. Every event is then dispatched as soon as the first copy of it arrives, and later copies are ignored.
+# A watchdog restarts connections that have gone silent: during update, when region updates are expected every few seconds, as soon as
+# one is overdue, and outside of it, after STALE_TIMEOUT seconds without any event. If every connection stopped delivering region updates
+# during update, the regions that updated in the meantime are reported with an "sse_gap" event once the first region update arrives after
+# reconnecting.
+class EventStream(commands.Cog):
+    def __init__(self, bot: commands.Bot, log_events: bool = False, queue_size: int = EVENT_QUEUE_SIZE, dispatchers: int = 1, connections: int = 1,
+                 open_stream: typing.Callable[[sans.AsyncClient], typing.AsyncIterable[dict]] = open_event_stream,
+                 recorder: typing.Optional[recording.EventRecorder] = None):
+        self.bot = bot
+        self.recorder = recorder # If set, every event read (except copies of one already read) is recorded, to be replayed later.
+        self.log_events = log_events
+        self.dispatchers = dispatchers
+        self.connections = connections
+        self.open_stream = open_stream
+        self.queue = EventQueue(queue_size)
+        self.stats = IngestionStats()
+        self.connection_stats = [ConnectionStats() for _ in range(connections)]
+        self.seen_events: collections.OrderedDict[typing.Hashable, float] = collections.OrderedDict() # time.monotonic() each recent event was first read at, by ID.
+        self.last_event = time.time()
+        self.last_events = [time.time()] * connections # Last time an event was read from each connection.
+        self.last_region_update = time.time()
+        self.last_region_updates = [time.time()] * connections # Last time a region update was read from each connection.
+        self.reader_tasks: typing.List[asyncio.Task] = []
+        self.dispatcher_tasks: typing.List[asyncio.Task] = []
+        self.restarts = [0] * connections # Number of times in a row the watchdog restarted each connection.
+        self.outage_since: typing.Optional[float] = None # time.time() of the last event (or region update) before every connection went silent, until the gap is reported.
+
+    async def cog_load(self) -> None:
+        self.last_event = self.last_region_update = time.time()
+        self.last_events = [time.time()] * self.connections
+        self.last_region_updates = [time.time()] * self.connections
+        self.reader_tasks = [asyncio.create_task(self.read_loop(connection)) for connection in range(self.connections)]
+        self.dispatcher_tasks = [asyncio.create_task(self.dispatch_loop()) for _ in range(self.dispatchers)]
+        self.check_stale_loop.start()
+
+    async def cog_unload(self) -> None:
+        self.check_stale_loop.cancel()
+        for task in self.reader_tasks + self.dispatcher_tasks:
+            task.cancel()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    # Read events from one connection to the SSE stream and queue them, reconnecting whenever the stream ends or fails.
+    # If delay is set, wait that many seconds before connecting.
+    async def read_loop(self, connection: int = 0, delay: float = 0) -> None:
+        await asyncio.sleep(delay)
+
+        client = util.ns_async_client()
+        failures = 0
+        while True:
+            try:
+                async for event in self.open_stream(client):
+                    failures = 0
+                    self.restarts[connection] = 0
+                    self.last_event = self.last_events[connection] = time.time()
+                    # Region updates are the only happenings Everblaze listens to that start with a region.
+                    if event["str"].startswith("%%"):
+                        self.last_region_update = self.last_region_updates[connection] = self.last_event
+                    self.handle_sse_event(event, connection)
+
+                print(f"log: SSE connection {connection} disconnected, attempting to reconnect")
+            except Exception as e:
+                print(f"log: SSE connection {connection} failed ({e}), attempting to reconnect")
+
+            # With other connections still up, nothing is missed while this one reconnects.
+            if self.connections == 1:
+                self.start_outage(self.last_event)
+
+            failures += 1
+            await asyncio.sleep(get_backoff_delay(failures))
+
+    # Returns True if this is the first copy of an event read from any connection, and keeps track of which connection won.
+    def deduplicate(self, event: dict, connection: int) -> bool:
+        now = time.monotonic()
+        stats = self.connection_stats[connection]
+        stats.received += 1
+
+        key = event.get("id")
+        if key is None:
+            key = (event["str"], event["time"])
+
+        first_seen = self.seen_events.get(key)
+        if first_seen is not None:
+            delay = now - first_seen
+            stats.total_delay += delay
+            stats.max_delay = max(stats.max_delay, delay)
+            return False
+
+        stats.wins += 1
+        self.seen_events[key] = now
+        if len(self.seen_events) > DEDUPLICATION_WINDOW:
+            self.seen_events.popitem(last=False)
+        return True
+
+    # Parse an event from the SSE stream and queue it for dispatching. Never waits, so it never holds up reading.
+    def handle_sse_event(self, event: dict, connection: int = 0) -> None:
+        if self.connections > 1 and not self.deduplicate(event, connection):
+            return
+
+        if self.recorder is not None:
+            self.recorder.record(event, time.time())
+
+        response = parse_sse_event(event, self.log_events)
+        if response is None:
+            return
+
+        (name, data) = response
+        self.enqueue(ReceivedEvent(name, data, time.monotonic()))
+
+    def enqueue(self, event: ReceivedEvent) -> None:
+        dropped = self.queue.put(event)
+        if dropped is not None:
+            self.stats.dropped[dropped.name] = self.stats.dropped.get(dropped.name, 0) + 1
+
+        self.stats.received += 1
+        self.stats.max_depth = max(self.stats.max_depth, self.queue.qsize())
+
+    # Dispatch queued events to their listeners, in the order they were received.
+    async def dispatch_loop(self) -> None:
+        while True:
+            event = await self.queue.get()
+
+            lag = time.monotonic() - event.received
+            self.stats.dispatched += 1
+            self.stats.total_lag += lag
+            self.stats.max_lag = max(self.stats.max_lag, lag)
+            self.stats.last_lag = lag
+
+            if self.outage_since is not None and isinstance(event.data, util.RegionUpdateEvent):
+                self.report_gap(event.data)
+
+            self.bot.dispatch(event.name, event.data)
+
+    # Remember that no connection is delivering events anymore, so that the regions missed in the meantime can be reported later.
+    def start_outage(self, since: float) -> None:
+        if self.outage_since is None:
+            self.outage_since = since
+
+    # Dispatch an "sse_gap" event if regions updated without Everblaze noticing between the last region update received before the outage
+    # and this one, received after it.
+    def report_gap(self, event: util.RegionUpdateEvent) -> None:
+        outage_since = typing.cast(float, self.outage_since)
+        self.outage_since = None
+
+        update_listener: UpdateListener = self.bot.get_cog('UpdateListener')
+        database: Database = self.bot.get_cog('Database')
+
+        last_update = update_listener.last_update
+        region = database.region_cache.get(event.region)
+        if last_update is None or region is None or region.update_index <= last_update.index + 1:
+            return
+
+        self.bot.dispatch("sse_gap", SSEGap(last_update.index + 1, region.update_index - 1, time.time() - outage_since))
+
+    # Returns the number of seconds a connection can go without delivering a region update before it's considered stalled, or None
+    # outside of update, when region updates aren't expected.
+    def get_update_silence_threshold(self) -> float | None:
+        update_listener: UpdateListener = self.bot.get_cog('UpdateListener')
+        if update_listener is None or not update_listener.is_updating():
+            return None
+
+        expected_gap = update_listener.get_expected_update_gap()
+        if expected_gap is None:
+            return None
+
+        return expected_gap + UPDATE_SILENCE_GRACE
+
+    @tasks.loop(seconds=WATCHDOG_INTERVAL)
+    async def check_stale_loop(self):
+        current_time = time.time()
+        threshold = self.get_update_silence_threshold()
+
+        if threshold is None:
+            (threshold, last, last_by_connection, kind) = (STALE_TIMEOUT, self.last_event, self.last_events, "SSE events")
+        else:
+            (last, last_by_connection, kind) = (self.last_region_update, self.last_region_updates, "region updates")
+
+        # Every connection silent at once means events are being missed, rather than just one connection being slow.
+        if (current_time - last) > threshold:
+            self.start_outage(last)
+
+        for connection in range(self.connections):
+            if (current_time - last_by_connection[connection]) > threshold:
+                print(f"No {kind} in the last %.0f seconds on connection {connection}, restarting it." % (current_time - last_by_connection[connection]))
+                self.reader_tasks[connection].cancel()
+                self.last_events[connection] = self.last_region_updates[connection] = current_time
+                self.restarts[connection] += 1
+                self.reader_tasks[connection] = asyncio.create_task(self.read_loop(connection, get_backoff_delay(self.restarts[connection] - 1)))
+
+    # Format a summary of the ingestion statistics.
+    def format_stats(self) -> str:
+        stats = self.stats
+        average_lag = stats.total_lag / stats.dispatched if stats.dispatched != 0 else 0
+        dropped = ", ".join(f"{count} {name}" for (name, count) in stats.dropped.items()) or "none"
+
+        return (f"Events received: {stats.received}, dispatched: {stats.dispatched}\n"
+                f"Queue depth: {self.queue.qsize()}/{self.queue.maxsize} (max: {stats.max_depth})\n"
+                f"Dispatch lag: %.1fms last, %.1fms average, %.1fms max\n"
+                f"Dropped: {dropped}") % (stats.last_lag * 1000, average_lag * 1000, stats.max_lag * 1000) + self.format_connection_stats()
+
+    # Format a summary of how each connection is doing, when reading from several at once.
+    def format_connection_stats(self) -> str:
+        if self.connections == 1:
+            return ""
+
+        lines = []
+        for (connection, stats) in enumerate(self.connection_stats):
+            win_rate = 100 * stats.wins / stats.received if stats.received != 0 else 0
+            losses = stats.received - stats.wins
+            average_delay = stats.total_delay / losses if losses != 0 else 0
+            lines.append(f"Connection {connection}: {stats.received} events, won %.1f%%, behind by %.1fms average, %.1fms max"
+                         % (win_rate, average_delay * 1000, stats.max_delay * 1000))
+
+        return "\n" + "\n".join(lines)
+
+    @app_commands.command(description="Show how well Everblaze is keeping up with NationStates events.")
+    async def ssestatus(self, interaction: discord.Interaction):
+        await interaction.response.send_message(self.format_stats(), ephemeral=True)
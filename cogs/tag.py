@@ -180,9 +180,31 @@ class TagManager(commands.Cog):
                         return
                     
                     run.jump_point = jump_point
-                    run.jp_index = jp_data["update_index"]
+                    run.jp_index = jp_data.update_index
                     await message.channel.send(f"Jump point set to {jump_point}")
 
+    # Look up the update index of every tag run's jump point again, after the region database has been replaced.
+    # Jump points that no longer exist are unset, and their channel is told to set a new one.
+    async def reindex_jump_points(self) -> None:
+        database: Database = self.bot.get_cog('Database')
+
+        coroutines = []
+        for run in self.runs.values():
+            if run.jump_point == "":
+                continue
+
+            jp_data = database.fetch_region_data(run.jump_point)
+            if jp_data is not None:
+                run.jp_index = jp_data.update_index
+                continue
+
+            channel = self.bot.get_channel(run.channel_id)
+            coroutines.append(channel.send(f"Jump point {run.jump_point} no longer exists! Set a new one before launching."))
+            run.jump_point = ""
+            run.jp_index = 0
+
+        await asyncio.gather(*coroutines)
+
     # Look for a target, register it in Everblaze's trigger framework, and post it.
     # Called either when the LAUNCH command is given or the tracked nation reaches the endo requirement.
     async def select_target(self, run: TagRun) -> None:
@@ -212,7 +234,8 @@ class TagManager(commands.Cog):
             # Yeah just pretend as if update had just started. For testing outside of update's sake.
             last_update = LastUpdate(0, time.time(), 0, 0)
         
-        raidable_regions = util.find_raidable_regions(cursor, run.point_endos, last_update.index)
+        # Regions past the jump point are never picked, so don't even read them.
+        raidable_regions = util.find_raidable_regions(cursor, run.point_endos, last_update.index, region_filter=blacklist.get_region_filter(guild, run.whitelist), end=run.jp_index)
 
         last_update_time = 0
         if minor:
@@ -224,21 +247,14 @@ class TagManager(commands.Cog):
         target_minimum_update_time = math.ceil(last_update_time + time_since_last_update + run.delay_time)
 
         for region in raidable_regions:
-            if(region["update_index"] <= last_update.index):
+            if(region.update_index <= last_update.index):
                 continue
 
-            if(region["update_index"] > run.jp_index):
-                await channel.send(f"No more regions found before jump point! Stopped watching nations.")
-                run.tracked_nation = None
-                run.point = None
-                run.target = None
-                break
-
             update_time: int = 0
             if minor:
-                update_time = region["seconds_minor"]
+                update_time = region.seconds_minor
             else:
-                update_time = region["seconds_major"]
+                update_time = region.seconds_major
 
             if update_time < target_minimum_update_time:
                 continue
@@ -246,34 +262,27 @@ class TagManager(commands.Cog):
             if update_time < run.trigger_time:
                 continue
 
-            if run.whitelist:
-                if not blacklist.check_whitelist(guild, region):
-                    continue
-            else:
-                if blacklist.check_blacklist(guild, region):
-                    continue
-
-            target = region["api_name"]
+            target = region.api_name
 
             if not target_lock.lock(run.guild_id, compose_trigger("", target=target)):
                 continue
 
-            trigger = util.find_region_updating_at_time(cursor, update_time - run.trigger_time, minor, 0.8, 0.4)
+            trigger = util.find_region_updating_at_time(cursor, update_time - run.trigger_time, minor, 0.8, 0.4, database.timing_index)
             if trigger is None:
                 target_lock.unlock(run.guild_id, compose_trigger("", target=target))
                 continue
 
             delay = 0
             if minor:
-                delay = region["seconds_minor"] - trigger["seconds_minor"]
+                delay = region.seconds_minor - trigger.seconds_minor
             else:
-                delay = region["seconds_major"] - trigger["seconds_major"]
+                delay = region.seconds_major - trigger.seconds_major
 
             time_to_region = update_time - (last_update_time + time_since_last_update)
 
             targets = triggers.get_trigger_list_from_id(run.channel_id)
 
-            targets.add_trigger(compose_trigger(trigger["api_name"], target=target, delay=delay, message="GO!"))
+            targets.add_trigger(compose_trigger(trigger.api_name, target=target, delay=delay, message="GO!"))
             targets.sort_triggers(cursor)
 
             run.target = target
@@ -286,14 +295,14 @@ class TagManager(commands.Cog):
                 embed = discord.Embed()
                 text = "%" * 400
                 embed.description = f"[{text}](https://{domain_prefix}.nationstates.net/region={target}/template-overall=none?generated_by=everblaze_discord_bot__by_merethin__ran_by_{self.nation})"
-                embed.set_author(name=f"Target: {target}, delay: %.2fs, trigger: %.2fs - {region["update_index"]}/{update_listener.region_count}" % (time_to_region, delay))
+                embed.set_author(name=f"Target: {target}, delay: %.2fs, trigger: %.2fs - {region.update_index}/{update_listener.region_count}" % (time_to_region, delay))
                 await channel.send(embed=embed)
             except Exception:
                 await channel.send(f"An error occurred, please try again.")
                 break
             break
         else:
-            await channel.send(f"No more regions found, update is over! Stopped watching nations.")
+            await channel.send(f"No more regions found before jump point! Stopped watching nations.")
             run.tracked_nation = None
             run.point = None
             run.target = None
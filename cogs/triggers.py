@@ -1,7 +1,7 @@
 from discord.ext import commands
 from discord import app_commands
 import utility as util
-import discord, typing
+import discord, typing, heapq
 from .guilds import GuildManager
 from .db import Database
 from .lock import TargetLock
@@ -35,14 +35,23 @@ def format_time(timestamp: float) -> str:
     return "{:02d}:{:02d}:{:02d}.{:02d}".format(hours, minutes, seconds, int(fractional*100))
 
 # Manage per-channel triggers, add them, remove them, react to them.
+# Channels with triggers are tracked in two indexes, kept up to date as trigger lists change, so that a region update only has to look at
+# the channels it concerns rather than every channel with triggers:
+#   - subscriptions maps the api_name of every trigger to the channels that have it.
+#   - next_triggers is a min-heap of (update_index, channel_id) for every trigger in update order. Entries for triggers that have since been
+#     removed are left in place, and skipped once they reach the top of the heap.
 class TriggerManager(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.trigger_map: dict[int, util.TriggerList] = {}
+        self.subscriptions: dict[str, set[int]] = {}
+        self.next_triggers: list[tuple[int, int]] = []
     
     def get_trigger_list_from_id(self, channel_id: int):
         if channel_id not in self.trigger_map.keys():
-            self.trigger_map[channel_id] = util.TriggerList()
+            targets = util.TriggerList()
+            targets.add_listener(lambda change, trigger: self.on_trigger_change(channel_id, targets, change, trigger))
+            self.trigger_map[channel_id] = targets
 
         return self.trigger_map[channel_id]
     
@@ -51,7 +60,69 @@ class TriggerManager(commands.Cog):
     
     def remove_channel(self, channel_id: int):
         if channel_id in self.trigger_map.keys():
+            for trigger in self.trigger_map[channel_id].triggers:
+                self.unsubscribe(channel_id, trigger["api_name"])
             del self.trigger_map[channel_id]
+
+    # Remove every trigger from every channel.
+    def clear_triggers(self) -> None:
+        self.trigger_map = {}
+        self.subscriptions = {}
+        self.next_triggers = []
+
+    # Keep subscriptions and next_triggers in sync with a channel's trigger list.
+    # Lists dropped by clear_triggers() or remove_channel() may still be held (and changed) elsewhere, such as by a command waiting for
+    # confirmation, and must not add their channel back to the indexes.
+    def on_trigger_change(self, channel_id: int, targets: util.TriggerList, change: str, trigger: typing.Dict) -> None:
+        if self.trigger_map.get(channel_id) is not targets:
+            return
+
+        if change == "add":
+            self.subscriptions.setdefault(trigger["api_name"], set()).add(channel_id)
+        elif change == "order":
+            heapq.heappush(self.next_triggers, (trigger["update_index"], channel_id))
+        elif change == "remove":
+            self.unsubscribe(channel_id, trigger["api_name"])
+
+    def unsubscribe(self, channel_id: int, api_name: str) -> None:
+        channels = self.subscriptions.get(api_name)
+        if channels is not None:
+            channels.discard(channel_id)
+            if len(channels) == 0:
+                del self.subscriptions[api_name]
+
+    # Returns the IDs of the channels affected by a region update: those with a trigger on the region, or with triggers that should have
+    # updated before it. Every other channel can safely ignore the update.
+    def find_affected_channels(self, api_name: str, update_index: int) -> typing.List[int]:
+        channels = dict.fromkeys(self.subscriptions.get(api_name, ()))
+
+        while len(self.next_triggers) != 0 and self.next_triggers[0][0] < update_index:
+            (trigger_index, channel_id) = heapq.heappop(self.next_triggers)
+            # Skip entries for triggers that have been removed since. The channel's actual next trigger has an entry of its own.
+            targets = self.trigger_map.get(channel_id)
+            if targets is not None and targets.next_update_index() == trigger_index:
+                channels[channel_id] = None
+
+        return list(channels)
+
+    # Recompute the update index of every trigger after the region database has been regenerated.
+    # Triggers whose region no longer exists are dropped, and their targets unlocked.
+    def reindex_triggers(self) -> None:
+        guilds: GuildManager = self.bot.get_cog('GuildManager')
+        target_lock: TargetLock = self.bot.get_cog('TargetLock')
+        database: Database = self.bot.get_cog('Database')
+        cursor = database.everblaze_db.cursor()
+
+        for (channel_id, targets) in self.trigger_map.items():
+            removed = targets.reindex_triggers(cursor)
+            if len(removed) == 0:
+                continue
+
+            print(f"[everblaze] dropped {len(removed)} triggers for regions that no longer exist in channel {channel_id}")
+            if channel_id in guilds.channels.keys():
+                target_lock.unlocklist(guilds.channels[channel_id].guild_id, removed)
+
+        cursor.close()
     
     # Format a string with trigger data, including the link, triggers and predicted update times.
     def display_trigger(self, trigger: typing.Dict) -> str:
@@ -69,9 +140,9 @@ class TriggerManager(commands.Cog):
             message_shown = f" - message: \"{trigger["message"]}\""
 
         if "target" not in trigger.keys():
-            return f"[{trigger["api_name"]}](https://www.nationstates.net/region={trigger["api_name"]}) - {format_time(data["seconds_minor"])} minor, {format_time(data["seconds_major"])} major{message_shown}"
+            return f"[{trigger["api_name"]}](https://www.nationstates.net/region={trigger["api_name"]}) - {format_time(data.seconds_minor)} minor, {format_time(data.seconds_major)} major{message_shown}"
         
-        return f"[{trigger["target"]}](https://www.nationstates.net/region={trigger["target"]}) ({data["canon_name"]};%.2fs) - {format_time(data["seconds_minor"])} minor, {format_time(data["seconds_major"])} major{message_shown}" % trigger["delay"]
+        return f"[{trigger["target"]}](https://www.nationstates.net/region={trigger["target"]}) ({data.canon_name};%.2fs) - {format_time(data.seconds_minor)} minor, {format_time(data.seconds_major)} major{message_shown}" % trigger["delay"]
     
     # Format a string with a link to a trigger.
     def display_trigger_simple(self, trigger: typing.Dict) -> str:
@@ -128,7 +199,7 @@ class TriggerManager(commands.Cog):
         target_lock: TargetLock = self.bot.get_cog('TargetLock')
         target_lock.unlocklist(interaction.guild.id, triggers)
 
-        del self.trigger_map[interaction.channel.id]
+        self.remove_channel(interaction.channel.id)
 
         await interaction.response.send_message(f"Successfully reset all triggers in this channel.", ephemeral=guilds.should_be_ephemeral(interaction))
 
@@ -158,16 +229,16 @@ class TriggerManager(commands.Cog):
         if not await guilds.check_channel_setup_role(interaction):
             return
         
-        targets = self.get_trigger_list(interaction)
+        # A new list, so it stays the same even if the trigger list is modified while the user is scrolling.
+        local_targets = self.get_trigger_list(interaction).triggers
 
-        if(len(targets.triggers) == 0):
+        if(len(local_targets) == 0):
             await interaction.response.send_message(f"No triggers set!", ephemeral=guilds.should_be_ephemeral(interaction))
             return
 
         ELEMENTS_PER_PAGE = 10
 
-        if(len(targets.triggers) > ELEMENTS_PER_PAGE):
-            local_targets = targets.triggers[:] # Local copy in case the original one is modified while the user is scrolling
+        if(len(local_targets) > ELEMENTS_PER_PAGE):
 
             async def get_page(page: int):
                 emb = discord.Embed(title="Trigger List", description="")
@@ -181,7 +252,7 @@ class TriggerManager(commands.Cog):
             await Pagination(interaction, get_page).navigate()
             return
 
-        list = "\n".join([self.display_trigger(t) for t in targets.triggers])
+        list = "\n".join([self.display_trigger(t) for t in local_targets])
         await interaction.response.send_message(list, ephemeral=guilds.should_be_ephemeral(interaction))
 
     @app_commands.command(description="Display the next region to update in the trigger list.")
@@ -191,13 +262,13 @@ class TriggerManager(commands.Cog):
         if not await guilds.check_channel_setup_role(interaction):
             return
         
-        targets = self.get_trigger_list(interaction)
+        next_trigger = self.get_trigger_list(interaction).next_trigger()
 
-        if(len(targets.triggers) == 0):
+        if next_trigger is None:
             await interaction.response.send_message(f"No triggers set!", ephemeral=guilds.should_be_ephemeral(interaction))
             return
         
-        await interaction.response.send_message(f"Next {self.display_trigger_simple(targets.triggers[0])}", ephemeral=(guilds.should_be_ephemeral(interaction) and not visible))
+        await interaction.response.send_message(f"Next {self.display_trigger_simple(next_trigger)}", ephemeral=(guilds.should_be_ephemeral(interaction) and not visible))
 
     @app_commands.command(description="Skip the next region to update in the trigger list.")
     async def skip(self, interaction: discord.Interaction):
@@ -207,12 +278,12 @@ class TriggerManager(commands.Cog):
             return
         
         targets = self.get_trigger_list(interaction)
+        next_trigger = targets.next_trigger()
 
-        if(len(targets.triggers) == 0):
+        if next_trigger is None:
             await interaction.response.send_message(f"No triggers set!", ephemeral=guilds.should_be_ephemeral(interaction))
             return
         
-        name = targets.triggers[0]["api_name"]
-        trigger = targets.remove_trigger(name)
+        trigger = targets.remove_trigger(next_trigger["api_name"])
         
         await interaction.response.send_message(f"Removed {self.display_trigger_simple(trigger)}")
\ No newline at end of file
@@ -4,7 +4,7 @@ from .guilds import GuildManager
 from .db import Database
 from .triggers import TriggerManager
 from .lock import TargetLock
-import discord, typing, asyncio, sys
+import discord, typing, asyncio, sys, time
 import utility as util
 from dataclasses import dataclass
 
@@ -17,19 +17,53 @@ class LastUpdate:
     minor: float # The predicted timestamp at which the region would update during minor update.
     major: float # The predicted timestamp at which the region would update during major update.
 
+# Number of seconds without a region update after which update is considered to be over.
+UPDATE_IDLE_TIME = 300
+
+# Most triggers listed by name in a message about regions missed while Everblaze wasn't receiving events, to stay within Discord's message length.
+GAP_TRIGGER_LIST_LIMIT = 20
+
+# Regions that updated while Everblaze wasn't receiving events from NationStates, dispatched as an "sse_gap" event.
+class SSEGap(typing.NamedTuple):
+    first_missed: int # Update index of the first region missed.
+    last_missed: int # Update index of the last region missed.
+    seconds: float # How long no events were received for.
+
 # Listen for region updates, dispatch them to TriggerManager, keep track of the last registered region update, and trigger self-termination after update's over.
 class UpdateListener(commands.Cog):
     def __init__(self, bot: commands.Bot, exit_delay: typing.Optional[int]):
         self.bot = bot
         self.last_update: typing.Optional[LastUpdate] = None
 
+        self.reload_region_count()
+
+        self.exit_delay = exit_delay
+
+    # Count the regions in the region database again, after it has been regenerated.
+    def reload_region_count(self) -> None:
         database: Database = self.bot.get_cog('Database')
         cursor = database.everblaze_db.cursor()
 
         self.region_count = util.count_regions(cursor)
         cursor.close()
 
-        self.exit_delay = exit_delay
+    # Returns True if a region has updated in the last UPDATE_IDLE_TIME seconds, meaning update is probably still going on.
+    def is_updating(self) -> bool:
+        if self.last_update is None:
+            return False
+        return time.time() - self.last_update.real_time < UPDATE_IDLE_TIME
+
+    # Returns the predicted number of seconds between the last region update and the next one, or None if there is no next region.
+    # Update may be major or minor, so the longest of the two predictions is used.
+    def get_expected_update_gap(self) -> float | None:
+        if self.last_update is None or self.last_update.index + 1 >= self.region_count:
+            return None
+
+        database: Database = self.bot.get_cog('Database')
+        store = database.region_store
+        next_index = self.last_update.index + 1
+
+        return max(store.seconds_major[next_index] - self.last_update.major, store.seconds_minor[next_index] - self.last_update.minor)
 
     # Format a region update happening given a trigger that has just updated.
     def format_update_log(self, trigger: typing.Dict) -> str:
@@ -67,20 +101,27 @@ class UpdateListener(commands.Cog):
     async def on_region_update(self, event: typing.Tuple[str, int]):
         (region, timestamp) = event
         
+        # This runs for every region in update, so use the region cache rather than querying the database.
         database: Database = self.bot.get_cog('Database')
-        data = database.fetch_region_data(region)
+        region_data = database.region_cache.get(region)
 
-        if data is None:
+        if region_data is None:
             return None
-        
-        self.last_update = LastUpdate(data["update_index"], float(timestamp), data["seconds_minor"], data["seconds_major"])
+
+        update_index = region_data.update_index
+        self.last_update = LastUpdate(update_index, float(timestamp), region_data.seconds_minor, region_data.seconds_major)
         
         messages = []
 
         guilds: GuildManager = self.bot.get_cog('GuildManager')
         triggers: TriggerManager = self.bot.get_cog('TriggerManager')
         
-        for channel_id, targets in triggers.trigger_map.items():
+        # Only channels with a trigger on this region, or triggers that have already updated, have anything to do.
+        for channel_id in triggers.find_affected_channels(region, update_index):
+            targets = triggers.trigger_map.get(channel_id)
+            if targets is None:
+                continue
+
             channel = guilds.channels[channel_id]
             guild = self.bot.get_guild(channel.guild_id)
 
@@ -89,14 +130,44 @@ class UpdateListener(commands.Cog):
         coroutines = [channel.send(message) for (channel, message) in messages]
         await asyncio.gather(*coroutines)
 
-        if data["update_index"] == (self.region_count-1):
+        if update_index == (self.region_count-1):
             self.bot.dispatch("update_end")
 
+    # Let channels with triggers that updated while Everblaze wasn't receiving events know about it, and which triggers those were.
+    # The triggers themselves are still reported as already updated when the next region update is handled.
+    @commands.Cog.listener()
+    async def on_sse_gap(self, gap: SSEGap):
+        print(f"[everblaze] no events received for %.1fs, missed regions {gap.first_missed} to {gap.last_missed}" % gap.seconds)
+
+        guilds: GuildManager = self.bot.get_cog('GuildManager')
+        triggers: TriggerManager = self.bot.get_cog('TriggerManager')
+
+        coroutines = []
+        for channel_id, targets in triggers.trigger_map.items():
+            next_index = targets.next_update_index()
+            if next_index is None or next_index > gap.last_missed:
+                continue
+
+            missed = [trigger["api_name"] for trigger in targets.triggers if trigger.get("update_index", gap.last_missed + 1) <= gap.last_missed]
+            listed = ", ".join(missed[:GAP_TRIGGER_LIST_LIMIT])
+            if len(missed) > GAP_TRIGGER_LIST_LIMIT:
+                listed += f" and {len(missed) - GAP_TRIGGER_LIST_LIMIT} more"
+
+            guild = self.bot.get_guild(guilds.channels[channel_id].guild_id)
+            channel = guild.get_channel(channel_id)
+            coroutines.append(channel.send(f"Lost connection to NationStates for %.1fs during update, {gap.last_missed - gap.first_missed + 1} regions updated in the meantime! "
+                                           f"Triggers that have updated: {listed}" % gap.seconds))
+
+        await asyncio.gather(*coroutines)
+
     @commands.Cog.listener()
     async def on_update_end(self):
+        database: Database = self.bot.get_cog('Database')
+        print(f"[everblaze] update over, region cache: {database.region_cache.format_stats()}")
+
         # Wipe all triggers
         triggers: TriggerManager = self.bot.get_cog('TriggerManager')
-        triggers.trigger_map = {}
+        triggers.clear_triggers()
 
         if self.exit_delay is not None:
             print(f"[everblaze] starting exit timer... terminating in {self.exit_delay} seconds")
@@ -118,4 +189,4 @@ class UpdateListener(commands.Cog):
         region = util.fetch_region_data_with_index(cursor, self.last_update.index)
         cursor.close()
 
-        await interaction.response.send_message(f"Last update: {region["canon_name"]}")
\ No newline at end of file
+        await interaction.response.send_message(f"Last update: {region.canon_name}")
\ No newline at end of file
@@ -2,153 +2,778 @@
 # Authored by Merethin, licensed under the BSD-2-Clause license.
 
 import xml.etree.ElementTree as ET
-import time, calendar, sqlite3, typing, datetime, gzip, os, sans
+import time, calendar, sqlite3, typing, datetime, gzip, os, sans, itertools, zlib, contextlib, json, concurrent.futures, collections, re, shutil, email.utils, multiprocessing
 import utility as util
-
-# Fetch a list of all passworded regions from the NationStates API and return it as a list of API-compatible region names.
-def fetch_passworded_regions() -> typing.List[str]:
-    query = sans.World("regionsbytag", tags="password")
-    root = sans.get(query).xml
+import snapshot
+from dataclasses import dataclass
+
+# Size of the chunks the data dump is downloaded in.
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# zlib window size that makes zlib expect a gzip header and trailer, as used by the data dump.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Version of the region database layout, stored in the database file as PRAGMA user_version.
+# Bump this and add an entry to MIGRATIONS whenever the layout changes.
+SCHEMA_VERSION = 5
+
+# Columns of the main region table, holding everything needed to look up regions and find triggers and targets.
+# update_index is the primary key, so that lookups by update index go straight to the row.
+REGION_SCHEMA = """canon_name TEXT NOT NULL,
+    api_name TEXT NOT NULL,
+    update_index INTEGER PRIMARY KEY,
+    seconds_major REAL NOT NULL,
+    seconds_minor REAL NOT NULL,
+    delendos INTEGER NOT NULL,
+    executive INTEGER NOT NULL,
+    tags INTEGER NOT NULL"""
+
+# Columns of the region details table, holding bulky data that's only needed to apply blacklists and whitelists.
+# Keeping it out of the main table means lookups during update never have to read it.
+# The WFE is stored in lowercase, as it is only ever matched against lowercase blacklist/whitelist phrases.
+REGION_DETAIL_SCHEMA = """api_name TEXT PRIMARY KEY,
+    wfe TEXT NOT NULL"""
+
+# Columns of the embassy table, with one row for each embassy of each region.
+# status is the type of the embassy as given by the data dump ("pending", "invited", ...), or "established" if it has none.
+EMBASSY_SCHEMA = """region TEXT NOT NULL,
+    embassy TEXT NOT NULL,
+    status TEXT NOT NULL"""
+
+# Columns of the region tag table, which maps every tag fetched from NationStates to its bit in the tags column of the region table.
+REGION_TAG_SCHEMA = """tag TEXT PRIMARY KEY,
+    bit INTEGER NOT NULL"""
+
+# Region tags fetched from NationStates by default. A region's tags are stored as a bitmask, with bit N set if it has the Nth tag in the list.
+# password and governorless are needed to find raidable regions, so they always come first.
+DEFAULT_REGION_TAGS = ["password", "governorless", "founderless", "frontier", "stronghold", "fascist", "invader", "defender", "lgbt"]
+
+# Maximum number of tags a bitmask can hold, as SQLite integers are 64-bit signed.
+MAX_REGION_TAGS = 63
+
+# Tables making up the region database, mapped to their columns and the column holding the name of the region each row belongs to.
+REGION_TABLES: dict[str, tuple[str, str]] = {
+    "regions": (REGION_SCHEMA, "api_name"),
+    "region_details": (REGION_DETAIL_SCHEMA, "api_name"),
+    "embassies": (EMBASSY_SCHEMA, "region"),
+}
+
+# Columns of the region table read straight from the data dump and the tag lists. The other ones (update_index, seconds_major and
+# seconds_minor) are derived from every region before it, so they shift for nearly every region from one data dump to the next.
+REGION_SOURCE_COLUMNS = "canon_name, api_name, delendos, executive, tags"
+
+# Indexes on the region database tables, for lookups by name and by update time.
+REGION_INDEXES = [
+    "CREATE UNIQUE INDEX idx_regions_api_name ON regions(api_name)",
+    "CREATE INDEX idx_regions_seconds_major ON regions(seconds_major)",
+    "CREATE INDEX idx_regions_seconds_minor ON regions(seconds_minor)",
+    "CREATE INDEX idx_embassies_embassy ON embassies(embassy, region)",
+    "CREATE INDEX idx_embassies_region ON embassies(region)",
+]
+
+# Full-text index over the WFE of every region, used to match WFE blacklist/whitelist phrases without scanning every WFE.
+# The trigram tokenizer allows matching arbitrary substrings of at least three characters, and the rowid of each entry is the region's update index.
+# It is contentless, since the WFE itself is already stored in region_details.
+WFE_INDEX_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS wfe_index USING fts5(wfe, content='', tokenize='trigram')"
+
+# Size in bytes of the pieces of the decompressed data dump handed to each worker process by parse_region_data_parallel().
+PARALLEL_SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Default directory downloaded data dumps are cached in, and number of days they are kept for.
+DUMP_CACHE_DIRECTORY = "dumps"
+DUMP_CACHE_DAYS = 7
+
+# Name of the files holding cached data dumps, with the date of the dump as the first group.
+DUMP_CACHE_FILENAME = re.compile(r"regions-(\d{4}-\d{2}-\d{2})\.xml\.gz")
+
+# Number of regions inserted into the database at once while parsing the data dump.
+INSERT_BATCH_SIZE = 1000
+
+# Fetch a list of all regions with a given tag from the NationStates API and return it as a list of API-compatible region names.
+def fetch_regions_by_tag(tag: str) -> typing.List[str]:
+    query = sans.World("regionsbytag", tags=tag)
+    root = sans.get(util.ns_url(query)).xml
 
     regions = root.find("./REGIONS")
+    if regions.text is None:
+        return []
 
     return [util.format_nation_or_region(r) for r in regions.text.split(',')]
 
-# Fetch a list of all governorless regions from the NationStates API and return it as a list of API-compatible region names.
-def fetch_governorless_regions() -> typing.List[str]:
-    query = sans.World("regionsbytag", tags="governorless")
-    root = sans.get(query).xml
-
-    regions = root.find("./REGIONS")
+# Read a compressed data dump from disk, decompressing it on the fly. Yields chunks of decompressed XML.
+def read_dump_file(path: str) -> typing.Iterator[bytes]:
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+
+    with open(path, 'rb') as dump_file:
+        while chunk := dump_file.read(DOWNLOAD_CHUNK_SIZE):
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+
+    yield decompressor.flush()
+
+# Returns the date (as YYYY-MM-DD) a data dump was generated on, from the Last-Modified header it was served with.
+# Falls back to the current date (UTC) if the header is missing or invalid.
+def get_dump_date(last_modified: str | None) -> str:
+    if last_modified is not None:
+        try:
+            return email.utils.parsedate_to_datetime(last_modified).astimezone(datetime.timezone.utc).date().isoformat()
+        except (TypeError, ValueError):
+            pass
+
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+# Local cache of downloaded data dumps, holding one dump per day.
+# Each dump is stored as <directory>/regions-YYYY-MM-DD.xml.gz, next to a .json file holding the ETag and Last-Modified headers
+# it was served with (used to make conditional requests), and the region tags fetched alongside it (used to build the database offline).
+@dataclass
+class DumpCache:
+    directory: str = DUMP_CACHE_DIRECTORY
+    retention_days: int = DUMP_CACHE_DAYS # Dumps older than this many days before the newest one are deleted.
+
+    def dump_path(self, date: str) -> str:
+        return os.path.join(self.directory, f"regions-{date}.xml.gz")
+
+    def metadata_path(self, date: str) -> str:
+        return os.path.join(self.directory, f"regions-{date}.json")
+
+    # Returns the dates of all cached dumps, oldest first.
+    def get_dates(self) -> typing.List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+
+        dates = []
+        for filename in os.listdir(self.directory):
+            match = DUMP_CACHE_FILENAME.fullmatch(filename)
+            if match is not None:
+                dates.append(match.group(1))
+
+        return sorted(dates)
+
+    # Returns the date of the newest cached dump, or None if the cache is empty.
+    def get_latest_date(self) -> str | None:
+        dates = self.get_dates()
+        if len(dates) == 0:
+            return None
+        return dates[-1]
+
+    def load_metadata(self, date: str) -> typing.Dict:
+        try:
+            with open(self.metadata_path(date)) as metadata_file:
+                return json.load(metadata_file)
+        except FileNotFoundError:
+            return {}
+
+    def save_metadata(self, date: str, metadata: typing.Dict) -> None:
+        # Write to a temporary file first, so other processes never see a half-written file.
+        temporary_path = f"{self.metadata_path(date)}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(temporary_path, self.metadata_path(date))
+
+    # Delete every cached dump more than retention_days days older than the newest one.
+    def prune(self) -> None:
+        dates = self.get_dates()
+        if len(dates) == 0:
+            return
+
+        oldest = (datetime.date.fromisoformat(dates[-1]) - datetime.timedelta(days=self.retention_days - 1)).isoformat()
+        for date in dates:
+            if date >= oldest:
+                continue
+
+            print(f"[everblaze] deleting cached regional data dump from {date}")
+            for path in [self.dump_path(date), self.metadata_path(date)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+# The regional data dump to build the region database from, either downloaded from NationStates or read from the dump cache.
+class RegionDataDump:
+    # If offline is set, the newest cached dump is used (or the one from date, if provided) and nothing is downloaded.
+    # If keep_dump is set, the compressed data dump will also be copied to regions.xml.gz.
+    def __init__(self, cache: DumpCache, offline: bool = False, date: str | None = None, keep_dump: bool = False) -> None:
+        self.cache = cache
+        self.offline = offline or date is not None
+        self.date = date # Date of the dump being read, known once the first chunk has been read.
+        self.keep_dump = keep_dump
+
+        # Check for the cached dump right away, so a missing one is reported before anything else is done.
+        if self.offline:
+            if self.date is None:
+                self.date = self.cache.get_latest_date()
+
+            if self.date is None or not os.path.exists(self.cache.dump_path(self.date)):
+                raise FileNotFoundError(f"no cached regional data dump{f" from {self.date}" if self.date is not None else ""} in {self.cache.directory}")
+
+    # Yields chunks of the decompressed XML as they come in, so the dump can be parsed while it is still downloading.
+    def read_chunks(self) -> typing.Iterator[bytes]:
+        if self.offline:
+            yield from self.read_cached()
+        else:
+            yield from self.download()
+
+        if self.keep_dump:
+            shutil.copyfile(self.cache.dump_path(self.date), "regions.xml.gz")
+
+    def read_cached(self) -> typing.Iterator[bytes]:
+        print(f"[everblaze] parsing cached regional data dump from {self.date}")
+        yield from read_dump_file(self.cache.dump_path(self.date))
+
+    # Download the latest dump from NationStates into the cache, unless the newest cached one is still up to date.
+    def download(self) -> typing.Iterator[bytes]:
+        latest = self.cache.get_latest_date()
+
+        headers = {}
+        if latest is not None:
+            metadata = self.cache.load_metadata(latest)
+            if "etag" in metadata:
+                headers["If-None-Match"] = metadata["etag"]
+            if "last_modified" in metadata:
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        print("[everblaze] downloading and parsing latest regional data dump")
+
+        with sans.stream("GET", util.ns_url(sans.RegionsDump()), headers=headers) as r:
+            if r.status_code == 304:
+                print(f"[everblaze] regional data dump unchanged since {latest}, using cached copy")
+                self.date = latest
+                yield from read_dump_file(self.cache.dump_path(latest))
+                return
+
+            r.raise_for_status()
+            self.date = get_dump_date(r.headers.get("Last-Modified"))
+
+            # Download to a temporary file first, so other processes never see a half-downloaded dump.
+            os.makedirs(self.cache.directory, exist_ok=True)
+            path = self.cache.dump_path(self.date)
+            temporary_path = f"{path}.{os.getpid()}.part"
+
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+            with open(temporary_path, 'wb') as dump_file:
+                for chunk in r.iter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    dump_file.write(chunk)
+
+                    data = decompressor.decompress(chunk)
+                    if data:
+                        yield data
+
+            yield decompressor.flush()
+            os.replace(temporary_path, path)
+
+            metadata = self.cache.load_metadata(self.date)
+            metadata["etag"] = r.headers.get("ETag")
+            metadata["last_modified"] = r.headers.get("Last-Modified")
+            self.cache.save_metadata(self.date, {key: value for (key, value) in metadata.items() if value is not None})
+
+        self.cache.prune()
+
+# Parse an XML document incrementally from a stream of chunks, yielding (event, element) pairs as soon as they are available.
+def iter_xml_events(chunks: typing.Iterable[bytes]) -> typing.Iterator[tuple[str, ET.Element]]:
+    parser = ET.XMLPullParser(events=("start", "end"))
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.read_events()
+
+    parser.close()
+    yield from parser.read_events()
+
+# Running totals collected while streaming through the data dump.
+# Update times can only be computed once every region has been seen, so they are backfilled from these afterwards.
+@dataclass
+class DumpSummary:
+    region_count: int = 0 # Number of regions seen so far.
+    numnations: int = 0 # Total number of nations seen so far.
+    major_start: int = 0 # LASTMAJORUPDATE of the first region.
+    major_end: int = 0 # LASTMAJORUPDATE of the last region seen so far.
+    minor_start: int = 0 # LASTMINORUPDATE of the first region.
+    minor_end: int = 0 # LASTMINORUPDATE of the last region seen so far.
+
+    # Register a region's update timestamps. Regions must be registered in update order.
+    def add_region(self, last_major: int, last_minor: int, numnations: int) -> None:
+        if self.region_count == 0:
+            self.major_start = last_major
+            self.minor_start = last_minor
+
+        self.major_end = last_major
+        self.minor_end = last_minor
+        self.numnations += numnations
+        self.region_count += 1
+
+    def get_last_major_data(self) -> tuple[int, int]:
+        return (self.major_start, self.major_end - self.major_start)
+
+    def get_last_minor_data(self) -> tuple[int, int]:
+        return (self.minor_start, self.minor_end - self.minor_start)
 
-    return [util.format_nation_or_region(r) for r in regions.text.split(',')]
-
-# Download the daily regional data dump from NationStates and decompress it.
-def download_region_data_dump() -> None:
-    print("[everblaze] downloading latest regional data dump")
+def format_timestamp(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%A %b %d, %H:%M")
 
-    with sans.stream("GET", sans.RegionsDump()) as r:
-        r.raise_for_status()
-        with open("regions.xml.gz", 'wb') as f:
-            for chunk in r.iter_bytes(chunk_size=8192):
-                f.write(chunk)
+# Extract the data of a single region from its element in the regions.xml data dump.
+# Returns (canon_name, api_name, delendos, executive, wfe, embassies, last_major, last_minor, numnations),
+# where embassies is a list of (embassy, status) pairs.
+def parse_region_element(region: ET.Element) -> typing.Tuple:
+    # Core information
+    canon_name = region.find("NAME").text
+    api_name = util.format_nation_or_region(canon_name)
+    delendos = int(region.find("DELEGATEVOTES").text) - 1 # Delegate Votes = Delegate Endos + 1
+    executive = int("X" in region.find("DELEGATEAUTH").text) # 1 for Executive, 0 for Non-Executive
+    wfe = region.find("FACTBOOK").text
+    if wfe is None:
+        wfe = ""
+    wfe = wfe.lower()
+
+    # Oh boy
+    embassies = []
+    for child in region.find("EMBASSIES"):
+        status = "established"
+        if("type" in child.attrib.keys()):
+            if(child.attrib["type"] in ["denied", "rejected", "closing"]):
+                # Skipping unwanted/closed embassy
+                continue
+            if(child.attrib["type"] in ["requested", "pending", "invited"]):
+                pass # Add it nonetheless. We don't want to retag regions we've already tagged even if the embassy is pending.
+            status = child.attrib["type"]
+
+        embassies.append((util.format_nation_or_region(child.text), status))
+
+    return (canon_name, api_name, delendos, executive, wfe, embassies,
+            int(region.find("LASTMAJORUPDATE").text), int(region.find("LASTMINORUPDATE").text), int(region.find("NUMNATIONS").text))
+
+# Turn regions parsed by parse_region_element(), in update order, into the tuples yielded by parse_region_data().
+def number_regions(regions: typing.Iterable[typing.Tuple], summary: DumpSummary) -> typing.Iterator[typing.Tuple]:
+    for (canon_name, api_name, delendos, executive, wfe, embassies, last_major, last_minor, numnations) in regions:
+        update_index = summary.region_count
 
-    print("[everblaze] decompressing latest regional data dump")
+        # Apparently last update isn't accurate enough. Calculate update times based on average update time per nation.
+        # We don't know the total number of nations yet, so store the cumulative nation count for now and backfill the times later.
+        cumulative_nations = summary.numnations
+        summary.add_region(last_major, last_minor, numnations)
 
-    with gzip.open("regions.xml.gz", 'rb') as f:
-        file_content = f.read()
-        with open("regions.xml", 'wb') as output:
-            output.write(file_content)
-    
-    os.remove("regions.xml.gz")
+        # Tags are fetched separately and filled in afterwards by apply_region_tags().
+        tags = 0
 
-def get_last_major_data(regions: list[ET.Element]) -> tuple[int, int]:
-    first_region = regions[0]
-    major_start = int(first_region.find("LASTMAJORUPDATE").text)
+        # Join it all together
+        yield (canon_name, api_name, update_index, cumulative_nations, cumulative_nations, delendos, executive, tags, wfe, embassies)
+
+# Parse every region element in a stream of decompressed data dump chunks, discarding each one once it has been read.
+def iter_region_elements(chunks: typing.Iterable[bytes]) -> typing.Iterator[typing.Tuple]:
+    context = iter_xml_events(chunks)
+    (_, root) = next(context)
+
+    for (event, region) in context:
+        if event != "end" or region.tag != "REGION":
+            continue
+
+        data = parse_region_element(region)
+
+        # We're done with this region, drop it (and everything before it) from the tree.
+        root.clear()
+
+        yield data
+
+# Extract region data from the regions.xml data dump, one region at a time.
+# The dump is read from a stream of decompressed chunks (as yielded by RegionDataDump.read_chunks()) and parsed incrementally.
+# Every region element is discarded once it has been read, so memory usage stays flat regardless of the size of the dump.
+# seconds_major and seconds_minor are yielded as the cumulative number of nations before the region,
+# and must be converted to update times with backfill_update_times() once the generator has been exhausted.
+# The last element of each tuple is a list of (embassy, status) pairs.
+def parse_region_data(chunks: typing.Iterable[bytes], summary: DumpSummary) -> typing.Iterator[typing.Tuple]:
+    yield from number_regions(iter_region_elements(chunks), summary)
+
+# Split a stream of decompressed data dump chunks into standalone XML documents of at least segment_size bytes
+# (except for the last one), each holding a run of consecutive regions. Documents are cut right before a <REGION> tag,
+# which can't appear anywhere else in the dump since text content is escaped.
+def split_region_data(chunks: typing.Iterable[bytes], segment_size: int) -> typing.Iterator[bytes]:
+    buffer = bytearray()
+    started = False
+
+    for chunk in chunks:
+        buffer += chunk
+
+        # Drop the XML declaration and the opening <REGIONS> tag.
+        if not started:
+            start = buffer.find(b"<REGION>")
+            if start == -1:
+                continue
+            del buffer[:start]
+            started = True
+
+        if len(buffer) >= segment_size:
+            cut = buffer.rfind(b"<REGION>")
+            if cut > 0:
+                yield b"<REGIONS>" + buffer[:cut] + b"</REGIONS>"
+                del buffer[:cut]
+
+    if not started:
+        return
+
+    # Drop the closing </REGIONS> tag.
+    end = buffer.rfind(b"</REGIONS>")
+    if end != -1:
+        del buffer[end:]
+
+    yield b"<REGIONS>" + buffer + b"</REGIONS>"
+
+# Parse every region in a document produced by split_region_data(). Runs in a worker process.
+def parse_region_segment(segment: bytes) -> typing.List[typing.Tuple]:
+    return [parse_region_element(region) for region in ET.fromstring(segment).iter("REGION")]
+
+# Same as parse_region_data(), but the dump is split into segments which are parsed by a pool of worker processes.
+# Segments are handed back in the order they appear in the dump, so regions are still yielded in update order.
+# At most two segments per worker are in flight at once, so memory usage stays bounded.
+# Workers are started from a fork server rather than forked from this process, which may be the bot, running other threads (such as the event
+# loop) whose locks a forked child could inherit while they're held.
+def parse_region_data_parallel(chunks: typing.Iterable[bytes], summary: DumpSummary, workers: int) -> typing.Iterator[typing.Tuple]:
+    def parse_segments() -> typing.Iterator[typing.Tuple]:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as executor:
+            pending: collections.deque[concurrent.futures.Future] = collections.deque()
+
+            for segment in split_region_data(chunks, PARALLEL_SEGMENT_SIZE):
+                pending.append(executor.submit(parse_region_segment, segment))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+
+            while len(pending) > 0:
+                yield from pending.popleft().result()
+
+    yield from number_regions(parse_segments(), summary)
+
+# Convert the cumulative nation counts stored by parse_region_data() into update times, now that the total number of nations is known.
+def backfill_update_times(cursor: sqlite3.Cursor, table: str, summary: DumpSummary) -> None:
+    (major_start, major_length) = summary.get_last_major_data()
+    (minor_start, minor_length) = summary.get_last_minor_data()
 
-    last_region = regions[-1]
-    major_end = int(last_region.find("LASTMAJORUPDATE").text)
+    print(f"[everblaze] last major: {format_timestamp(major_start)}, {major_length} seconds long")
+    print(f"[everblaze] last minor: {format_timestamp(minor_start)}, {minor_length} seconds long")
 
-    return (major_start, major_end - major_start)
+    numnations = summary.numnations
+    major_secs_per_nation = major_length / numnations
+    minor_secs_per_nation = minor_length / numnations
 
-def get_last_minor_data(regions: list[ET.Element]) -> tuple[int, int]:
-    first_region = regions[0]
-    minor_start = int(first_region.find("LASTMINORUPDATE").text)
+    print(f"[everblaze] {numnations} total nations, {major_secs_per_nation} seconds per nation (major), {minor_secs_per_nation} seconds per nation (minor)")
 
-    last_region = regions[-1]
-    minor_end = int(last_region.find("LASTMINORUPDATE").text)
+    cursor.execute(f"UPDATE {table} SET seconds_major = seconds_major * ?, seconds_minor = seconds_minor * ?", [major_secs_per_nation, minor_secs_per_nation])
+
+# Create empty tables with the region database layout. Their names will be the ones in REGION_TABLES (and region_tags), followed by suffix.
+# If temporary is set, the tables will only exist for as long as the current connection does.
+def create_region_tables(cursor: sqlite3.Cursor, suffix: str = "", temporary: bool = False) -> None:
+    for (table, (schema, _)) in REGION_TABLES.items():
+        cursor.execute(f"CREATE {"TEMP " if temporary else ""}TABLE {table}{suffix}({schema})")
+    cursor.execute(f"CREATE {"TEMP " if temporary else ""}TABLE region_tags{suffix}({REGION_TAG_SCHEMA})")
+
+# Create the indexes on the region tables. It's faster to do this after the tables have been filled.
+def create_region_indexes(cursor: sqlite3.Cursor) -> None:
+    for index in REGION_INDEXES:
+        cursor.execute(index)
+
+# (Re)build the WFE full-text index from the region tables. Has to be called whenever the region tables change.
+def build_wfe_index(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(WFE_INDEX_SCHEMA)
+    cursor.execute("INSERT INTO wfe_index(wfe_index) VALUES('delete-all')")
+    cursor.execute("INSERT INTO wfe_index(rowid, wfe) SELECT regions.update_index, region_details.wfe FROM regions JOIN region_details USING(api_name)")
+
+# Schema version 0 -> 1: add column types, make update_index the primary key and index the lookup columns.
+def migrate_to_typed_schema(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("ALTER TABLE regions RENAME TO regions_untyped")
+    cursor.execute("""CREATE TABLE regions(canon_name TEXT NOT NULL, api_name TEXT NOT NULL, update_index INTEGER PRIMARY KEY,
+                   seconds_major REAL NOT NULL, seconds_minor REAL NOT NULL, delendos INTEGER NOT NULL, executive INTEGER NOT NULL,
+                   password INTEGER NOT NULL, governorless INTEGER NOT NULL, wfe TEXT NOT NULL, embassies TEXT NOT NULL)""")
+    cursor.execute("INSERT INTO regions SELECT * FROM regions_untyped")
+    cursor.execute("DROP TABLE regions_untyped")
+    cursor.execute("CREATE UNIQUE INDEX idx_regions_api_name ON regions(api_name)")
+    cursor.execute("CREATE INDEX idx_regions_seconds_major ON regions(seconds_major)")
+    cursor.execute("CREATE INDEX idx_regions_seconds_minor ON regions(seconds_minor)")
+
+# Schema version 1 -> 2: move the WFE and embassies out of the main region table into region_details.
+def migrate_to_split_schema(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("ALTER TABLE regions RENAME TO regions_combined")
+    cursor.execute("""CREATE TABLE regions(canon_name TEXT NOT NULL, api_name TEXT NOT NULL, update_index INTEGER PRIMARY KEY,
+                   seconds_major REAL NOT NULL, seconds_minor REAL NOT NULL, delendos INTEGER NOT NULL, executive INTEGER NOT NULL,
+                   password INTEGER NOT NULL, governorless INTEGER NOT NULL)""")
+    cursor.execute("CREATE TABLE region_details(api_name TEXT PRIMARY KEY, wfe TEXT NOT NULL, embassies TEXT NOT NULL)")
+    cursor.execute("""INSERT INTO regions SELECT canon_name, api_name, update_index, seconds_major, seconds_minor,
+                   delendos, executive, password, governorless FROM regions_combined""")
+    cursor.execute("INSERT INTO region_details SELECT api_name, wfe, embassies FROM regions_combined")
+    cursor.execute("DROP TABLE regions_combined")
+    cursor.execute("CREATE UNIQUE INDEX idx_regions_api_name ON regions(api_name)")
+    cursor.execute("CREATE INDEX idx_regions_seconds_major ON regions(seconds_major)")
+    cursor.execute("CREATE INDEX idx_regions_seconds_minor ON regions(seconds_minor)")
+
+# Schema version 2 -> 3: move the embassies into their own table with one row per embassy, and store the WFE in lowercase.
+def migrate_to_embassy_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("CREATE TABLE embassies(region TEXT NOT NULL, embassy TEXT NOT NULL, status TEXT NOT NULL)")
+
+    # The previous layout didn't record the status of embassies.
+    rows = cursor.execute("SELECT api_name, embassies FROM region_details").fetchall()
+    for (region, embassies) in rows:
+        cursor.executemany("INSERT INTO embassies VALUES(?, ?, 'unknown')", [(region, embassy) for embassy in embassies.split(",") if embassy != ""])
+
+    rows = cursor.execute("SELECT api_name, wfe FROM region_details").fetchall()
+    cursor.executemany("UPDATE region_details SET wfe = ? WHERE api_name = ?", [(wfe.lower(), region) for (region, wfe) in rows])
+
+    cursor.execute("ALTER TABLE region_details DROP COLUMN embassies")
+    cursor.execute("CREATE INDEX idx_embassies_embassy ON embassies(embassy, region)")
+    cursor.execute("CREATE INDEX idx_embassies_region ON embassies(region)")
+
+# Schema version 3 -> 4: add the WFE full-text index.
+def migrate_to_wfe_index(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("CREATE VIRTUAL TABLE wfe_index USING fts5(wfe, content='', tokenize='trigram')")
+    cursor.execute("INSERT INTO wfe_index(rowid, wfe) SELECT regions.update_index, region_details.wfe FROM regions JOIN region_details USING(api_name)")
+
+# Schema version 4 -> 5: replace the password and governorless columns with a bitmask of region tags.
+# Only those two tags were fetched before, so they become bits 0 and 1; other tags are picked up on the next refresh.
+def migrate_to_tag_bitmask(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("ALTER TABLE regions ADD COLUMN tags INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE regions SET tags = password | (governorless << 1)")
+    cursor.execute("ALTER TABLE regions DROP COLUMN password")
+    cursor.execute("ALTER TABLE regions DROP COLUMN governorless")
+    cursor.execute("CREATE TABLE region_tags(tag TEXT PRIMARY KEY, bit INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO region_tags VALUES('password', 0), ('governorless', 1)")
+
+# Migrations to apply to bring a database up to date, indexed by the schema version they upgrade from.
+# Each migration spells out the layout it migrates to, since the constants above always describe the latest one.
+MIGRATIONS: dict[int, typing.Callable[[sqlite3.Cursor], None]] = {
+    0: migrate_to_typed_schema,
+    1: migrate_to_split_schema,
+    2: migrate_to_embassy_table,
+    3: migrate_to_wfe_index,
+    4: migrate_to_tag_bitmask,
+}
+
+# Returns the layout version of a region database.
+def get_schema_version(cursor: sqlite3.Cursor) -> int:
+    cursor.execute("PRAGMA user_version")
+    return int(cursor.fetchone()[0])
+
+def set_schema_version(cursor: sqlite3.Cursor, version: int) -> None:
+    cursor.execute(f"PRAGMA user_version = {int(version)}")
+
+# Bring an existing region database up to the current layout, if it was generated by an older version of Everblaze.
+def migrate_database(con: sqlite3.Connection) -> None:
+    cursor = con.cursor()
 
-    return (minor_start, minor_end - minor_start)
+    version = get_schema_version(cursor)
+    while version < SCHEMA_VERSION:
+        print(f"[everblaze] migrating regional database from version {version} to {version + 1}")
+
+        # Explicit transaction, as sqlite3 won't open one by itself for schema changes.
+        cursor.execute("BEGIN")
+        try:
+            MIGRATIONS[version](cursor)
+            set_schema_version(cursor, version + 1)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+        version += 1
+
+    cursor.close()
+
+# Insert a batch of regions, as yielded by parse_region_data(), into the region tables.
+def insert_region_data(cursor: sqlite3.Cursor, suffix: str, batch: list[tuple]) -> None:
+    cursor.executemany(f"INSERT INTO regions{suffix} VALUES(?, ?, ?, ?, ?, ?, ?, ?)", [region[:8] for region in batch])
+    cursor.executemany(f"INSERT INTO region_details{suffix} VALUES(?, ?)", [(region[1], region[8]) for region in batch])
+    cursor.executemany(f"INSERT INTO embassies{suffix} VALUES(?, ?, ?)", [(region[1], embassy, status) for region in batch for (embassy, status) in region[9]])
+
+# Returns the list of region tags to fetch: the default ones, followed by any extra ones that aren't already in there.
+def get_region_tags(extra_tags: typing.List[str]) -> typing.List[str]:
+    tags = list(DEFAULT_REGION_TAGS)
+    for tag in extra_tags:
+        tag = tag.strip().lower()
+        if tag != "" and tag not in tags:
+            tags.append(tag)
+    return tags
+
+# Set the tag bits of every region in the region table from the lists fetched with fetch_regions_by_tag(), and record which bit each tag uses.
+# tagged_regions maps each tag to the regions that have it, in the same order as the tags list the bits were assigned from.
+def apply_region_tags(cursor: sqlite3.Cursor, suffix: str, tagged_regions: dict[str, typing.List[str]]) -> None:
+    cursor.execute(f"DELETE FROM region_tags{suffix}")
+
+    for (bit, (tag, regions)) in enumerate(tagged_regions.items()):
+        cursor.execute(f"INSERT INTO region_tags{suffix} VALUES(?, ?)", [tag, bit])
+        cursor.execute(f"UPDATE regions{suffix} SET tags = tags | ? WHERE api_name IN (SELECT value FROM json_each(?))", [1 << bit, json.dumps(regions)])
+
+# Read a regional data dump and fill empty region tables (as created by create_region_tables()) with it.
+# The given region tags are fetched from NationStates at the same time as the data dump is downloaded, and saved in the dump cache.
+# If the dump is read offline, the tags saved in the dump cache are used instead. Tags that weren't saved are left out.
+# If workers is more than 1, the data dump is parsed by that many worker processes with parse_region_data_parallel().
+def populate_region_tables(cursor: sqlite3.Cursor, suffix: str, dump: RegionDataDump, tags: typing.List[str], workers: int = 1) -> None:
+    if len(tags) > MAX_REGION_TAGS:
+        raise ValueError(f"at most {MAX_REGION_TAGS} region tags can be fetched, got {len(tags)}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(tags))) as executor:
+        tag_futures = {}
+        if not dump.offline:
+            tag_futures = {tag: executor.submit(fetch_regions_by_tag, tag) for tag in tags}
+
+        summary = DumpSummary()
+        if workers > 1:
+            region_data = parse_region_data_parallel(dump.read_chunks(), summary, workers)
+        else:
+            region_data = parse_region_data(dump.read_chunks(), summary)
+
+        while True:
+            batch = list(itertools.islice(region_data, INSERT_BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            insert_region_data(cursor, suffix, batch)
+
+        backfill_update_times(cursor, f"regions{suffix}", summary)
+
+        metadata = dump.cache.load_metadata(dump.date)
+        if dump.offline:
+            cached_tags = metadata.get("tags", {})
+            missing = [tag for tag in tags if tag not in cached_tags]
+            if len(missing) > 0:
+                print(f"[everblaze] region tags not cached for {dump.date}, leaving them out: {', '.join(missing)}")
+            tagged_regions = {tag: cached_tags[tag] for tag in tags if tag in cached_tags}
+        else:
+            tagged_regions = {tag: future.result() for (tag, future) in tag_futures.items()}
+            metadata["tags"] = tagged_regions
+            dump.cache.save_metadata(dump.date, metadata)
+
+        apply_region_tags(cursor, suffix, tagged_regions)
+
+# Summary of the changes made to the region database by an incremental refresh.
+@dataclass
+class RefreshSummary:
+    inserted: int # Regions that didn't exist in the previous snapshot.
+    updated: int # Regions whose data has changed since the previous snapshot.
+    deleted: int # Regions that no longer exist.
+    unchanged: int # Regions whose data hasn't changed, though their update index and times may have.
+    retimed: int = 0 # Unchanged regions whose update index or times were updated.
+
+# Refresh an existing region database in place, only touching regions that have changed since the last refresh.
+# The new data dump is loaded into staging tables first, compared against the current snapshot by api_name,
+# and the differences are applied in a single transaction, so readers see either the old or the new snapshot, never a mix of both.
+# Besides the default region tags, extra_tags will also be fetched and stored.
+# If workers is more than 1, the data dump is parsed by that many worker processes.
+# The data dump is read from (and downloaded into) cache, or a new DumpCache with default settings if not provided.
+# If offline is set, the newest cached dump is used (or the one from dump_date, if provided) and nothing is downloaded.
+# The database is read from and written to path, and a snapshot of it (see snapshot.py) is written to snapshot_path, unless it is None.
+def refresh_database(keep_dump: bool = False, extra_tags: typing.List[str] = [], workers: int = 1,
+                     offline: bool = False, dump_date: str | None = None, cache: DumpCache | None = None, path: str = "regions.db",
+                     snapshot_path: str | None = snapshot.SNAPSHOT_PATH) -> RefreshSummary:
+    print("[everblaze] refreshing regional database table")
+    dump = RegionDataDump(cache or DumpCache(), offline, dump_date, keep_dump)
+
+    con = sqlite3.connect(path)
+    # Write-ahead logging lets other connections keep reading the current snapshot while the refresh is applied.
+    con.execute("PRAGMA journal_mode=WAL")
+    migrate_database(con)
 
-def format_timestamp(timestamp: int) -> str:
-    return datetime.datetime.fromtimestamp(timestamp).strftime("%A %b %d, %H:%M")
+    cursor = con.cursor()
+    create_region_tables(cursor, "_staging", temporary=True)
+    populate_region_tables(cursor, "_staging", dump, get_region_tags(extra_tags), workers)
+    con.commit()
 
-# Extract region data from the regions.xml data dump.
-def parse_region_data(filename: str) -> typing.List[typing.Tuple]:
-    print("[everblaze] parsing latest regional data dump")
+    # Names of the regions that are new, gone, or whose data has changed since the current snapshot.
+    # Update indexes and times are left out of the comparison, as they are updated separately for every region below.
+    cursor.execute("CREATE TEMP TABLE changed_regions(api_name TEXT PRIMARY KEY)")
+    for (table, (_, key)) in REGION_TABLES.items():
+        columns = REGION_SOURCE_COLUMNS if table == "regions" else "*"
+        cursor.execute(f"""INSERT OR IGNORE INTO changed_regions
+                       SELECT {key} FROM (SELECT {columns} FROM {table}_staging EXCEPT SELECT {columns} FROM {table})
+                       UNION SELECT {key} FROM (SELECT {columns} FROM {table} EXCEPT SELECT {columns} FROM {table}_staging)""")
 
-    tree = ET.parse(filename)
-    root = tree.getroot()
+    cursor.execute("SELECT count(*) FROM changed_regions WHERE api_name NOT IN (SELECT api_name FROM regions)")
+    inserted = int(cursor.fetchone()[0])
 
-    region_data = []
+    cursor.execute("SELECT count(*) FROM changed_regions WHERE api_name NOT IN (SELECT api_name FROM regions_staging)")
+    deleted = int(cursor.fetchone()[0])
 
-    regions = root.findall("./REGION")
+    cursor.execute("SELECT count(*) FROM changed_regions")
+    updated = int(cursor.fetchone()[0]) - inserted - deleted
 
-    (major_start, major_length) = get_last_major_data(regions)
-    (minor_start, minor_length) = get_last_minor_data(regions)
+    with con:
+        # Changed regions are removed and reinserted as a whole.
+        for (table, (_, key)) in REGION_TABLES.items():
+            cursor.execute(f"DELETE FROM {table} WHERE {key} IN (SELECT api_name FROM changed_regions)")
 
-    print(f"[everblaze] last major: {format_timestamp(major_start)}, {major_length} seconds long")
-    print(f"[everblaze] last minor: {format_timestamp(minor_start)}, {minor_length} seconds long")
+        # Every other region gets its new update index and times in bulk. Update indexes are unique, so the ones that move are
+        # first set aside as negative numbers, so that a region never takes the index another one hasn't left yet.
+        cursor.execute("""UPDATE regions SET update_index = -1 - regions.update_index FROM regions_staging AS staging
+                       WHERE staging.api_name = regions.api_name AND staging.update_index != regions.update_index""")
+        reindexed = cursor.rowcount
 
-    passworded_regions = fetch_passworded_regions()
-    governorless_regions = fetch_governorless_regions()
+        cursor.execute("""UPDATE regions SET update_index = staging.update_index, seconds_major = staging.seconds_major, seconds_minor = staging.seconds_minor
+                       FROM regions_staging AS staging WHERE staging.api_name = regions.api_name
+                       AND (staging.update_index != regions.update_index OR staging.seconds_major != regions.seconds_major OR staging.seconds_minor != regions.seconds_minor)""")
+        retimed = cursor.rowcount
 
-    numnations = 0
-    for region in regions:
-        numnations += int(region.find("NUMNATIONS").text)
+        for (table, (_, key)) in REGION_TABLES.items():
+            cursor.execute(f"INSERT INTO {table} SELECT * FROM {table}_staging WHERE {key} IN (SELECT api_name FROM changed_regions)")
 
-    major_secs_per_nation = major_length / numnations
-    minor_secs_per_nation = minor_length / numnations
+        # Bits may have been reassigned if the list of tags changed, in which case every region will show up as updated above.
+        cursor.execute("DELETE FROM region_tags")
+        cursor.execute("INSERT INTO region_tags SELECT * FROM region_tags_staging")
 
-    print(f"[everblaze] {numnations} total nations, {major_secs_per_nation} seconds per nation (major), {minor_secs_per_nation} seconds per nation (minor)")
+        # The WFE index is keyed by update index, so it has to be rebuilt as a whole if any of them moved.
+        if inserted + updated + deleted + reindexed > 0:
+            build_wfe_index(cursor)
 
-    cumulative_nations = 0
+    cursor.execute("SELECT count(*) FROM regions")
+    unchanged = int(cursor.fetchone()[0]) - inserted - updated
 
-    for index, region in enumerate(regions):
-        # Core information
-        canon_name = region.find("NAME").text
-        api_name = util.format_nation_or_region(canon_name)
-        update_index = index
-        delendos = int(region.find("DELEGATEVOTES").text) - 1 # Delegate Votes = Delegate Endos + 1
-        executive = int("X" in region.find("DELEGATEAUTH").text) # 1 for Executive, 0 for Non-Executive
-        wfe = region.find("FACTBOOK").text
-        if wfe is None:
-            wfe = ""
+    if snapshot_path is not None:
+        snapshot.write_snapshot(con, snapshot_path)
 
-        # Apparently last update isn't accurate enough. Calculate update times based on average update time per nation.
-        seconds_major = cumulative_nations * major_secs_per_nation
-        seconds_minor = cumulative_nations * minor_secs_per_nation
-        cumulative_nations += int(region.find("NUMNATIONS").text)
-
-        # Simple enough
-        password = 0
-        if api_name in passworded_regions:
-            password = 1
-
-        governorless = 0
-        if api_name in governorless_regions:
-            governorless = 1
-
-        # Oh boy
-        embassies = []
-        for child in region.find("EMBASSIES"):
-            if("type" in child.attrib.keys()):
-                if(child.attrib["type"] in ["denied", "rejected", "closing"]):
-                    # Skipping unwanted/closed embassy
-                    continue
-                if(child.attrib["type"] in ["requested", "pending", "invited"]):
-                    pass # Add it nonetheless. We don't want to retag regions we've already tagged even if the embassy is pending.
-
-            embassies.append(util.format_nation_or_region(child.text))
+    con.close()
 
-        # Join it all together
-        region_data.append((canon_name, api_name, update_index, seconds_major, seconds_minor, delendos, executive, password, governorless, wfe, ",".join(embassies)))
+    summary = RefreshSummary(inserted, updated, deleted, unchanged, retimed)
+    print(f"[everblaze] refresh done: {summary.inserted} new, {summary.updated} updated, {summary.deleted} deleted, {summary.unchanged} unchanged regions "
+          f"({summary.retimed} with new update times)")
 
-    return region_data
+    return summary
 
 # Generate the region information database, using the provided nation name to identify itself to NationStates.
-def generate_database() -> None:
+# If keep_dump is set, the compressed data dump will be kept as regions.xml.gz.
+# If incremental is set and a database already exists, it will be refreshed in place with refresh_database() instead of being rebuilt from scratch.
+# Besides the default region tags, extra_tags will also be fetched and stored.
+# If workers is more than 1, the data dump is parsed by that many worker processes.
+# The data dump is read from (and downloaded into) cache, or a new DumpCache with default settings if not provided.
+# If offline is set, the newest cached dump is used (or the one from dump_date, if provided) and nothing is downloaded.
+# The database is written to path, and a snapshot of it (see snapshot.py) to snapshot_path, unless it is None.
+def generate_database(keep_dump: bool = False, incremental: bool = False, extra_tags: typing.List[str] = [], workers: int = 1,
+                      offline: bool = False, dump_date: str | None = None, cache: DumpCache | None = None, path: str = "regions.db",
+                      snapshot_path: str | None = snapshot.SNAPSHOT_PATH) -> None:
+    if incremental and os.path.exists(path):
+        refresh_database(keep_dump, extra_tags, workers, offline, dump_date, cache, path, snapshot_path)
+        return
+
     print("[everblaze] generating regional database table")
+    dump = RegionDataDump(cache or DumpCache(), offline, dump_date, keep_dump)
 
-    if os.path.exists("regions.db"):
-        os.remove("regions.db")
-    con = sqlite3.connect("regions.db")
+    # Also clean up the write-ahead log left behind by refresh_database(), if any.
+    for filename in [path, f"{path}-wal", f"{path}-shm"]:
+        if os.path.exists(filename):
+            os.remove(filename)
+    con = sqlite3.connect(path)
 
     cursor = con.cursor()
-    cursor.execute("CREATE TABLE regions(canon_name, api_name, update_index, seconds_major, seconds_minor, delendos, executive, password, governorless, wfe, embassies)")
-
-    download_region_data_dump()
-    region_data = parse_region_data("regions.xml")
-
-    cursor.executemany("INSERT INTO regions VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", region_data)
-    con.commit()
\ No newline at end of file
+    create_region_tables(cursor)
+    populate_region_tables(cursor, "", dump, get_region_tags(extra_tags), workers)
+    create_region_indexes(cursor)
+    build_wfe_index(cursor)
+    set_schema_version(cursor, SCHEMA_VERSION)
+    con.commit()
+
+    if snapshot_path is not None:
+        snapshot.write_snapshot(con, snapshot_path)
+
+    con.close()
+
+# Replace the contents of the region database at destination with the one at source, then delete source.
+# The copy is made with SQLite's backup API rather than by renaming the file, so connections that are still open on destination
+# (including their write-ahead log, if any) stay valid, and see either the old or the new database, never a mix of both.
+def install_database(source: str, destination: str = "regions.db") -> None:
+    source_con = sqlite3.connect(source)
+    destination_con = sqlite3.connect(destination)
+
+    source_con.backup(destination_con)
+
+    destination_con.close()
+    source_con.close()
+    os.remove(source)
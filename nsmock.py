@@ -0,0 +1,244 @@
+# nsmock.py - Local stand-in for the NationStates endpoints Everblaze uses
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# Serves a synthetic regional data dump, the regionsbytag and nation shards of the API, and an SSE happenings stream simulating an update
+# across the same regions, so Everblaze can be tested at scale without touching NationStates.
+# Point the bot or the TUI at it with --ns-url http://localhost:PORT (requests to it aren't rate limited).
+# Usage: python nsmock.py [-n REGIONS] [--port PORT] [--update major|minor] [--speed N] [--start-delay SECONDS] [--repeat] [--delay-connections N:SECONDS,...]
+
+import argparse, asyncio, email.utils, gzip, itertools, json, random, time, typing
+from dataclasses import dataclass
+from xml.sax.saxutils import escape
+from aiohttp import web
+import db, recording
+import utility as util
+
+DEFAULT_PORT = 6260
+
+# Seconds a major/minor update takes, roughly.
+MAJOR_LENGTH = 5400.0
+MINOR_LENGTH = 3600.0
+
+# LASTMAJORUPDATE/LASTMINORUPDATE of the first region in the data dump, which is when the simulated last updates started.
+MAJOR_START = 1700000000
+MINOR_START = 1700040000
+
+# Number of nations a region can have, picked at random. Most regions are tiny, a few are huge.
+NATION_COUNTS = [0, 1, 1, 1, 2, 3, 5, 10, 30, 200]
+
+# A region served by the stand-in server.
+@dataclass
+class MockRegion:
+    canon_name: str
+    api_name: str
+    numnations: int
+    delendos: int
+    executive: bool
+    tags: set[str]
+    seconds_major: float # Seconds after the start of major update the region updates at, as Everblaze will predict it from the data dump.
+    seconds_minor: float # Same, for minor update.
+    last_major: int # LASTMAJORUPDATE of the region in the data dump.
+    last_minor: int # LASTMINORUPDATE of the region in the data dump.
+
+# Generate count regions, in update order.
+def generate_regions(count: int, seed: int = 0) -> typing.List[MockRegion]:
+    rng = random.Random(seed)
+    nations = [rng.choice(NATION_COUNTS) for _ in range(count)]
+    total_nations = max(1, sum(nations))
+
+    # Everblaze spreads update over regions by nation count, between the last update times of the first and last regions in the dump.
+    # Use the same calculation, so the simulated update matches its predictions exactly.
+    cumulative_nations = [0, *itertools.accumulate(nations[:-1])]
+    major_length = round(MAJOR_LENGTH)
+    minor_length = round(MINOR_LENGTH)
+
+    regions = []
+    for index in range(count):
+        tags = {tag for tag in db.DEFAULT_REGION_TAGS if rng.random() < 0.1}
+        seconds_major = cumulative_nations[index] * major_length / total_nations
+        seconds_minor = cumulative_nations[index] * minor_length / total_nations
+        regions.append(MockRegion(f"Region {index}", f"region_{index}", nations[index], rng.randint(0, 40), rng.random() < 0.7, tags,
+                                  seconds_major, seconds_minor, MAJOR_START + round(seconds_major), MINOR_START + round(seconds_minor)))
+
+    # Only the first and last regions' times matter to Everblaze, and the last region's has to be the end of update.
+    if count != 0:
+        regions[-1].last_major = MAJOR_START + major_length
+        regions[-1].last_minor = MINOR_START + minor_length
+
+    return regions
+
+# Build a compressed data dump shaped like regions.xml.gz, holding regions.
+def build_region_dump(regions: typing.List[MockRegion]) -> bytes:
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<REGIONS api_version="12">\n']
+
+    for region in regions:
+        nations = ":".join(f"{region.api_name}_nation_{n}" for n in range(region.numnations))
+        parts.append(f"<REGION><NAME>{escape(region.canon_name)}</NAME><NUMNATIONS>{region.numnations}</NUMNATIONS><NATIONS>{nations}</NATIONS>"
+                     f"<DELEGATEVOTES>{region.delendos + 1}</DELEGATEVOTES><DELEGATEAUTH>{'X' if region.executive else 'A'}</DELEGATEAUTH>"
+                     f"<FACTBOOK>welcome to {escape(region.canon_name)}</FACTBOOK><LASTMAJORUPDATE>{region.last_major}</LASTMAJORUPDATE>"
+                     f"<LASTMINORUPDATE>{region.last_minor}</LASTMINORUPDATE><EMBASSIES></EMBASSIES></REGION>\n")
+
+    parts.append("</REGIONS>\n")
+    return gzip.compress("".join(parts).encode())
+
+# Simulates updates, sending their happenings to every client connected to the SSE stream.
+class UpdateSimulator:
+    def __init__(self, regions: typing.List[MockRegion], minor: bool = False, speed: float = 1, start_delay: float = 5, repeat: bool = False,
+                 wa_events: float = 1, delegate_changes: float = 0.01, seed: int = 0) -> None:
+        self.regions = regions
+        self.minor = minor
+        self.speed = speed
+        self.start_delay = start_delay
+        self.repeat = repeat
+        self.wa_events = wa_events
+        self.delegate_changes = delegate_changes
+        self.seed = seed
+        self.subscribers: set[asyncio.Queue[tuple[float, str]]] = set() # Each holds (time.monotonic() at broadcast, event) pairs.
+        self.next_id = 0
+        self.sent = 0
+
+    # Run updates until cancelled, or only one if repeat isn't set.
+    async def run(self) -> None:
+        names = [region.api_name for region in self.regions]
+        seconds = [region.seconds_minor if self.minor else region.seconds_major for region in self.regions]
+        update = 0
+
+        while True:
+            await asyncio.sleep(self.start_delay)
+
+            events = recording.synthetic_update(names, seconds, self.wa_events, self.delegate_changes, seed=self.seed + update)
+            print(f"[nsmock] starting {'minor' if self.minor else 'major'} update, {len(events)} happenings at {self.speed}x speed")
+
+            start = time.monotonic()
+            async for data in recording.replay_events(events, self.speed):
+                self.broadcast(data["str"])
+
+            print(f"[nsmock] update over in %.1fs, {len(self.subscribers)} clients connected" % (time.monotonic() - start))
+
+            update += 1
+            if not self.repeat:
+                return
+
+    # Send a happening to every connected client, formatted like NationStates does.
+    def broadcast(self, happening: str) -> None:
+        event = json.dumps({"id": str(self.next_id), "str": happening, "time": int(time.time())})
+        self.next_id += 1
+        self.sent += 1
+
+        now = time.monotonic()
+        for queue in self.subscribers:
+            queue.put_nowait((now, f"data: {event}\n\n"))
+
+# Holds everything the request handlers serve.
+class MockServer:
+    def __init__(self, regions: typing.List[MockRegion], simulator: UpdateSimulator, missing_nations: set[str] = set(),
+                 connection_delays: dict[int, float] = {}) -> None:
+        self.regions = regions
+        self.simulator = simulator
+        self.missing_nations = missing_nations
+        self.connection_delays = connection_delays # Seconds each SSE connection gets every happening late by, by connection number.
+        self.sse_connections = 0 # Number of SSE connections opened so far, which is the number of the next one (starting at 0).
+        self.dump = build_region_dump(regions)
+        self.last_modified = email.utils.formatdate(usegmt=True)
+        self.etag = f'"{len(regions)}-{simulator.seed}"'
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/pages/regions.xml.gz", self.handle_dump)
+        app.router.add_get("/archive/nations/{name}", self.handle_dump)
+        app.router.add_get("/cgi-bin/api.cgi", self.handle_api)
+        app.router.add_get("/api/{buckets}", self.handle_sse)
+        app.cleanup_ctx.append(self.run_simulator)
+        return app
+
+    async def run_simulator(self, app: web.Application) -> typing.AsyncIterator[None]:
+        task = asyncio.create_task(self.simulator.run())
+        yield
+        task.cancel()
+
+    async def handle_dump(self, request: web.Request) -> web.Response:
+        headers = {"ETag": self.etag, "Last-Modified": self.last_modified}
+        if request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=self.dump, headers=headers, content_type="application/x-gzip")
+
+    # The nation and regionsbytag shards, which are all Everblaze asks the API for.
+    async def handle_api(self, request: web.Request) -> web.Response:
+        query = request.query
+
+        if "nation" in query:
+            nation = util.format_nation_or_region(query["nation"])
+            if nation in self.missing_nations:
+                return web.Response(status=404, text="Unknown nation.", content_type="text/xml")
+            return web.Response(text=f'<NATION id="{escape(nation)}"><NAME>{escape(nation)}</NAME></NATION>', content_type="text/xml")
+
+        if "regionsbytag" in query.get("q", "").split(" "):
+            # Tags starting with - are ones regions must not have, like on NationStates.
+            tags = [tag for tag in query.get("tags", "").split(",") if tag != ""]
+            required = {tag for tag in tags if not tag.startswith("-")}
+            excluded = {tag[1:] for tag in tags if tag.startswith("-")}
+            names = [region.canon_name for region in self.regions if required <= region.tags and not (excluded & region.tags)]
+            return web.Response(text=f"<WORLD><REGIONS>{escape(",".join(names))}</REGIONS></WORLD>", content_type="text/xml")
+
+        return web.Response(status=400, text="Unsupported query.")
+
+    # Every client gets every happening, whichever buckets it asked for.
+    # Connections listed in connection_delays get each happening that many seconds after it was broadcast, to simulate a slow connection.
+    async def handle_sse(self, request: web.Request) -> web.StreamResponse:
+        connection = self.sse_connections
+        self.sse_connections += 1
+        delay = self.connection_delays.get(connection, 0)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        queue: asyncio.Queue[tuple[float, str]] = asyncio.Queue()
+        self.simulator.subscribers.add(queue)
+        try:
+            while True:
+                (broadcast, event) = await queue.get()
+                if delay > 0:
+                    await asyncio.sleep(broadcast + delay - time.monotonic())
+                await response.write(event.encode())
+        except ConnectionResetError:
+            pass
+        finally:
+            self.simulator.subscribers.discard(queue)
+
+        return response
+
+# Parse the value of --delay-connections, such as "1:0.5,2:2".
+def parse_connection_delays(value: str) -> dict[int, float]:
+    delays = {}
+    for pair in value.split(","):
+        (connection, seconds) = pair.split(":")
+        delays[int(connection)] = float(seconds)
+    return delays
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="everblaze-nsmock", description="Local stand-in NationStates server for testing Everblaze")
+    parser.add_argument("-n", "--regions", type=int, default=30000)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--update", choices=["major", "minor"], default="major")
+    parser.add_argument("--speed", type=float, default=1, help="run updates N times faster than real time")
+    parser.add_argument("--start-delay", type=float, default=5, help="seconds to wait before starting each update")
+    parser.add_argument("--repeat", action='store_true', help="start a new update after each one ends")
+    parser.add_argument("--wa-events", type=float, default=1, help="average number of endorsements, unendorsements and resignations per region update")
+    parser.add_argument("--delegate-changes", type=float, default=0.01, help="chance of each region getting a new WA delegate as it updates")
+    parser.add_argument("--missing-nations", type=lambda value: {util.format_nation_or_region(nation) for nation in value.split(",")}, default=set(),
+                        help="comma-separated nations to report as nonexistent (every other nation exists)")
+    parser.add_argument("--delay-connections", type=parse_connection_delays, default={},
+                        help="comma-separated CONNECTION:SECONDS pairs, delaying every happening sent over the given SSE connections (numbered from 0, in the order they're opened)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    regions = generate_regions(args.regions, args.seed)
+    simulator = UpdateSimulator(regions, util.is_minor(args.update), args.speed, args.start_delay, args.repeat, args.wa_events, args.delegate_changes, args.seed)
+    server = MockServer(regions, simulator, args.missing_nations, args.delay_connections)
+
+    print(f"[nsmock] serving {len(regions)} regions on http://{args.host}:{args.port}")
+    web.run_app(server.create_app(), host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# recording.py - Recording and replaying NationStates SSE streams
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# A recording holds one raw SSE event per line, as compact JSON, in the order they were received:
+#   {"id":...,"str":"%%region%% updated.","time":1700000000,"received":1700000000.123}
+# "time" is the UNIX timestamp NationStates gave the happening, "received" the UNIX timestamp it was read at.
+# Recordings are only ever appended to, so a recording interrupted by a crash keeps everything received until then.
+
+import asyncio, datetime, json, random, time, typing
+
+# A raw SSE event, as returned by sans.serversent_events(), along with the UNIX timestamp it was received at.
+class RecordedEvent(typing.NamedTuple):
+    data: dict
+    received: float
+
+# Appends every SSE event it's given to a recording.
+class EventRecorder:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Line buffered, so every event reaches the file as soon as it's recorded.
+        self.file = open(path, "a", buffering=1)
+
+    def record(self, data: dict, received: float) -> None:
+        self.file.write(format_recorded_event(data, received) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+def format_recorded_event(data: dict, received: float) -> str:
+    event = {"id": data["id"], "str": data["str"], "time": int(data["time"].timestamp()), "received": round(received, 6)}
+    return json.dumps(event, separators=(",", ":"))
+
+# Read every event in the recording at path. Lines that can't be parsed (such as one cut short by a crash) are skipped.
+def load_recording(path: str) -> typing.List[RecordedEvent]:
+    events = []
+    with open(path, "r") as recording:
+        for line in recording:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            data = {"id": event["id"], "str": event["str"], "time": datetime.datetime.fromtimestamp(event["time"], datetime.timezone.utc)}
+            events.append(RecordedEvent(data, event["received"]))
+
+    return events
+
+# Generate the events of a whole update, starting at start (a UNIX timestamp). names holds the api_names of the regions in update order,
+# and seconds the number of seconds after the start of update each of them updates at.
+# Each region update comes with wa_events endorsement, unendorsement and resignation happenings on average, in between region updates,
+# and is followed by a new WA delegate in that region with a probability of delegate_changes.
+def synthetic_update(names: typing.Sequence[str], seconds: typing.Sequence[float], wa_events: float = 1, delegate_changes: float = 0,
+                     start: float = 0, seed: int = 0) -> typing.List[RecordedEvent]:
+    rng = random.Random(seed)
+    wa_formats = [
+        (25, "@@{nation}@@ endorsed @@{other}@@."),
+        (10, "@@{nation}@@ withdrew its endorsement from @@{other}@@."),
+        (3, "@@{nation}@@ resigned from the World Assembly."),
+    ]
+    weights = [weight for (weight, _) in wa_formats]
+
+    events: typing.List[RecordedEvent] = []
+    def add_event(happening: str, received: float) -> None:
+        data = {"id": len(events), "str": happening, "time": datetime.datetime.fromtimestamp(int(received), datetime.timezone.utc)}
+        events.append(RecordedEvent(data, received))
+
+    for (index, name) in enumerate(names):
+        received = start + seconds[index]
+        add_event(f"%%{name}%% updated.", received)
+
+        if rng.random() < delegate_changes:
+            add_event(f"@@nation_{rng.randrange(100000)}@@ became WA Delegate of %%{name}%%.", received)
+
+        while rng.random() < wa_events / (wa_events + 1):
+            happening = rng.choices(wa_formats, weights)[0][1].format(nation=f"nation_{rng.randrange(100000)}", other=f"nation_{rng.randrange(100000)}")
+            add_event(happening, received)
+
+    return events
+
+# Yield the data of each event at the same pace it was received at, sped up speed times, or as fast as possible if speed is None.
+# Can be passed as the event source of the TUI, or of EventStream (through a lambda ignoring the client).
+async def replay_events(events: typing.Sequence[RecordedEvent], speed: float | None = None) -> typing.AsyncIterator[dict]:
+    if len(events) == 0:
+        return
+
+    first_received = events[0].received
+    start = time.monotonic()
+    for event in events:
+        if speed is not None:
+            delay = start + (event.received - first_received) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Still let other tasks run between events, like they would between network reads.
+            await asyncio.sleep(0)
+
+        yield event.data
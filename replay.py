@@ -0,0 +1,191 @@
+# replay.py - Replays recorded or synthetic update streams through the bot and the TUI
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# Feeds a recording made with `bot.py --record-sse` or `tui.py --record`, or a synthetic update generated from the region snapshot,
+# into the same code that handles live events, and reports how long handling them took. Nothing is sent over the network: the bot
+# gets stub Discord guilds and channels, and the TUI runs headless.
+# Usage: python replay.py [RECORDING] [--target bot|tui] [--speed N] [--triggers N] [--channels N]
+
+import argparse, asyncio, collections, contextvars, random, sqlite3, time, typing
+import utility as util
+import recording, snapshot
+from stubs import StubChannel, StubGuild
+
+# time.monotonic() at which the event being dispatched was received, inherited by the tasks running its listeners.
+received_at: contextvars.ContextVar[float] = contextvars.ContextVar("received_at")
+
+# Guild ID every stub channel belongs to.
+REPLAY_GUILD_ID = 1
+
+# Format the number and distribution of a list of durations, in milliseconds.
+def format_latencies(name: str, values: typing.List[float]) -> str:
+    if len(values) == 0:
+        return f"{name}: none"
+
+    values = sorted(values)
+    def percentile(fraction: float) -> float:
+        return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+    return f"{name}: {len(values)}, mean %.3fms, p50 %.3fms, p99 %.3fms, max %.3fms" % (sum(values) / len(values) * 1000, percentile(0.5), percentile(0.99), values[-1] * 1000)
+
+# Pick count random regions to use as triggers, spread over channels channels.
+def pick_triggers(store: snapshot.RegionStore, count: int, channels: int, seed: int) -> dict[int, typing.List[str]]:
+    rng = random.Random(seed)
+    triggers: dict[int, typing.List[str]] = {channel_id: [] for channel_id in range(1, channels + 1)}
+    for index in rng.sample(range(len(store)), min(count, len(store))):
+        triggers[rng.randrange(channels) + 1].append(store.get_api_name(index))
+    return triggers
+
+def print_summary(events: int, elapsed: float) -> None:
+    print(f"replayed {events} events in %.3fs, %.0f events/s" % (elapsed, events / elapsed if elapsed > 0 else 0))
+
+# Replay events through the bot's cogs, dispatching them like EventStream does.
+async def replay_bot(events: typing.List[recording.RecordedEvent], speed: float | None, triggers: dict[int, typing.List[str]]) -> None:
+    # Imported here so that replaying through the TUI doesn't need discord.py's bot machinery loaded.
+    from discord.ext import commands
+    import bot as everblaze
+    from cogs.sse import EventStream
+    from cogs.triggers import TriggerManager
+
+    latencies: typing.List[float] = []
+
+    # Record how long after its event was received each message would have been sent.
+    def record_latency(channel_id: int, content: typing.Optional[str]) -> None:
+        latencies.append(time.monotonic() - received_at.get(time.monotonic()))
+
+    class ReplayBot(everblaze.EverblazeBot):
+        # Events come from the replay instead of NationStates.
+        async def add_cog(self, cog: commands.Cog, **kwargs) -> None:
+            if not isinstance(cog, EventStream):
+                await super().add_cog(cog, **kwargs)
+
+        def get_guild(self, id: int, /) -> typing.Any:
+            return StubGuild(id, record_latency)
+
+        def get_channel(self, id: int, /) -> typing.Any:
+            return StubChannel(id, record_latency)
+
+    bot_db = sqlite3.connect(":memory:")
+    everblaze.create_tables_if_needed(bot_db)
+    for channel_id in triggers.keys():
+        bot_db.execute("INSERT INTO channels VALUES (?, ?, 0, 0, 0, 0)", (channel_id, REPLAY_GUILD_ID))
+
+    replay_bot = ReplayBot(bot_db, sqlite3.connect("regions.db"), None, "replay")
+    async with replay_bot:
+        await replay_bot.setup_hook()
+
+        trigger_manager: TriggerManager = replay_bot.get_cog('TriggerManager')
+        cursor = replay_bot.everblaze_db.cursor()
+        for (channel_id, regions) in triggers.items():
+            trigger_list = trigger_manager.get_trigger_list_from_id(channel_id)
+            trigger_list.add_triggers([{"api_name": region} for region in regions])
+            trigger_list.sort_triggers(cursor)
+        cursor.close()
+
+        handling: typing.List[float] = []
+        count = 0
+        start = time.monotonic()
+        async for data in recording.replay_events(events, speed):
+            received = time.monotonic()
+            count += 1
+
+            response = everblaze.parse_sse_event(data)
+            if response is None:
+                continue
+
+            (name, event) = response
+            token = received_at.set(received)
+            replay_bot.dispatch(name, event)
+            received_at.reset(token)
+            handling.append(time.monotonic() - received)
+
+        listeners = [task for task in asyncio.all_tasks() if task.get_name().startswith("discord.py:")]
+        await asyncio.gather(*listeners)
+        elapsed = time.monotonic() - start
+
+    print_summary(count, elapsed)
+    print(format_latencies("parsed and dispatched", handling))
+    print(format_latencies("messages sent", latencies))
+
+# Replay events through a headless TUI.
+async def replay_tui(events: typing.List[recording.RecordedEvent], speed: float | None, triggers: dict[int, typing.List[str]]) -> None:
+    from textual import on
+    import tui
+
+    received: collections.deque[float] = collections.deque()
+    latencies: typing.List[float] = []
+    count = 0
+    done = asyncio.Event()
+
+    async def replay_stream(client: typing.Any) -> typing.AsyncIterator[dict]:
+        nonlocal count
+        async for data in recording.replay_events(events, speed):
+            count += 1
+            if isinstance(util.classify_sse_event(data), util.RegionUpdateEvent):
+                received.append(time.monotonic())
+            yield data
+        done.set()
+
+    class ReplayApp(tui.TriggerApp):
+        # Runs before TriggerApp.on_region_update(), so wait for it before measuring.
+        @on(tui.TriggerApp.RegionUpdate)
+        def on_replayed_region_update(self, event: tui.TriggerApp.RegionUpdate) -> None:
+            self.call_next(lambda: latencies.append(time.monotonic() - received.popleft()))
+
+    con = sqlite3.connect("regions.db")
+    tui.cursor = con.cursor()
+    tui.store = snapshot.RegionStore()
+    tui.timing_index = util.TimingIndex.from_store(tui.store)
+    tui.region_cache.preload(tui.cursor)
+    tui.targets.add_triggers([{"api_name": region} for regions in triggers.values() for region in regions])
+    tui.targets.sort_triggers(tui.cursor)
+    tui.open_event_stream = replay_stream
+
+    app = ReplayApp()
+    start = time.monotonic()
+    async with app.run_test(headless=True) as pilot:
+        await done.wait()
+        while len(received) != 0:
+            await pilot.pause()
+        elapsed = time.monotonic() - start
+
+    print_summary(count, elapsed)
+    print(format_latencies("region updates handled", latencies))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="everblaze-replay", description="Replay recorded or synthetic update streams offline")
+    parser.add_argument("recording", nargs="?", help="recording to replay (a synthetic update is generated if omitted)")
+    parser.add_argument("--target", choices=["bot", "tui"], default="bot")
+    parser.add_argument("--speed", type=float, help="replay N times faster than recorded (as fast as possible if omitted)")
+    parser.add_argument("--minor", action='store_true', help="generate a minor update instead of a major one")
+    parser.add_argument("--wa-events", type=float, default=1, help="average number of endorsements, unendorsements and resignations per region update, in synthetic updates")
+    parser.add_argument("--delegate-changes", type=float, default=0.01, help="chance of each region getting a new WA delegate as it updates, in synthetic updates")
+    parser.add_argument("--save", help="also write the synthetic update to this file, as a recording")
+    parser.add_argument("--triggers", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    store = snapshot.RegionStore()
+
+    if args.recording is not None:
+        events = recording.load_recording(args.recording)
+    else:
+        names = [store.get_api_name(index) for index in range(len(store))]
+        seconds = store.seconds_minor if args.minor else store.seconds_major
+        events = recording.synthetic_update(names, seconds, args.wa_events, args.delegate_changes, time.time(), args.seed)
+        if args.save is not None:
+            recorder = recording.EventRecorder(args.save)
+            for event in events:
+                recorder.record(event.data, event.received)
+            recorder.close()
+
+    triggers = pick_triggers(store, args.triggers, args.channels, args.seed)
+
+    if args.target == "bot":
+        asyncio.run(replay_bot(events, args.speed, triggers))
+    else:
+        asyncio.run(replay_tui(events, args.speed, triggers))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# snapshot.py - Memory-mapped columnar snapshot of the region database
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# The snapshot holds the columns needed to look up regions and their update times during update, stored as fixed-width arrays
+# indexed by update index, plus a table of region names sorted alphabetically. It is written alongside the region database
+# and memory-mapped read-only, so lookups don't need any SQL queries, and every process using it shares the same pages.
+
+import array, bisect, mmap, os, sqlite3, struct, typing, zlib
+
+# Default location of the snapshot, next to regions.db.
+SNAPSHOT_PATH = "regions.snapshot"
+
+# Identifies snapshot files, and the version of their layout. Bump SNAPSHOT_VERSION whenever the layout changes.
+SNAPSHOT_MAGIC = b"EVBZSNAP"
+SNAPSHOT_VERSION = 1
+
+# Written in native byte order, so a snapshot written on a machine with a different byte order can be told apart.
+BYTE_ORDER_MARK = 0x01020304
+
+# Array type codes used by snapshot columns.
+ColumnType = typing.Literal["d", "Q", "i", "I", "B"]
+
+# Columns of the snapshot, in the order they're stored in, with their array type codes.
+# Columns with wider types come first, so every column stays aligned to its type's size.
+SNAPSHOT_COLUMNS: list[tuple[str, ColumnType]] = [
+    ("seconds_major", "d"),
+    ("seconds_minor", "d"),
+    ("tags", "Q"),
+    ("delendos", "i"),
+    ("name_order", "I"), # Update indexes of all regions, sorted by api_name.
+    ("name_table", "I"), # Open-addressing hash table of api_names, holding update index + 1 in each used slot and 0 in empty ones.
+    ("api_name_offsets", "I"), # Offsets of each region's api_name in api_names, plus the end of the last one.
+    ("canon_name_offsets", "I"), # Offsets of each region's canon_name in canon_names, plus the end of the last one.
+    ("executive", "B"),
+    ("api_names", "B"), # UTF-8 encoded api_names of all regions, in update order.
+    ("canon_names", "B"), # UTF-8 encoded canon_names of all regions, in update order.
+]
+
+# magic, version, byte order mark, region count, then the offset and length in bytes of each column.
+HEADER_FORMAT = f"=8sIII{"QQ" * len(SNAPSHOT_COLUMNS)}"
+
+# The name hash table has at least this many slots per region, so lookups rarely need more than one or two probes.
+NAME_TABLE_LOAD_FACTOR = 2
+
+# Columns are aligned to this many bytes within the file.
+COLUMN_ALIGNMENT = 8
+
+# Write a snapshot of the region database open on con to path.
+# The snapshot is written to a temporary file first and then renamed, so processes that have the previous one mapped keep using it
+# undisturbed, and new ones never see a half-written file.
+def write_snapshot(con: sqlite3.Connection, path: str = SNAPSHOT_PATH) -> None:
+    cursor = con.cursor()
+    cursor.execute("SELECT update_index, api_name, canon_name, seconds_major, seconds_minor, delendos, executive, tags FROM regions ORDER BY update_index")
+    rows = cursor.fetchall()
+    cursor.close()
+
+    columns = {name: array.array(typecode) for (name, typecode) in SNAPSHOT_COLUMNS}
+    api_names = []
+    api_name_offset = 0
+    canon_name_offset = 0
+
+    for (position, (update_index, api_name, canon_name, seconds_major, seconds_minor, delendos, executive, tags)) in enumerate(rows):
+        # Columns are indexed by update index, so it has to go from 0 to the number of regions minus one.
+        if update_index != position:
+            raise ValueError(f"update indexes are not contiguous: expected {position}, found {update_index}")
+
+        columns["seconds_major"].append(seconds_major)
+        columns["seconds_minor"].append(seconds_minor)
+        columns["tags"].append(tags)
+        columns["delendos"].append(delendos)
+        columns["executive"].append(executive)
+
+        encoded_api_name = api_name.encode()
+        columns["api_name_offsets"].append(api_name_offset)
+        columns["api_names"].frombytes(encoded_api_name)
+        api_name_offset += len(encoded_api_name)
+        api_names.append(encoded_api_name)
+
+        encoded_canon_name = canon_name.encode()
+        columns["canon_name_offsets"].append(canon_name_offset)
+        columns["canon_names"].frombytes(encoded_canon_name)
+        canon_name_offset += len(encoded_canon_name)
+
+    columns["api_name_offsets"].append(api_name_offset)
+    columns["canon_name_offsets"].append(canon_name_offset)
+    columns["name_order"].extend(sorted(range(len(rows)), key=lambda index: api_names[index]))
+
+    # Hash table size is a power of two, so slots can be found with a mask. Collisions go to the next slot.
+    table_size = 1
+    while table_size < len(rows) * NAME_TABLE_LOAD_FACTOR:
+        table_size *= 2
+
+    name_table = [0] * table_size
+    for (index, encoded_api_name) in enumerate(api_names):
+        slot = zlib.crc32(encoded_api_name) & (table_size - 1)
+        while name_table[slot] != 0:
+            slot = (slot + 1) & (table_size - 1)
+        name_table[slot] = index + 1
+
+    columns["name_table"].extend(name_table)
+
+    # Lay out the columns one after the other, after the header.
+    layout = []
+    offset = struct.calcsize(HEADER_FORMAT)
+    for (name, _) in SNAPSHOT_COLUMNS:
+        offset += -offset % COLUMN_ALIGNMENT
+        size = len(columns[name]) * columns[name].itemsize
+        layout += [offset, size]
+        offset += size
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(struct.pack(HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, BYTE_ORDER_MARK, len(rows), *layout))
+        for (index, (name, _)) in enumerate(SNAPSHOT_COLUMNS):
+            snapshot_file.seek(layout[index * 2])
+            columns[name].tofile(snapshot_file)
+
+    os.replace(temporary_path, path)
+
+# Returns True if the snapshot at path exists, has the current layout, and is at least as recent as the region database at database_path.
+def is_snapshot_current(path: str = SNAPSHOT_PATH, database_path: str = "regions.db") -> bool:
+    if not os.path.exists(path):
+        return False
+
+    if os.path.exists(database_path) and os.path.getmtime(path) < os.path.getmtime(database_path):
+        return False
+
+    with open(path, 'rb') as snapshot_file:
+        header = snapshot_file.read(struct.calcsize(HEADER_FORMAT))
+
+    if len(header) < struct.calcsize(HEADER_FORMAT):
+        return False
+
+    (magic, version, byte_order_mark) = struct.unpack_from("=8sII", header)
+    return magic == SNAPSHOT_MAGIC and version == SNAPSHOT_VERSION and byte_order_mark == BYTE_ORDER_MARK
+
+# Read-only view of a region snapshot written by write_snapshot().
+# Columns are exposed as memoryviews indexed by update index (e.g. store.seconds_major[index]), which read straight from the mapped file.
+class RegionStore:
+    seconds_major: memoryview
+    seconds_minor: memoryview
+    tags: memoryview
+    delendos: memoryview
+    executive: memoryview
+    name_order: memoryview
+    name_table: memoryview
+    api_name_offsets: memoryview
+    canon_name_offsets: memoryview
+
+    def __init__(self, path: str = SNAPSHOT_PATH) -> None:
+        with open(path, 'rb') as snapshot_file:
+            self.mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = struct.unpack_from(HEADER_FORMAT, self.mmap)
+        (magic, version, byte_order_mark, self.region_count) = header[:4]
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a region snapshot")
+        if version != SNAPSHOT_VERSION or byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"{path} was written by an incompatible version of Everblaze, or on a different machine")
+
+        self.views: list["memoryview[typing.Any]"] = [] # memoryview is only generic to type checkers.
+        self.column_offsets: dict[str, int] = {}
+        view = memoryview(self.mmap)
+        self.views.append(view)
+
+        for (index, (name, typecode)) in enumerate(SNAPSHOT_COLUMNS):
+            (offset, size) = header[4 + index * 2:6 + index * 2]
+            self.column_offsets[name] = offset
+            column = view[offset:offset + size].cast(typecode)
+            self.views.append(column)
+            setattr(self, name, column)
+
+    # Release the mapped file. Columns obtained from this store can't be used anymore afterwards.
+    def close(self) -> None:
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.mmap.close()
+
+    def __len__(self) -> int:
+        return self.region_count
+
+    def __contains__(self, api_name: str) -> bool:
+        return self.index_of(api_name) is not None
+
+    def get_api_name(self, index: int) -> str:
+        return self.get_encoded_api_name(index).decode()
+
+    def get_canon_name(self, index: int) -> str:
+        start = self.column_offsets["canon_names"]
+        return self.mmap[start + self.canon_name_offsets[index]:start + self.canon_name_offsets[index + 1]].decode()
+
+    # Returns the UTF-8 encoded api_name of a region, read straight from the mapped file.
+    def get_encoded_api_name(self, index: int) -> bytes:
+        start = self.column_offsets["api_names"]
+        return self.mmap[start + self.api_name_offsets[index]:start + self.api_name_offsets[index + 1]]
+
+    # Returns the update index of a region, or None if it doesn't exist.
+    # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
+    def index_of(self, api_name: str) -> int | None:
+        encoded = api_name.encode()
+        name_table = self.name_table
+        mask = len(name_table) - 1
+
+        slot = zlib.crc32(encoded) & mask
+        while (entry := name_table[slot]) != 0:
+            if self.get_encoded_api_name(entry - 1) == encoded:
+                return entry - 1
+            slot = (slot + 1) & mask
+
+        return None
+
+    # Returns the update indexes of all regions whose api_name starts with prefix, in alphabetical order.
+    def find_by_prefix(self, prefix: str) -> typing.List[int]:
+        encoded = prefix.encode()
+        position = bisect.bisect_left(self.name_order, encoded, key=self.get_encoded_api_name)
+
+        indexes = []
+        while position < self.region_count and self.get_encoded_api_name(self.name_order[position]).startswith(encoded):
+            indexes.append(self.name_order[position])
+            position += 1
+
+        return indexes
+
+    # Returns the update indexes of all regions updating strictly between start and end seconds after the start of update, as a range.
+    # Update times only ever increase with the update index, so this is a binary search.
+    def find_updating_between(self, minor: bool, start: float, end: float) -> range:
+        column = self.seconds_minor if minor else self.seconds_major
+        return range(bisect.bisect_right(column, start), bisect.bisect_left(column, end))
+
+    # Returns the columns of a region, in the order of utility.REGION_COLUMNS, so utility.format_database_data() can turn them into a Region.
+    def get_region(self, index: int) -> typing.Tuple[str, str, int, float, float, int, int, int]:
+        return (self.get_canon_name(index), self.get_api_name(index), index, self.seconds_major[index], self.seconds_minor[index],
+                self.delendos[index], self.executive[index], self.tags[index])
@@ -0,0 +1,55 @@
+# stubs.py - Stand-ins for the bot and Discord objects, for running cogs offline
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# Used by replay.py and the tests. Nothing is sent over the network: messages sent to a stub channel are passed to a callback instead,
+# along with the channel's ID.
+
+import time, typing
+
+# Called with the ID of the channel a message was sent to, and the message.
+SendCallback = typing.Callable[[int, typing.Optional[str]], None]
+
+class StubChannel:
+    def __init__(self, id: int, on_send: SendCallback) -> None:
+        self.id = id
+        self.on_send = on_send
+
+    async def send(self, content: typing.Optional[str] = None, **kwargs) -> None:
+        self.on_send(self.id, content)
+
+class StubRole:
+    mention = "@role"
+
+class StubGuild:
+    def __init__(self, id: int, on_send: SendCallback) -> None:
+        self.id = id
+        self.on_send = on_send
+
+    def get_channel(self, id: int) -> StubChannel:
+        return StubChannel(id, self.on_send)
+
+    def get_role(self, id: int) -> StubRole:
+        return StubRole()
+
+# Stands in for the bot, for cogs that only use it to find other cogs, look up guilds and channels, and dispatch events.
+# Messages sent to its channels are kept in sent, and dispatched events in dispatched, along with time.monotonic() at the time.
+class StubBot:
+    def __init__(self, cogs: dict[str, typing.Any] = {}) -> None:
+        self.cogs = dict(cogs)
+        self.sent: typing.List[tuple[int, typing.Optional[str]]] = []
+        self.dispatched: typing.List[tuple[str, tuple, float]] = []
+
+    def get_cog(self, name: str) -> typing.Any:
+        return self.cogs.get(name)
+
+    def get_guild(self, id: int) -> StubGuild:
+        return StubGuild(id, self.record_message)
+
+    def get_channel(self, id: int) -> StubChannel:
+        return StubChannel(id, self.record_message)
+
+    def dispatch(self, name: str, *args) -> None:
+        self.dispatched.append((name, args, time.monotonic()))
+
+    def record_message(self, channel_id: int, content: typing.Optional[str]) -> None:
+        self.sent.append((channel_id, content))
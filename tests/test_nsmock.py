@@ -0,0 +1,68 @@
+# test_nsmock.py - Tests of EventStream against the stand-in NationStates server
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# Usage: python -m unittest discover tests (or python -m pytest tests)
+
+import asyncio, unittest
+from aiohttp import web
+import sans
+import nsmock
+import utility as util
+from stubs import StubBot
+from cogs.sse import EventStream
+
+# Seconds every happening is held back by on the slow connection.
+CONNECTION_DELAY = 0.3
+
+class DeduplicationTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        sans.set_agent("Everblaze tests")
+
+        regions = nsmock.generate_regions(40)
+        self.simulator = nsmock.UpdateSimulator(regions, speed=5400, start_delay=0.5, wa_events=0.5, delegate_changes=0.1)
+        # Only the second connection opened is slow, so whichever of EventStream's connections opens first wins every happening.
+        self.server = nsmock.MockServer(regions, self.simulator, connection_delays={1: CONNECTION_DELAY})
+
+        # The SSE handlers never return by themselves, so don't wait for them when shutting down.
+        self.runner = web.AppRunner(self.server.create_app(), shutdown_timeout=0.1)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        (host, port) = self.runner.addresses[0][:2]
+        util.set_ns_base_url(f"http://{host}:{port}")
+
+    async def asyncTearDown(self) -> None:
+        util.set_ns_base_url(None)
+        await self.runner.cleanup()
+
+    async def test_dispatches_earliest_copy_once(self) -> None:
+        bot = StubBot()
+        stream = EventStream(bot, connections=2)
+        await stream.cog_load()
+
+        # Wait for both connections to be open before update starts, then for the slow one to get every happening too.
+        while len(self.simulator.subscribers) < 2:
+            await asyncio.sleep(0.01)
+        while sum(1 for (name, _, _) in bot.dispatched if name == "region_update") < 40:
+            await asyncio.sleep(0.05)
+        while sum(stats.received for stats in stream.connection_stats) < 2 * self.simulator.sent:
+            await asyncio.sleep(0.05)
+        await stream.cog_unload()
+
+        # Every happening was dispatched once, in the order it was sent, as it arrived on the fast connection.
+        regions = [args[0].region for (name, args, _) in bot.dispatched if name == "region_update"]
+        self.assertEqual(regions, [f"region_{index}" for index in range(40)])
+        self.assertEqual(stream.stats.received, len(bot.dispatched))
+
+        fast = stream.connection_stats[0] if stream.connection_stats[0].wins != 0 else stream.connection_stats[1]
+        slow = stream.connection_stats[1] if fast is stream.connection_stats[0] else stream.connection_stats[0]
+        self.assertEqual(fast.wins, self.simulator.sent)
+        self.assertEqual(slow.wins, 0)
+        self.assertEqual(slow.received, self.simulator.sent)
+
+        # The slow connection's copies came about CONNECTION_DELAY later, and were ignored.
+        self.assertGreater(slow.total_delay / slow.received, CONNECTION_DELAY * 0.5)
+        self.assertLess(stream.stats.max_lag, CONNECTION_DELAY)
+
+if __name__ == "__main__":
+    unittest.main()
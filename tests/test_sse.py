@@ -0,0 +1,119 @@
+# test_sse.py - Tests of EventStream's event queue and watchdog
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# Usage: python -m unittest discover tests (or python -m pytest tests)
+
+import asyncio, time, typing, unittest
+import utility as util
+from stubs import StubBot
+from cogs.sse import EventQueue, EventStream, ReceivedEvent, STALE_TIMEOUT
+
+def region_update(region: str) -> ReceivedEvent:
+    return ReceivedEvent("region_update", util.RegionUpdateEvent(region, 0), 0)
+
+def endorsement(nation: str) -> ReceivedEvent:
+    return ReceivedEvent("wa", util.WAEvent("endo", nation), 0)
+
+# Take every event waiting in a queue, in order.
+def drain(queue: EventQueue) -> list[ReceivedEvent]:
+    async def get_all() -> list[ReceivedEvent]:
+        return [await queue.get() for _ in range(queue.qsize())]
+    return asyncio.run(get_all())
+
+class EventQueueTest(unittest.TestCase):
+    def test_drops_oldest_wa_happening_first(self) -> None:
+        queue = EventQueue(4)
+        events = [region_update("a"), endorsement("x"), region_update("b"), endorsement("y")]
+        for event in events:
+            self.assertIsNone(queue.put(event))
+
+        self.assertIs(queue.put(region_update("c")), events[1])
+        self.assertIs(queue.put(endorsement("z")), events[3])
+        self.assertEqual([event.data for event in drain(queue)],
+                         [("a", 0), ("b", 0), ("c", 0), ("endo", "z")])
+
+    def test_grows_rather_than_dropping_region_updates(self) -> None:
+        queue = EventQueue(2)
+        for region in ["a", "b", "c", "d"]:
+            self.assertIsNone(queue.put(region_update(region)))
+        self.assertEqual(queue.qsize(), 4)
+
+        # With region updates filling the queue past its size, the next WA happening is the only one that can go.
+        wa = endorsement("x")
+        self.assertIsNone(queue.put(wa))
+        self.assertIs(queue.put(region_update("e")), wa)
+        self.assertEqual([event.data.region for event in drain(queue)], ["a", "b", "c", "d", "e"])
+
+    def test_get_waits_for_an_event(self) -> None:
+        async def run() -> ReceivedEvent:
+            queue = EventQueue(2)
+            getter = asyncio.create_task(queue.get())
+            await asyncio.sleep(0)
+            self.assertFalse(getter.done())
+            queue.put(region_update("a"))
+            return await getter
+
+        self.assertEqual(asyncio.run(run()).data, ("a", 0))
+
+    def test_stream_counts_dropped_events(self) -> None:
+        stream = EventStream(StubBot(), queue_size=2)
+        for event in [endorsement("x"), region_update("a"), region_update("b"), region_update("c"), endorsement("y")]:
+            stream.enqueue(event)
+
+        self.assertEqual(stream.stats.dropped, {"wa": 1})
+        self.assertEqual(stream.stats.received, 5)
+        self.assertEqual(stream.stats.max_depth, 4)
+        self.assertEqual([event.name for event in drain(stream.queue)], ["region_update"] * 3 + ["wa"])
+
+# Stands in for UpdateListener, as far as the watchdog is concerned.
+class StubUpdateListener:
+    def __init__(self, updating: bool, expected_gap: float) -> None:
+        self.updating = updating
+        self.expected_gap = expected_gap
+
+    def is_updating(self) -> bool:
+        return self.updating
+
+    def get_expected_update_gap(self) -> float | None:
+        return self.expected_gap
+
+# A stream that never delivers anything, for connections the watchdog restarts.
+async def silent_stream(client: typing.Any) -> typing.AsyncIterator[dict]:
+    await asyncio.Event().wait()
+    yield {}
+
+class WatchdogTest(unittest.IsolatedAsyncioTestCase):
+    async def run_watchdog(self, updating: bool, last_events: typing.List[float], last_region_updates: typing.List[float]) -> EventStream:
+        stream = EventStream(StubBot({'UpdateListener': StubUpdateListener(updating, 5)}), connections=2, open_stream=silent_stream)
+        stream.reader_tasks = [asyncio.create_task(silent_stream(None).__anext__()) for _ in range(2)]
+        now = time.time()
+        stream.last_events = [now - seconds for seconds in last_events]
+        stream.last_event = max(stream.last_events)
+        stream.last_region_updates = [now - seconds for seconds in last_region_updates]
+        stream.last_region_update = max(stream.last_region_updates)
+
+        await stream.check_stale_loop.coro(stream)
+        for task in stream.reader_tasks:
+            task.cancel()
+        return stream
+
+    # During update, a connection still delivering WA happenings but no region updates is stalled.
+    async def test_update_restarts_connection_without_region_updates(self) -> None:
+        stream = await self.run_watchdog(True, [1, 1], [40, 1])
+        self.assertEqual(stream.restarts, [1, 0])
+        self.assertIsNone(stream.outage_since)
+
+    # Every connection going without region updates is an outage, dated from the last region update received.
+    async def test_update_outage_dates_from_last_region_update(self) -> None:
+        stream = await self.run_watchdog(True, [1, 1], [40, 30])
+        self.assertEqual(stream.restarts, [1, 1])
+        self.assertAlmostEqual(typing.cast(float, stream.outage_since), time.time() - 30, delta=1)
+
+    # Outside of update, region updates aren't expected, so only silence from every kind of happening counts.
+    async def test_outside_update_only_counts_any_event(self) -> None:
+        stream = await self.run_watchdog(False, [1, STALE_TIMEOUT + 10], [3600, 3600])
+        self.assertEqual(stream.restarts, [0, 1])
+        self.assertIsNone(stream.outage_since)
+
+if __name__ == "__main__":
+    unittest.main()
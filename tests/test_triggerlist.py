@@ -0,0 +1,162 @@
+# test_triggerlist.py - Randomized tests of utility.TriggerList against a plain list
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# Runs random sequences of operations on a TriggerList and on ReferenceTriggerList, which keeps its triggers in a plain list like
+# TriggerList used to, and checks that both always return the same triggers in the same order.
+# Usage: python -m unittest discover tests (or python -m pytest tests)
+
+import random, sqlite3, typing, unittest
+import utility as util
+
+REGION_NAMES = [f"region_{n}" for n in range(60)]
+
+# The list-based trigger list TriggerList replaced, kept as the reference for what it must return.
+class ReferenceTriggerList:
+    def __init__(self) -> None:
+        self.triggers: typing.List[typing.Dict] = []
+
+    def __len__(self) -> int:
+        return len(self.triggers)
+
+    def add_trigger(self, target: typing.Dict) -> None:
+        if self.query_trigger(target["api_name"]) is None:
+            self.triggers.append(target)
+
+    def add_triggers(self, targets: typing.List[typing.Dict]) -> None:
+        for target in targets:
+            self.add_trigger(target)
+
+    def sort_triggers(self, cursor: sqlite3.Cursor) -> None:
+        for trigger in self.triggers:
+            if "update_index" not in trigger.keys():
+                trigger["update_index"] = util.fetch_update_index(cursor, trigger["api_name"])
+
+        self.triggers.sort(key=lambda x: x["update_index"])
+
+    def reindex_triggers(self, cursor: sqlite3.Cursor) -> typing.List[typing.Dict]:
+        removed = []
+        for trigger in self.triggers:
+            update_index = util.fetch_update_index(cursor, trigger["api_name"])
+            if update_index is None:
+                removed.append(trigger)
+            else:
+                trigger["update_index"] = update_index
+
+        for trigger in removed:
+            self.triggers.remove(trigger)
+
+        self.triggers.sort(key=lambda x: x["update_index"])
+        return removed
+
+    def query_trigger(self, api_name: str) -> typing.Dict | None:
+        for trigger in self.triggers:
+            if trigger["api_name"] == api_name:
+                return trigger
+        return None
+
+    def remove_trigger(self, api_name: str) -> typing.Optional[typing.Dict]:
+        trigger = self.query_trigger(api_name)
+        if trigger is not None:
+            self.triggers.remove(trigger)
+        return trigger
+
+    def remove_all_updated_triggers(self, update_index: int) -> typing.List[typing.Dict]:
+        already_updated = [trigger for trigger in self.triggers if trigger["update_index"] < update_index]
+        for trigger in already_updated:
+            self.triggers.remove(trigger)
+        return already_updated
+
+# What a trigger is compared on, so the same trigger copied into both lists compares equal.
+def describe(triggers: typing.Iterable[typing.Dict | None]) -> typing.List[tuple]:
+    return [(trigger["api_name"], trigger.get("update_index"), trigger.get("value")) for trigger in triggers if trigger is not None]
+
+class TriggerListTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.con = sqlite3.connect(":memory:")
+        self.con.execute("CREATE TABLE regions (api_name TEXT, update_index INTEGER PRIMARY KEY)")
+        self.cursor = self.con.cursor()
+        self.update_indexes: dict[str, int] = {}
+
+    def tearDown(self) -> None:
+        self.con.close()
+
+    # Fill the regions table with 50 of the 60 region names, in a random update order, like a new data dump would.
+    def load_regions(self, rng: random.Random) -> None:
+        self.con.execute("DELETE FROM regions")
+        self.update_indexes = {name: index for (index, name) in enumerate(rng.sample(REGION_NAMES, 50))}
+        self.con.executemany("INSERT INTO regions VALUES (?, ?)", self.update_indexes.items())
+
+    def run_sequence(self, seed: int) -> None:
+        rng = random.Random(seed)
+        self.load_regions(rng)
+        reference = ReferenceTriggerList()
+        triggers = util.TriggerList()
+
+        # The reference list is only in update order after sort_triggers(), and can only remove updated triggers then.
+        in_order = True
+
+        for step in range(rng.randint(1, 80)):
+            operation = rng.random()
+            existing = list(self.update_indexes.keys())
+
+            if operation < 0.3:
+                trigger = {"api_name": rng.choice(existing), "value": step}
+                if rng.random() < 0.2:
+                    trigger["update_index"] = self.update_indexes[trigger["api_name"]]
+                reference.add_trigger(dict(trigger))
+                triggers.add_trigger(dict(trigger))
+                in_order = False
+            elif operation < 0.45:
+                targets = [{"api_name": rng.choice(existing), "value": step} for _ in range(rng.randint(0, 5))]
+                reference.add_triggers([dict(target) for target in targets])
+                triggers.add_triggers([dict(target) for target in targets])
+                in_order = False
+            elif operation < 0.6:
+                reference.sort_triggers(self.cursor)
+                triggers.sort_triggers(self.cursor)
+                in_order = True
+            elif operation < 0.7:
+                name = rng.choice(REGION_NAMES)
+                self.assertEqual(describe([reference.remove_trigger(name)]), describe([triggers.remove_trigger(name)]))
+            elif operation < 0.85 and in_order:
+                update_index = rng.randint(-1, 52)
+                self.assertEqual(describe(reference.remove_all_updated_triggers(update_index)), describe(triggers.remove_all_updated_triggers(update_index)))
+            elif operation < 0.9 and in_order:
+                self.load_regions(rng)
+                self.assertEqual(describe(reference.reindex_triggers(self.cursor)), describe(triggers.reindex_triggers(self.cursor)))
+            else:
+                name = rng.choice(REGION_NAMES)
+                self.assertEqual(describe([reference.query_trigger(name)]), describe([triggers.query_trigger(name)]))
+
+            self.assertEqual(len(reference), len(triggers))
+            if in_order:
+                self.assertEqual(describe(reference.triggers), describe(triggers.triggers))
+                first = reference.triggers[0]["update_index"] if len(reference) != 0 else None
+                self.assertEqual(first, triggers.next_update_index())
+                self.assertEqual(describe(reference.triggers[:1]), describe([triggers.next_trigger()]))
+            else:
+                # The reference list isn't in update order here, but next_trigger() must still match the ordered list.
+                self.assertEqual(describe(triggers.triggers[:1]), describe([triggers.next_trigger()]))
+                self.assertCountEqual(describe(reference.triggers), describe(triggers.triggers))
+
+    def test_random_sequences(self) -> None:
+        for seed in range(500):
+            with self.subTest(seed=seed):
+                self.run_sequence(seed)
+
+    # Many removals leave the heap full of stale entries, which are compacted away without changing anything the list returns.
+    def test_heap_compaction(self) -> None:
+        self.load_regions(random.Random(0))
+        triggers = util.TriggerList()
+        for _ in range(20):
+            triggers.add_triggers([{"api_name": name} for name in self.update_indexes.keys()])
+            triggers.sort_triggers(self.cursor)
+            for name in list(self.update_indexes.keys())[:40]:
+                triggers.remove_trigger(name)
+            self.assertLessEqual(len(triggers.heap), triggers.HEAP_COMPACTION_FACTOR * len(triggers) + 16 + 1)
+
+        remaining = sorted(index for (name, index) in self.update_indexes.items() if name not in list(self.update_indexes.keys())[:40])
+        self.assertEqual([trigger["update_index"] for trigger in triggers.triggers], remaining)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# test_triggers.py - Tests of TriggerManager's channel indexes and region update handling
+# Authored by Merethin, licensed under the BSD-2-Clause license.
+
+# Usage: python -m unittest discover tests (or python -m pytest tests)
+
+import asyncio, sqlite3, typing, unittest
+import utility as util
+from stubs import StubBot
+from cogs.guilds import Channel
+from cogs.lock import TargetLock
+from cogs.triggers import TriggerManager
+from cogs.update import UpdateListener, SSEGap
+
+REGION_COUNT = 10
+
+# Stand-ins for the other cogs that region updates go through.
+class StubDatabase:
+    def __init__(self, everblaze_db: sqlite3.Connection) -> None:
+        self.everblaze_db = everblaze_db
+        self.region_cache = util.RegionCache()
+        self.region_cache.preload(everblaze_db.cursor())
+
+class StubGuildManager:
+    def __init__(self) -> None:
+        self.channels: dict[int, Channel] = {}
+
+class TriggerManagerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.con = sqlite3.connect(":memory:")
+        self.con.execute("CREATE TABLE regions (canon_name TEXT, api_name TEXT, update_index INTEGER PRIMARY KEY, seconds_major REAL, seconds_minor REAL, delendos INTEGER, executive INTEGER, tags INTEGER)")
+        self.con.executemany("INSERT INTO regions VALUES (?, ?, ?, ?, ?, 0, 0, 0)",
+                             [(f"Region {n}", f"region_{n}", n, n * 2.0, n * 1.0) for n in range(REGION_COUNT)])
+        self.cursor = self.con.cursor()
+
+        self.bot = StubBot()
+        self.bot.cogs['Database'] = StubDatabase(self.con)
+        self.bot.cogs['GuildManager'] = guilds = StubGuildManager()
+        self.bot.cogs['TargetLock'] = TargetLock(self.bot)
+        self.bot.cogs['TriggerManager'] = self.triggers = TriggerManager(self.bot)
+        self.bot.cogs['UpdateListener'] = self.listener = UpdateListener(self.bot, None)
+
+        for channel_id in (1, 2):
+            guilds.channels[channel_id] = Channel(100, 0, 0, False, False)
+
+    def tearDown(self) -> None:
+        self.con.close()
+
+    def add_triggers(self, channel_id: int, regions: typing.List[str]) -> util.TriggerList:
+        targets = self.triggers.get_trigger_list_from_id(channel_id)
+        targets.add_triggers([{"api_name": region} for region in regions])
+        targets.sort_triggers(self.cursor)
+        return targets
+
+    def update(self, region: str) -> None:
+        asyncio.run(self.listener.on_region_update((region, 0)))
+
+    def test_update_pings_affected_channels(self) -> None:
+        self.add_triggers(1, ["region_5", "region_2"])
+        self.add_triggers(2, ["region_5"])
+
+        self.update("region_3")
+        self.assertEqual(self.bot.sent, [(1, "region_2 has already updated!")])
+
+        self.bot.sent.clear()
+        self.update("region_5")
+        self.assertCountEqual(self.bot.sent, [(1, "@role region_5 updated!"), (2, "@role region_5 updated!")])
+        self.assertEqual(self.triggers.subscriptions, {})
+
+    # A trigger list dropped by clear_triggers(), but still held by a command waiting for confirmation, keeps being changed afterwards.
+    def test_list_orphaned_by_clear_triggers(self) -> None:
+        orphan = self.add_triggers(1, ["region_2"])
+        self.triggers.clear_triggers()
+        self.add_triggers(2, ["region_5"])
+
+        orphan.add_trigger({"api_name": "region_5"})
+        orphan.sort_triggers(self.cursor)
+        orphan.remove_trigger("region_2")
+
+        self.assertEqual(self.triggers.subscriptions, {"region_5": {2}})
+        self.assertEqual(self.triggers.find_affected_channels("region_9", 9), [2])
+
+        self.update("region_5")
+        self.assertEqual(self.bot.sent, [(2, "@role region_5 updated!")])
+
+    # Same for a channel removed with remove_channel(), which may get a new trigger list of its own later.
+    def test_list_orphaned_by_remove_channel(self) -> None:
+        orphan = self.add_triggers(1, ["region_4"])
+        self.add_triggers(2, ["region_4"])
+        self.triggers.remove_channel(1)
+
+        orphan.add_trigger({"api_name": "region_3"})
+        orphan.sort_triggers(self.cursor)
+        self.assertEqual(self.triggers.subscriptions, {"region_4": {2}})
+
+        self.update("region_4")
+        self.assertEqual(self.bot.sent, [(2, "@role region_4 updated!")])
+
+        # The channel's new list is tracked, and the old one still isn't.
+        self.add_triggers(1, ["region_8"])
+        orphan.remove_trigger("region_3")
+        self.assertEqual(self.triggers.subscriptions, {"region_8": {1}})
+
+    # Channels left in the indexes without a trigger list are skipped, rather than aborting the update for every other channel.
+    def test_update_skips_channels_without_trigger_list(self) -> None:
+        self.add_triggers(2, ["region_5"])
+        self.triggers.subscriptions["region_5"].add(3)
+
+        self.update("region_5")
+        self.assertEqual(self.bot.sent, [(2, "@role region_5 updated!")])
+
+    # Channels are told which of their triggers updated while events were being missed.
+    def test_gap_lists_missed_triggers(self) -> None:
+        self.add_triggers(1, ["region_6", "region_3", "region_4", "region_8"])
+        self.add_triggers(2, ["region_9"])
+
+        asyncio.run(self.listener.on_sse_gap(SSEGap(2, 7, 12.0)))
+        self.assertEqual(self.bot.sent, [(1, "Lost connection to NationStates for 12.0s during update, 6 regions updated in the meantime! "
+                                            "Triggers that have updated: region_3, region_4, region_6")])
+
+if __name__ == "__main__":
+    unittest.main()
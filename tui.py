@@ -6,12 +6,21 @@ from textual.containers import Horizontal, Vertical
 from textual.widgets import Header, Footer, Static, Input, RichLog
 from textual import on, work
 from textual.message import Message
-import re, argparse, sqlite3, typing, sys, sans, asyncio
+import re, argparse, sqlite3, typing, sys, sans, asyncio, time
 import utility as util
+import snapshot, recording
 
 # Global variables.
 targets = util.TriggerList() # The list of targets to watch for updates (can be modified at runtime).
 cursor: typing.Optional[sqlite3.Cursor] = None # Database cursor
+store: typing.Optional[snapshot.RegionStore] = None # Memory-mapped snapshot of the region database
+timing_index: typing.Optional[util.TimingIndex] = None # Update times of every region, read from the snapshot
+region_cache = util.RegionCache() # Every region in the region database, keyed by api_name
+recorder: typing.Optional[recording.EventRecorder] = None # If set, every SSE event received is recorded, to be replayed later
+
+# Returns the stream of SSE events to listen to. Replaced with a recorded stream when replaying an update.
+def open_event_stream(client: sans.AsyncClient) -> typing.AsyncIterable[dict]:
+    return sans.serversent_events(client, "admin")
 
 # Input field to run commands.
 # Currently, these are the four supported commands:
@@ -140,19 +149,17 @@ class OutputLog(RichLog):
     # Update client/listener worker.
     @work(name="update")
     async def update_listener(self):
-        client = sans.AsyncClient()
-        async for event in sans.serversent_events(client, "admin"):
-            happening = event["str"]
-
-            # The happening line is formatted like this: "%%region_name%% updated." We want to know if the happening matches this, 
-            # and if so, retrieve the region name.
-            match = util.EVENTS["update"].match(happening)
-            if match is not None:
-                region_name = match.groups()[0]
+        client = util.ns_async_client()
+        async for event in open_event_stream(client):
+            if recorder is not None:
+                recorder.record(event, time.time())
 
-                print(f"log: {region_name} updated!")
+            # Only region updates matter here, which are formatted like this: "%%region_name%% updated."
+            happening = util.classify_sse_event(event)
+            if isinstance(happening, util.RegionUpdateEvent):
+                print(f"log: {happening.region} updated!")
 
-                self.app.post_message(TriggerApp.RegionUpdate(region_name))
+                self.app.post_message(TriggerApp.RegionUpdate(happening.region))
 
 def display_trigger(trigger: typing.Dict) -> str:
     if "target" not in trigger.keys():
@@ -256,14 +263,15 @@ class TriggerApp(App):
     def on_region_update(self, event: RegionUpdate) -> None:
         global targets
 
-        assert self.cursor
-
-        data = util.fetch_region_data_from_db(self.cursor, event.region)
+        # This runs for every region in update, so use the region cache rather than querying the database.
+        region_data = region_cache.get(event.region)
 
-        if data is None:
+        if region_data is None:
             return None
 
-        already_updated = targets.remove_all_updated_triggers(data["update_index"])
+        update_index = region_data.update_index
+
+        already_updated = targets.remove_all_updated_triggers(update_index)
         for trigger in already_updated:
             self.get_widget_by_id("output", expect_type=OutputLog).post_message(OutputLog.WriteLog(f"\u2e30 {trigger["api_name"]} has already updated!"))
             self.get_widget_by_id("triggers", expect_type=TriggerList).post_message(TriggerList.RefreshTriggerList())
@@ -290,24 +298,24 @@ class TriggerApp(App):
         
         target_time = 0
         if minor:
-            target_time = region_data["seconds_minor"] - event.delay
+            target_time = region_data.seconds_minor - event.delay
         else:
-            target_time = region_data["seconds_major"] - event.delay
+            target_time = region_data.seconds_major - event.delay
 
-        trigger = util.find_region_updating_at_time(self.cursor, target_time, minor, event.early_tolerance, event.late_tolerance)
+        trigger = util.find_region_updating_at_time(self.cursor, target_time, minor, event.early_tolerance, event.late_tolerance, timing_index)
         if trigger is None:
             self.get_widget_by_id("output", expect_type=OutputLog).post_message(OutputLog.WriteLog(f"\u2e30 No trigger found in the specified time range!"))
             return
 
         delay = 0
         if minor:
-            delay = region_data["seconds_minor"] - trigger["seconds_minor"]
+            delay = region_data.seconds_minor - trigger.seconds_minor
         else:
-            delay = region_data["seconds_major"] - trigger["seconds_major"]
+            delay = region_data.seconds_major - trigger.seconds_major
 
         targets.add_trigger({
             "target": event.target,
-            "api_name": trigger["api_name"],
+            "api_name": trigger.api_name,
             "delay": delay,
         })
         targets.sort_triggers(self.cursor)
@@ -319,6 +327,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="everblaze-tui", description="Versatile triggering tool for NationStates R/D")
     parser.add_argument("-n", "--nation-name", default="")
     parser.add_argument("-r", '--regenerate-db', action='store_true')
+    parser.add_argument("--keep-dump", action='store_true')
+    parser.add_argument("-i", "--incremental", action='store_true')
+    parser.add_argument("--tags", type=lambda value: value.split(","), default=[])
+    parser.add_argument("-j", "--jobs", type=util.check_positive_integer, default=1)
+    parser.add_argument("--offline", action='store_true')
+    parser.add_argument("--dump-date")
+    parser.add_argument("--dump-cache-days", type=util.check_positive_integer)
+    parser.add_argument("--record")
+    parser.add_argument("--ns-url")
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-t", "--triglist", default="")
@@ -334,15 +351,23 @@ if __name__ == "__main__":
 
     user_agent = f"Everblaze (TUI) by Merethin, used by {nation_name}"
     sans.set_agent(user_agent)
+    util.set_ns_base_url(args.ns_url)
 
     if not util.check_if_nation_exists(nation_name):
         print(f"The nation {nation_name} does not exist. Try again.")
         sys.exit(1)
 
-    util.bootstrap(args.regenerate_db)
+    util.bootstrap(args.regenerate_db, args.keep_dump, args.incremental, args.tags, args.jobs,
+                   args.offline, args.dump_date, args.dump_cache_days)
 
     con = sqlite3.connect("regions.db")
     cursor = con.cursor()
+    store = snapshot.RegionStore()
+    timing_index = util.TimingIndex.from_store(store)
+    region_cache.preload(cursor)
+
+    if args.record is not None:
+        recorder = recording.EventRecorder(args.record)
 
     if len(args.triglist) != 0:
         with open(args.triglist, "r") as trigger_file:
@@ -1,34 +1,76 @@
 # utility.py - Utility functions for the entire Everblaze suite of tools
 # Authored by Merethin, licensed under the BSD-2-Clause license.
 
-import typing, sqlite3, os, re, db, sans
+import typing, sqlite3, os, re, db, sans, json, snapshot, array, bisect, heapq, math, httpx, argparse
+from dataclasses import dataclass
 
 # Format a NationStates nation name to be compatible with the API.
 def format_nation_or_region(name: str) -> str:
     return name.lower().replace(" ", "_")
 
-# Convert a row from a database query to a dictionary with well-known keys.
-def format_database_data(data) -> typing.Dict:
-    output = {}
-    # Database row layout: (canon_name, api_name, update_index, seconds_major, seconds_minor, delendos, executive, password, governorless, wfe, embassies)
-    output["canon_name"] = data[0]
-    output["api_name"] = data[1]
-    output["update_index"] = data[2]
-    output["seconds_major"] = data[3]
-    output["seconds_minor"] = data[4]
-    output["delendos"] = data[5]
-    output["executive"] = data[6]
-    output["password"] = data[7]
-    output["governorless"] = data[8]
-    output["wfe"] = data[9]
-    output["embassies"] = data[10]
-
-    return output
+# Columns selected from the main region table by the query helpers below, in the order expected by format_database_data() (and Region).
+REGION_COLUMNS = "canon_name, api_name, update_index, seconds_major, seconds_minor, delendos, executive, tags"
+
+# A region from the local database, as returned by the query helpers below.
+# Queries can return tens of thousands of regions at once, so this uses __slots__ rather than a dictionary to keep them small and cheap to create.
+# Fields can still be read like dictionary keys (region["api_name"]), so code written for the dictionaries previously returned keeps working.
+class Region:
+    __slots__ = ("canon_name", "api_name", "update_index", "seconds_major", "seconds_minor", "delendos", "executive", "tags")
+
+    canon_name: str
+    api_name: str
+    update_index: int
+    seconds_major: float
+    seconds_minor: float
+    delendos: int
+    executive: int
+    tags: int # Bitmask of region tags, see fetch_tag_mask().
+
+    def __init__(self, canon_name: str, api_name: str, update_index: int, seconds_major: float, seconds_minor: float, delendos: int, executive: int, tags: int) -> None:
+        self.canon_name = canon_name
+        self.api_name = api_name
+        self.update_index = update_index
+        self.seconds_major = seconds_major
+        self.seconds_minor = seconds_minor
+        self.delendos = delendos
+        self.executive = executive
+        self.tags = tags
+
+    def __getitem__(self, key: str) -> typing.Any:
+        if key not in Region.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in Region.__slots__
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Region):
+            return all(getattr(self, key) == getattr(other, key) for key in Region.__slots__)
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Region({", ".join(f"{key}={getattr(self, key)!r}" for key in Region.__slots__)})"
+
+    def keys(self) -> typing.Tuple[str, ...]:
+        return Region.__slots__
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        return getattr(self, key) if key in Region.__slots__ else default
+
+    def as_dict(self) -> typing.Dict:
+        return {key: getattr(self, key) for key in Region.__slots__}
+
+# Convert a row from a database query selecting REGION_COLUMNS to a Region.
+def format_database_data(data) -> Region:
+    return Region(*data)
 
 # Fetch data for a region from the local database.
 # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
-def fetch_region_data_from_db(cursor: sqlite3.Cursor, region: str) -> typing.Dict | None:
-    cursor.execute("SELECT * FROM regions WHERE api_name = ?", [region])
+def fetch_region_data_from_db(cursor: sqlite3.Cursor, region: str) -> Region | None:
+    cursor.execute(f"SELECT {REGION_COLUMNS} FROM regions WHERE api_name = ?", [region])
     data = cursor.fetchone()
 
     if data is None:
@@ -38,8 +80,8 @@ def fetch_region_data_from_db(cursor: sqlite3.Cursor, region: str) -> typing.Dic
 
 # Fetch data for a region from the local database, using its update index.
 # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
-def fetch_region_data_with_index(cursor: sqlite3.Cursor, index: int) -> typing.Dict | None:
-    cursor.execute("SELECT * FROM regions WHERE update_index = ?", [index])
+def fetch_region_data_with_index(cursor: sqlite3.Cursor, index: int) -> Region | None:
+    cursor.execute(f"SELECT {REGION_COLUMNS} FROM regions WHERE update_index = ?", [index])
     data = cursor.fetchone()
 
     if data is None:
@@ -47,55 +89,319 @@ def fetch_region_data_with_index(cursor: sqlite3.Cursor, index: int) -> typing.D
 
     return format_database_data(data)
 
+# In-memory cache of regions from the local database, keyed by api_name.
+# Preload it with every region before update, so that looking up a region for each update event is a single dictionary access.
+# Once preloaded, regions that aren't in the cache don't exist in the database either, so misses don't have to query it.
+class RegionCache:
+    def __init__(self) -> None:
+        self.regions: typing.Dict[str, Region] = {}
+        self.preloaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.regions)
+
+    # Load every region from the local database at once, replacing anything already cached.
+    def preload(self, cursor: sqlite3.Cursor) -> None:
+        cursor.execute(f"SELECT {REGION_COLUMNS} FROM regions")
+        self.regions = {region.api_name: region for region in map(format_database_data, cursor.fetchall())}
+        self.preloaded = True
+
+    # Forget all cached regions, e.g. after the region database is regenerated. Call preload() again to refill the cache.
+    def invalidate(self) -> None:
+        self.regions = {}
+        self.preloaded = False
+
+    # Fetch data for a region from the cache only. Returns None if it isn't cached.
+    # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
+    def get(self, region: str) -> Region | None:
+        data = self.regions.get(region)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    # Fetch data for a region from the cache, or else from the local database (unless the cache was preloaded, since it would have it).
+    # Regions fetched from the database are added to the cache.
+    def fetch(self, cursor: sqlite3.Cursor, region: str) -> Region | None:
+        data = self.get(region)
+        if data is not None or self.preloaded:
+            return data
+
+        data = fetch_region_data_from_db(cursor, region)
+        if data is not None:
+            self.regions[region] = data
+        return data
+
+    # Returns a short summary of the cache's hit rate, for logging.
+    def format_stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups != 0 else 0
+        return f"{len(self.regions)} regions cached, {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+# Fetch the WFE and embassies of a region from the local database, as a dictionary with the "wfe" (in lowercase) and "embassies" (a list of region names) keys.
+# These are kept apart from the rest of the region data and are only needed to apply blacklists and whitelists.
+# The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
+def fetch_region_details(cursor: sqlite3.Cursor, region: str) -> typing.Dict | None:
+    cursor.execute("SELECT wfe FROM region_details WHERE api_name = ?", [region])
+    data = cursor.fetchone()
+
+    if data is None:
+        return None
+
+    cursor.execute("SELECT embassy FROM embassies WHERE region = ?", [region])
+    embassies = [row[0] for row in cursor.fetchall()]
+
+    return {"wfe": data[0], "embassies": embassies}
+
+# Build an SQL query (and its parameters) returning the update index of every region whose WFE contains any of the given phrases.
+# Phrases must be in lowercase, and are matched as plain substrings of the (lowercase) WFE, just like Python's "in" operator.
+# Phrases of three characters or more are looked up in the WFE full-text index. The index can't match anything shorter,
+# so shorter phrases fall back to scanning the WFE of every region.
+def format_wfe_match(phrases: typing.Collection[str]) -> typing.Tuple[str, typing.List]:
+    indexed = [phrase for phrase in phrases if len(phrase) >= 3]
+    scanned = [phrase for phrase in phrases if len(phrase) < 3]
+
+    queries = []
+    parameters = []
+
+    if len(indexed) != 0:
+        # Each phrase is quoted so that it's matched as a whole, with no FTS5 query syntax.
+        queries.append("SELECT rowid FROM wfe_index WHERE wfe_index MATCH ?")
+        parameters.append(" OR ".join(["\"" + phrase.replace("\"", "\"\"") + "\"" for phrase in indexed]))
+
+    if len(scanned) != 0:
+        queries.append("SELECT regions.update_index FROM regions JOIN region_details USING(api_name), json_each(?) AS phrase WHERE instr(region_details.wfe, phrase.value) > 0")
+        parameters.append(json.dumps(scanned))
+
+    if len(queries) == 0:
+        return ("SELECT NULL WHERE 0", [])
+
+    return (" UNION ".join(queries), parameters)
+
+# Return the update indexes of all regions whose WFE contains any of the given (lowercase) phrases, using a single query.
+def find_wfe_matches(cursor: sqlite3.Cursor, phrases: typing.Collection[str]) -> typing.Set[int]:
+    (query, parameters) = format_wfe_match(phrases)
+    cursor.execute(query, parameters)
+    return set(row[0] for row in cursor.fetchall())
+
+# Embassies and WFE words/phrases to filter regions with, as set up in a guild's blacklist or whitelist.
+# A region matches the filter if it has an embassy with any of the embassy regions, or if its WFE contains any of the phrases (case-insensitively).
+# If whitelist is set, only matching regions pass the filter. Otherwise, matching regions are excluded.
+@dataclass
+class RegionFilter:
+    embassies: typing.Collection[str] # Embassy region names, formatted as output by format_nation_or_region().
+    wfe: typing.Collection[str] # WFE words/phrases, in lowercase.
+    whitelist: bool
+
+# Build an SQL condition (and its parameters) that is true for regions in the regions table passing the filter.
+# The lists are passed as JSON arrays and matched inside SQLite, so candidate regions never have to be checked one by one in Python.
+def format_region_filter(region_filter: RegionFilter) -> typing.Tuple[str, typing.List]:
+    (wfe_query, wfe_parameters) = format_wfe_match(region_filter.wfe)
+
+    condition = ("(EXISTS (SELECT 1 FROM embassies WHERE embassies.region = regions.api_name AND embassies.embassy IN (SELECT value FROM json_each(?))) "
+                 f"OR regions.update_index IN ({wfe_query}))")
+
+    if not region_filter.whitelist:
+        condition = f"NOT {condition}"
+
+    return (condition, [json.dumps(list(region_filter.embassies)), *wfe_parameters])
+
+# Sorted update times of every region, for major and minor update, indexed by update index.
+# Update times only ever increase with the update index, so the region closest to a given time can be found with a binary search.
+class TimingIndex:
+    def __init__(self, seconds_major: typing.Sequence[float], seconds_minor: typing.Sequence[float]) -> None:
+        self.seconds_major = seconds_major
+        self.seconds_minor = seconds_minor
+
+    # Build a timing index from the region database. Prefer TimingIndex.from_store() if a snapshot is available, as it doesn't copy anything.
+    @classmethod
+    def from_database(cls, cursor: sqlite3.Cursor) -> "TimingIndex":
+        cursor.execute("SELECT seconds_major, seconds_minor FROM regions ORDER BY update_index")
+        rows = cursor.fetchall()
+        return cls(array.array("d", [row[0] for row in rows]), array.array("d", [row[1] for row in rows]))
+
+    # Build a timing index reading straight from the columns of a memory-mapped region snapshot.
+    @classmethod
+    def from_store(cls, store: snapshot.RegionStore) -> "TimingIndex":
+        return cls(store.seconds_major, store.seconds_minor)
+
+    # Find the update index of the region updating closest to delay, strictly between lower and upper, or None if there isn't any.
+    # If several regions are equally close, the one updating first is returned.
+    def find_closest(self, delay: float, minor: bool, lower: float, upper: float) -> int | None:
+        seconds = self.seconds_minor if minor else self.seconds_major
+        return find_closest_around(seconds, bisect.bisect_left(seconds, delay), delay, lower, upper)
+
+    # Same as find_closest(), for many delays at once, each with its own bounds. Returns one result per delay, in the same order.
+    # Delays are handled in increasing order, so that each binary search only has to look past the previous one.
+    def find_closest_many(self, delays: typing.Sequence[float], minor: bool, lowers: typing.Sequence[float], uppers: typing.Sequence[float]) -> typing.List[int | None]:
+        seconds = self.seconds_minor if minor else self.seconds_major
+        results: typing.List[int | None] = [None] * len(delays)
+
+        after = 0
+        for position in sorted(range(len(delays)), key=delays.__getitem__):
+            delay = delays[position]
+            after = bisect.bisect_left(seconds, delay, after)
+            results[position] = find_closest_around(seconds, after, delay, lowers[position], uppers[position])
+
+        return results
+
+# Pick the region updating closest to delay out of the ones around it in seconds (an update time column), strictly between lower and upper.
+# after must be the position of the first region updating at or after delay. If several regions are equally close, the one updating first wins.
+def find_closest_around(seconds: typing.Sequence[float], after: int, delay: float, lower: float, upper: float) -> int | None:
+    best_match = None
+    best_interval = 0.0
+
+    # First region updating at or after delay.
+    if after < len(seconds) and lower < seconds[after] < upper:
+        best_match = after
+        best_interval = seconds[after] - delay
+
+    # First of the regions updating at the last time before delay. It updates first, so it wins ties.
+    if after > 0:
+        before = bisect.bisect_left(seconds, seconds[after - 1], 0, after)
+        if lower < seconds[before] < upper and (best_match is None or delay - seconds[before] <= best_interval):
+            best_match = before
+
+    return best_match
+
 # Find a region updating at the specified delay from the start of update (approximately) in the local database.
 # If minor is set to true, will use minor update times. Otherwise, will use major update times.
 # If early_tolerance is nonzero, it is the number of seconds before <delay> that a region is permitted to update at in order to be returned, if there is no exact match.
 # If late_tolerance is nonzero, it is the number of seconds after <delay> that a region is permitted to update at in order to be returned, if there is no exact match.
-def find_region_updating_at_time(cursor: sqlite3.Cursor, delay: float, minor: bool, early_tolerance: float, late_tolerance: float) -> typing.Dict | None:
+# If timing_index is provided, it is used to find the region with a binary search instead of scanning every candidate from the database.
+def find_region_updating_at_time(cursor: sqlite3.Cursor, delay: float, minor: bool, early_tolerance: float, late_tolerance: float,
+                                 timing_index: typing.Optional[TimingIndex] = None) -> Region | None:
     if early_tolerance < 0.3:
         early_tolerance = 0.3 # minimum threshold
         
     if late_tolerance < 0.3:
         late_tolerance = 0.3 # minimum threshold
 
+    if timing_index is not None:
+        update_index = timing_index.find_closest(delay, minor, delay-early_tolerance, delay+late_tolerance)
+        if update_index is None:
+            return None
+        return fetch_region_data_with_index(cursor, update_index)
+
     if minor:
-        cursor.execute("SELECT * FROM regions WHERE seconds_minor > ? AND seconds_minor < ?", [delay-early_tolerance, delay+late_tolerance])
+        cursor.execute(f"SELECT {REGION_COLUMNS} FROM regions WHERE seconds_minor > ? AND seconds_minor < ?", [delay-early_tolerance, delay+late_tolerance])
     else:
-        cursor.execute("SELECT * FROM regions WHERE seconds_major > ? AND seconds_major < ?", [delay-early_tolerance, delay+late_tolerance])
+        cursor.execute(f"SELECT {REGION_COLUMNS} FROM regions WHERE seconds_major > ? AND seconds_major < ?", [delay-early_tolerance, delay+late_tolerance])
 
     data = cursor.fetchall()
     if len(data) == 0:
         return None
     
-    best_match = None
+    best_match: Region | None = None
     best_interval = 999999
 
     for region in data:
         region_data = format_database_data(region)
         interval = 0
         if minor:
-            interval = abs(delay - region_data["seconds_minor"])
+            interval = abs(delay - region_data.seconds_minor)
         else:
-            interval = abs(delay - region_data["seconds_major"])
+            interval = abs(delay - region_data.seconds_major)
         if interval < best_interval:
             best_interval = interval
             best_match = region_data
 
     return best_match
 
-# Return a list of all regions that have less endorsements than a point nation and have an executive delegacy.
-def find_raidable_regions(cursor: sqlite3.Cursor, point_endos: int, start: int = -1, require_governorless: bool = False) -> typing.List[typing.Dict]:
-    if require_governorless:
-        cursor.execute("SELECT * FROM regions WHERE executive = 1 AND password = 0 AND governorless = 1 AND delendos < ? AND update_index > ?", [point_endos, start])
-    else:
-        cursor.execute("SELECT * FROM regions WHERE executive = 1 AND password = 0 AND delendos < ? AND update_index > ?", [point_endos, start])
-    data = cursor.fetchall()
+# Same as find_region_updating_at_time(), for many delays at once. Returns the best trigger for each delay (or None), in the same order.
+# The tolerances can either be a single value for every delay, or one value per delay.
+# All triggers are found in a single pass over timing_index (built from the database if not provided), and fetched with a single query.
+def find_regions_updating_at_times(cursor: sqlite3.Cursor, delays: typing.Sequence[float], minor: bool,
+                                   early_tolerance: float | typing.Sequence[float], late_tolerance: float | typing.Sequence[float],
+                                   timing_index: typing.Optional[TimingIndex] = None) -> typing.List[Region | None]:
+    if isinstance(early_tolerance, (int, float)):
+        early_tolerance = [early_tolerance] * len(delays)
+    if isinstance(late_tolerance, (int, float)):
+        late_tolerance = [late_tolerance] * len(delays)
+
+    if timing_index is None:
+        timing_index = TimingIndex.from_database(cursor)
+
+    # Same minimum threshold as find_region_updating_at_time().
+    lowers = [delay - max(early, 0.3) for (delay, early) in zip(delays, early_tolerance)]
+    uppers = [delay + max(late, 0.3) for (delay, late) in zip(delays, late_tolerance)]
+
+    indexes = timing_index.find_closest_many(delays, minor, lowers, uppers)
+    regions = fetch_regions_with_indexes(cursor, [index for index in indexes if index is not None])
+
+    return [regions.get(index) if index is not None else None for index in indexes]
+
+# Fetch data for several regions from the local database at once, using their update indexes.
+# Returns a dictionary mapping each update index to the region's data. Indexes that don't exist are left out.
+def fetch_regions_with_indexes(cursor: sqlite3.Cursor, indexes: typing.Collection[int]) -> typing.Dict[int, Region]:
+    cursor.execute(f"SELECT {REGION_COLUMNS} FROM regions WHERE update_index IN (SELECT value FROM json_each(?))", [json.dumps(list(set(indexes)))])
+    return {region.update_index: region for region in map(format_database_data, cursor.fetchall())}
+
+# Returns the bitmask matching a list of region tags, as stored in the tags column of the region table.
+# Raises ValueError if any of the tags wasn't fetched when the database was generated.
+def fetch_tag_mask(cursor: sqlite3.Cursor, tags: typing.Iterable[str]) -> int:
+    tags = set(tags)
+    if len(tags) == 0:
+        return 0
+
+    cursor.execute("SELECT tag, bit FROM region_tags WHERE tag IN (SELECT value FROM json_each(?))", [json.dumps(list(tags))])
+    bits = dict(cursor.fetchall())
+
+    missing = tags - bits.keys()
+    if len(missing) > 0:
+        raise ValueError(f"region tags not in the database: {', '.join(sorted(missing))}")
+
+    mask = 0
+    for bit in bits.values():
+        mask |= 1 << bit
+    return mask
+
+# Find all regions that have less endorsements than a point nation and have an executive delegacy, updating after start (and up to end, if set).
+# If region_filter is provided, only regions passing it (as a blacklist or whitelist) are returned.
+# Only regions with all of require_tags and none of exclude_tags are returned (by default, passworded regions are excluded).
+# Regions are yielded lazily in update order, so callers that stop early (e.g. once they find a target) don't pay for the rest.
+def find_raidable_regions(cursor: sqlite3.Cursor, point_endos: int, start: int = -1, require_governorless: bool = False, region_filter: typing.Optional[RegionFilter] = None,
+                          require_tags: typing.Collection[str] = (), exclude_tags: typing.Collection[str] = ("password",), end: typing.Optional[int] = None) -> typing.Iterator[Region]:
+    query = f"SELECT {REGION_COLUMNS} FROM regions WHERE executive = 1 AND delendos < ? AND update_index > ?"
+    parameters: list = [point_endos, start]
+
+    if end is not None:
+        query += " AND update_index <= ?"
+        parameters.append(end)
 
-    output = []
-    for region in data:
-        output.append(format_database_data(region))
-
-    return output
+    if require_governorless:
+        require_tags = [*require_tags, "governorless"]
+
+    require_mask = fetch_tag_mask(cursor, require_tags)
+    if require_mask != 0:
+        query += " AND tags & ? = ?"
+        parameters += [require_mask, require_mask]
+
+    exclude_mask = fetch_tag_mask(cursor, exclude_tags)
+    if exclude_mask != 0:
+        query += " AND tags & ? = 0"
+        parameters.append(exclude_mask)
+
+    if region_filter is not None:
+        (condition, filter_parameters) = format_region_filter(region_filter)
+        query += f" AND {condition}"
+        parameters += filter_parameters
+
+    return iter_regions(cursor.connection, query + " ORDER BY update_index", parameters)
+
+# Run a query returning REGION_COLUMNS and yield each region as it is read.
+# The query runs on a cursor of its own, so the caller can keep using theirs while iterating. It is closed once iteration stops.
+def iter_regions(con: sqlite3.Connection, query: str, parameters: typing.Sequence) -> typing.Iterator[Region]:
+    cursor = con.cursor()
+    try:
+        cursor.execute(query, parameters)
+        for region in cursor:
+            yield format_database_data(region)
+    finally:
+        cursor.close()
 
 # Returns the number of regions in the database.
 def count_regions(cursor: sqlite3.Cursor) -> int:
@@ -105,34 +411,110 @@ def count_regions(cursor: sqlite3.Cursor) -> int:
 # Fetch the update index for a region from the local database.
 # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
 def fetch_update_index(cursor: sqlite3.Cursor, region: str) -> int | None:
-    data = fetch_region_data_from_db(cursor, region)
+    cursor.execute("SELECT update_index FROM regions WHERE api_name = ?", [region])
+    data = cursor.fetchone()
     if data is None:
         return None
-    return data["update_index"]
+    return data[0]
 
 # Fetch the canonical name (how it's displayed on NationStates) for a region from the local database.
 # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
 def fetch_canon_name(cursor: sqlite3.Cursor, region: str) -> str | None:
-    data = fetch_region_data_from_db(cursor, region)
+    cursor.execute("SELECT canon_name FROM regions WHERE api_name = ?", [region])
+    data = cursor.fetchone()
     if data is None:
         return None
-    return data["canon_name"]
+    return data[0]
 
 # List of triggers, with arbitrary additional values.
+# Triggers are indexed by api_name, and kept in a heap ordered by update index, so that finding or removing a trigger doesn't need to scan
+# the whole list, and removing all triggers that have already updated only touches those. Triggers that don't have an update index yet
+# are kept apart until sort_triggers() is called.
 class TriggerList:
+    # Once the heap holds this many times more entries than there are ordered triggers, stale entries are cleaned up.
+    HEAP_COMPACTION_FACTOR = 2
+
     def __init__(self) -> None:
-        self.triggers: list[dict] = []
+        self.index: dict[str, dict] = {} # Every trigger, by api_name.
+        self.pending: dict[str, dict] = {} # Triggers without an update index yet, by api_name, in the order they were added.
+        self.heap: list[tuple[int, int, str]] = [] # (update_index, sequence, api_name), may hold stale entries for triggers since removed.
+        self.heap_entries: dict[str, int] = {} # Sequence number of the live heap entry of each ordered trigger, by api_name.
+        self.sequence = 0 # Breaks ties between triggers with the same update index, in the order they were ordered in.
+        self.listeners: list[typing.Callable[[str, typing.Dict], None]] = []
 
     def __len__(self) -> int:
-        return len(self.triggers)
+        return len(self.index)
+
+    # All triggers in update order, followed by those without an update index yet (in the order they were added).
+    # This is a new list every time, so it can be kept around while the trigger list changes. Building it sorts every trigger, so read it
+    # once rather than every time it's needed, and use next_trigger() if only the first one is.
+    @property
+    def triggers(self) -> typing.List[typing.Dict]:
+        ordered = sorted(entry for entry in self.heap if self.heap_entries.get(entry[2]) == entry[1])
+        return [self.index[api_name] for (_, _, api_name) in ordered] + list(self.pending.values())
+
+    # Register a function to be called whenever the trigger list changes, with the kind of change and the trigger concerned:
+    #   "add" - a trigger was added to the list
+    #   "order" - a trigger got its update index, and is now in update order (this may come right after "add")
+    #   "remove" - a trigger was removed from the list
+    def add_listener(self, listener: typing.Callable[[str, typing.Dict], None]) -> None:
+        self.listeners.append(listener)
+
+    def notify_listeners(self, change: str, trigger: typing.Dict) -> None:
+        for listener in self.listeners:
+            listener(change, trigger)
+
+    # Returns the update index of the first trigger in update order, or None if there isn't any.
+    def next_update_index(self) -> int | None:
+        while len(self.heap) != 0 and self.heap_entries.get(self.heap[0][2]) != self.heap[0][1]:
+            heapq.heappop(self.heap)
+
+        if len(self.heap) == 0:
+            return None
+        return self.heap[0][0]
+
+    # Returns the first trigger of the list, as triggers[0] would, without building the whole list. None if the list is empty.
+    def next_trigger(self) -> typing.Dict | None:
+        if self.next_update_index() is not None:
+            return self.index[self.heap[0][2]]
+        return next(iter(self.pending.values()), None)
+
+    # Add a trigger to the heap, using its "update_index" value.
+    def push_trigger(self, trigger: typing.Dict) -> None:
+        self.sequence += 1
+        self.heap_entries[trigger["api_name"]] = self.sequence
+        heapq.heappush(self.heap, (trigger["update_index"], self.sequence, trigger["api_name"]))
+        self.notify_listeners("order", trigger)
+
+    # Forget about a trigger. Its heap entry (if any) goes stale, and is dropped once it reaches the top of the heap or the heap is compacted.
+    def drop_trigger(self, api_name: str) -> typing.Dict:
+        self.heap_entries.pop(api_name, None)
+        self.pending.pop(api_name, None)
+        trigger = self.index.pop(api_name)
+        self.notify_listeners("remove", trigger)
+
+        if len(self.heap) > self.HEAP_COMPACTION_FACTOR * len(self.heap_entries) + 16:
+            self.heap = [entry for entry in self.heap if self.heap_entries.get(entry[2]) == entry[1]]
+            heapq.heapify(self.heap)
+
+        return trigger
 
     # Add a new trigger to the list.
     # The trigger must be a dictionary with the "api_name" value set to the trigger region's name
     # with lowercase letters and underscores (as output by format_nation_or_region()).
     # This dictionary may contain any additional values.
     def add_trigger(self, target: typing.Dict) -> None:
-        if self.query_trigger(target["api_name"]) is None:
-            self.triggers.append(target)
+        api_name = target["api_name"]
+        if api_name in self.index:
+            return
+
+        self.index[api_name] = target
+        self.notify_listeners("add", target)
+
+        if "update_index" in target.keys():
+            self.push_trigger(target)
+        else:
+            self.pending[api_name] = target
 
     # Add several new triggers to the list.
     # Each trigger must be a dictionary with the "api_name" value set to the trigger region's name
@@ -144,58 +526,82 @@ class TriggerList:
 
     # Sort the triggers by update order, in ascending order. (First updating trigger goes first, last updating trigger goes last).
     # If the triggers have "update_index" values they will be used, otherwise they will be queried from the database.
+    # Triggers are always kept in order, so this only has to look up the ones added since the last call.
     def sort_triggers(self, cursor: sqlite3.Cursor) -> None:
-        for trigger in self.triggers:
+        for trigger in list(self.pending.values()):
             if "update_index" not in trigger.keys():
-                region_data = fetch_region_data_from_db(cursor, trigger["api_name"])
-                assert region_data
-                trigger["update_index"] = region_data["update_index"]
+                update_index = fetch_update_index(cursor, trigger["api_name"])
+                assert update_index is not None
+                trigger["update_index"] = update_index
+
+            del self.pending[trigger["api_name"]]
+            self.push_trigger(trigger)
 
-        self.triggers.sort(key=lambda x: x["update_index"])
+    # Query the update index of every trigger from the database again and re-sort them, after the database has been regenerated.
+    # Triggers whose region no longer exists are removed from the list and returned.
+    def reindex_triggers(self, cursor: sqlite3.Cursor) -> typing.List[typing.Dict]:
+        removed = []
+        triggers = self.triggers
+
+        for trigger in triggers:
+            self.drop_trigger(trigger["api_name"])
+
+        for trigger in triggers:
+            update_index = fetch_update_index(cursor, trigger["api_name"])
+            if update_index is None:
+                removed.append(trigger)
+            else:
+                trigger["update_index"] = update_index
+                self.add_trigger(trigger)
+
+        return removed
 
     # Find the trigger object with any associated data for the corresponding region.
     # If the region is not in the trigger list, None will be returned.
     # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
     def query_trigger(self, api_name: str) -> typing.Dict | None:
-        for trigger in self.triggers:
-            if trigger["api_name"] == api_name:
-                return trigger
-            
-        return None
-    
+        return self.index.get(api_name)
+
     # Remove a region from the trigger list, if present, and return it.
     # The region's name must be formatted with lowercase letters and underscores (as output by format_nation_or_region()).
     def remove_trigger(self, api_name: str) -> typing.Optional[typing.Dict]:
-        value = None
-
-        for trigger in self.triggers:
-            if trigger["api_name"] == api_name:
-                value = trigger
-
-        if value is not None:
-            self.triggers.remove(value)
-
-        return value
+        if api_name not in self.index:
+            return None
+        return self.drop_trigger(api_name)
 
     # Remove all regions with a lower update index than provided from the trigger list, and return them.
+    # Triggers without an update index yet are left alone.
     def remove_all_updated_triggers(self, update_index: int) -> typing.List[typing.Dict]:
         already_updated = []
 
-        for trigger in self.triggers:
-            if trigger["update_index"] < update_index:
-                already_updated.append(trigger)
-
-        for trigger in already_updated:
-            self.triggers.remove(trigger)
+        while len(self.heap) != 0 and self.heap[0][0] < update_index:
+            (_, sequence, api_name) = heapq.heappop(self.heap)
+            if self.heap_entries.get(api_name) == sequence:
+                already_updated.append(self.drop_trigger(api_name))
 
         return already_updated
 
 # If needed, generate the region database.
 # If regenerate_db is set to True, it will always be generated. 
 # Otherwise, it will only be generated if there isn't already one.
-def bootstrap(regenerate_db: bool):
+# If keep_dump is set to True, the compressed data dump will be kept as regions.xml.gz.
+# If incremental is set to True, an existing database will be refreshed in place instead of being rebuilt from scratch.
+# extra_tags is a list of region tags to fetch and store on top of db.DEFAULT_REGION_TAGS.
+# workers is the number of processes used to parse the data dump.
+# Downloaded data dumps are cached for cache_days days (db.DUMP_CACHE_DAYS if not provided). If offline is set to True, the database is built from the newest cached dump
+# (or the one from dump_date, if provided) without downloading anything.
+# An existing database that isn't regenerated will be migrated to the current layout if needed, and its snapshot rewritten if it is out of date.
+def bootstrap(regenerate_db: bool, keep_dump: bool = False, incremental: bool = False, extra_tags: typing.List[str] = [], workers: int = 1,
+              offline: bool = False, dump_date: str | None = None, cache_days: int | None = None):
     if(regenerate_db or not os.path.exists("regions.db")):
-        db.generate_database()
+        cache = db.DumpCache() if cache_days is None else db.DumpCache(retention_days=cache_days)
+        db.generate_database(keep_dump, incremental, extra_tags, workers, offline, dump_date, cache)
+    else:
+        con = sqlite3.connect("regions.db")
+        db.migrate_database(con)
+        if not snapshot.is_snapshot_current():
+            snapshot.write_snapshot(con)
+        con.close()
 
 EVENTS: dict[str, re.Pattern] = {
     "update": re.compile(r"%%([a-z0-9_\-]+)%% updated\."),
@@ -205,11 +611,97 @@ EVENTS: dict[str, re.Pattern] = {
     "newdel": re.compile(r"@@([a-z0-9_\-]+)@@ became WA Delegate of %%([a-z0-9_\-]+)%%"),
     "seizedel": re.compile(r"@@([a-z0-9_\-]+)@@ seized the position of %%([a-z0-9_\-]+)%% WA Delegate from @@([a-z0-9_\-]+)@@"),
 }
-        
+
+# Every happening in EVENTS that starts with a nation, as a single pattern. Each kind of happening has a named group of its own,
+# and is the last one matched, so match.lastgroup tells which one it is.
+NATION_HAPPENINGS = re.compile(r"@@(?P<nation>[a-z0-9_\-]+)@@ (?:"
+                               r"endorsed @@(?P<endo>[a-z0-9_\-]+)@@"
+                               r"|withdrew its endorsement from @@(?P<unendo>[a-z0-9_\-]+)@@"
+                               r"|(?P<resign>resigned from the World Assembly)"
+                               r"|became WA Delegate of %%(?P<newdel>[a-z0-9_\-]+)%%"
+                               r"|seized the position of %%(?P<seizedel>[a-z0-9_\-]+)%% WA Delegate from @@(?:[a-z0-9_\-]+)@@)")
+
+# Happenings returned by classify_happening(). They unpack like the tuples passed to the bot's event listeners.
+class RegionUpdateEvent(typing.NamedTuple):
+    region: str # Region that updated.
+    time: int # UNIX timestamp of the update.
+
+class WAEvent(typing.NamedTuple):
+    kind: str # "endo", "unendo" or "resign".
+    nation: str # Nation that was endorsed, unendorsed, or resigned from the WA.
+
+class DelegateEvent(typing.NamedTuple):
+    nation: str # Nation that became WA Delegate.
+    region: str # Region it became WA Delegate of.
+
+Happening = RegionUpdateEvent | WAEvent | DelegateEvent
+
+# Name of the event each kind of happening is dispatched as.
+HAPPENING_EVENT_NAMES: dict[type, str] = {
+    RegionUpdateEvent: "region_update",
+    WAEvent: "wa",
+    DelegateEvent: "delegate",
+}
+
+# Find out which kind of happening (if any) a happening line is, in a single pass.
+# Region updates start with the region (%%region%%) and everything else with a nation (@@nation@@), so the first two characters
+# are enough to pick the one pattern that can match. Returns None for happenings Everblaze doesn't care about.
+# time is the UNIX timestamp of the happening, only used for region updates.
+def classify_happening(happening: str, time: int = 0) -> Happening | None:
+    if happening.startswith("%%"):
+        match = EVENTS["update"].match(happening)
+        if match is None:
+            return None
+        return RegionUpdateEvent(match.group(1), time)
+
+    if not happening.startswith("@@"):
+        return None
+
+    match = NATION_HAPPENINGS.match(happening)
+    if match is None:
+        return None
+
+    kind = match.lastgroup
+    if kind == "resign":
+        return WAEvent(kind, match.group("nation"))
+    if kind == "endo" or kind == "unendo":
+        return WAEvent(kind, match.group(kind))
+    return DelegateEvent(match.group("nation"), match.group(kind))
+
+# Classify an event from sans.serversent_events() with classify_happening().
+def classify_sse_event(data: dict) -> Happening | None:
+    happening = data["str"]
+    time = math.floor(data["time"].timestamp()) if happening.startswith("%%") else 0
+    return classify_happening(happening, time)
+
+# If set, requests to NationStates are sent to this server instead, keeping their path and query. Used to point Everblaze at a local
+# stand-in server (see nsmock.py) for testing. Requests to other servers skip sans' rate limiting, so tests aren't held back by it.
+ns_base_url: typing.Optional[httpx.URL] = None
+
+def set_ns_base_url(url: str | None) -> None:
+    global ns_base_url
+    ns_base_url = None if url is None else httpx.URL(url)
+
+# Returns a NationStates URL (as built by sans) pointing at ns_base_url, if set.
+def ns_url(url: httpx.URL) -> httpx.URL:
+    if ns_base_url is None:
+        return url
+    return url.copy_with(scheme=ns_base_url.scheme, host=ns_base_url.host, port=ns_base_url.port)
+
+# Request hook sending every request made through a client to ns_base_url, if set.
+async def rewrite_request_url(request: httpx.Request) -> None:
+    if ns_base_url is not None:
+        request.url = ns_url(request.url)
+        request.headers["Host"] = request.url.netloc.decode()
+
+# Returns a client whose requests go to ns_base_url if set, for URLs built inside sans (such as the SSE stream's).
+def ns_async_client() -> sans.AsyncClient:
+    return sans.AsyncClient(event_hooks={"request": [rewrite_request_url]})
+
 def check_if_nation_exists(nation: str) -> bool:
     query = sans.Nation(format_nation_or_region(nation), "name")
 
-    response = sans.get(query)
+    response = sans.get(ns_url(query))
     if response.status_code == 200:
         return True
     elif response.status_code == 404:
@@ -218,6 +710,13 @@ def check_if_nation_exists(nation: str) -> bool:
         # Should never happen unless something's wrong with your connection to NS, in which case, it will throw an error as we can't connect to NS anyway.
         typing.assert_never(response.status_code)
 
+# Argument type for command-line flags that only accept positive integers.
+def check_positive_integer(value: typing.Any) -> int:
+    ivalue = int(value)
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
+    return ivalue
+
 # If update is "minor" with any capitalization, returns minor. Anything else is assumed to be major.
 def is_minor(update: str) -> bool:
     return update.lower() == "minor"
\ No newline at end of file